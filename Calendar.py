@@ -13,47 +13,435 @@
 
 # Code adapted from https://developers.google.com/calendar/quickstart/python
 from __future__ import print_function
+import argparse
+import calendar
+import contextlib
+import copy
+import cProfile
 import datetime
-import pickle
+import functools
+import json
+import math
 import os.path
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-
-# If modifying these scopes, delete the file token.pickle.
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import warnings
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: the token file is still written atomically, just not locked
+    fcntl = None
+
+# If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly', 'https://www.googleapis.com/auth/calendar.events']
 DEFAULT_REMINDER = 0
+# Maximum number of seconds `import Calendar` may take; checked by the test suite.
+IMPORT_TIME_BUDGET = 0.5
+# Calendar metadata (default reminders, time zone, access role) rarely changes, so it is kept for this many seconds.
+CALENDAR_METADATA_TTL = 300
+# Wide windows are split into shards of about this many days which are fetched in parallel
+SHARD_DAYS = 180
+MAX_SHARDS = 32
+MAX_PARALLEL_SHARDS = 4
+# A shard is split again while it is denser than one page and wider than this
+MIN_SHARD_SPAN = datetime.timedelta(days=1)
+# Largest page size accepted by events().list
+PAGE_SIZE = 250
+# SQLite file holding mutations that have not reached the server yet, and how often (seconds) it is flushed
+MUTATION_QUEUE_FILE = 'mutations.db'
+QUEUE_FLUSH_INTERVAL = 5
+# Flushes a mutation failing with an unexpected error (neither an HTTP status nor offline) is tried on
+MAX_SEND_ATTEMPTS = 5
+# Seconds a fetched list of events is reused, and the number of windows kept
+EVENT_CACHE_TTL = 60
+EVENT_CACHE_SIZE = 128
+# Number of events shown per page when browsing
+BROWSE_PAGE_SIZE = 10
+# Directory lookups are made for this many addresses at a time, with this many batches in parallel
+DIRECTORY_BATCH_SIZE = 50
+DIRECTORY_WORKERS = 4
+# Events formatted per worker process task when printing with processes
+PARALLEL_CHUNK_SIZE = 2000
+# Requests sent per batch HTTP request (the API accepts up to 1000 but recommends at most 50)
+BATCH_SIZE = 50
+# Times a batched request failing with 429 or 5xx is sent again
+BATCH_RETRIES = 3
+# Longest reminder the API accepts, in minutes (4 weeks)
+MAX_REMINDER_MINUTES = 40320
+# File name to record a trace of the session to, like the --trace option
+TRACE_VARIABLE = 'CALENDAR_TRACE'
+# File name of the change journal kept during the session, like the --journal option
+JOURNAL_VARIABLE = 'CALENDAR_JOURNAL'
+# Number of journal records between two checkpoints of the whole calendar
+CHECKPOINT_INTERVAL = 1000
+# Window policy used by main, see parse_window_policy, e.g. rolling:30:90
+WINDOW_POLICY_VARIABLE = 'CALENDAR_WINDOW'
+
+# The file storing the user's access and refresh tokens as JSON
+TOKEN_FILE = 'token.json'
+
+# calendarId -> (expiry time, metadata dict)
+_calendar_metadata_cache = {}
+# token file path -> (mtime_ns, size, token info dict)
+_token_cache = {}
+# email -> person (e.g. {"displayName": ...}) resolved during this session
+_directory_cache = {}
+_directory_lock = threading.Lock()
+# The Tracer recording spans, None when tracing is off
+_tracer = None
+# The ChangeJournal recording event changes, None when journaling is off
+_journal = None
+# Per thread http connections, httplib2 connections must not be shared between threads. Every thread keeps one
+# connection per API connection it ran requests of, so requests carry the credentials of their own API.
+_thread_local = threading.local()
+
+
+@contextlib.contextmanager
+def token_lock(path=TOKEN_FILE):
+    """
+    Hold an exclusive lock on the token file so only one process refreshes or rewrites it at a time.
+
+    @param path: The token file to lock
+    @type path: String
+    """
+    with open(path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def atomic_write(path, prefix, mode='w', sync=False):
+    """
+    Write a file through a temporary file in the same directory, renamed over path when the block completes, so
+    readers never see a half written file. When the block raises, the temporary file is removed and path is left
+    as it was. Like every file made by tempfile.mkstemp, the file is only readable by its owner.
+
+    @param path: The file to replace
+    @type path: String
+    @param prefix: Prefix of the temporary file's name, e.g. '.token-'
+    @type prefix: String
+    @param mode: 'w' for text, 'wb' for bytes
+    @type mode: String
+    @param sync: Flush the file to disk before it replaces path
+    @type sync: Boolean
+    @return: the open temporary file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=prefix)
+    try:
+        with os.fdopen(fd, mode) as stored:
+            yield stored
+            if sync:
+                stored.flush()
+                os.fsync(stored.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_token_info(path=TOKEN_FILE):
+    """
+    Return the stored token info, reading the file only when it changed since the last read.
+
+    @param path: The token file to read
+    @type path: String
+    @return: dict as produced by Credentials.to_json(), or None when no token is stored
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _token_cache.pop(path, None)
+        return None
+
+    cached = _token_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return dict(cached[2])
+
+    with open(path) as token:
+        info = json.load(token)
+    _token_cache[path] = (stat.st_mtime_ns, stat.st_size, info)
+    return dict(info)
+
+
+def write_token_info(info, path=TOKEN_FILE):
+    """
+    Atomically replace the stored token info. Nothing is written when the stored info is already identical.
+
+    @param info: token info as produced by Credentials.to_json()
+    @type info: dict
+    @param path: The token file to write
+    @type path: String
+    @return: True if the file was rewritten
+    """
+    if read_token_info(path) == info:
+        return False
+
+    with atomic_write(path, '.token-', sync=True) as token:
+        json.dump(info, token, separators=(',', ':'))
+
+    stat = os.stat(path)
+    _token_cache[path] = (stat.st_mtime_ns, stat.st_size, dict(info))
+    return True
+
+
+class Tracer:
+    """
+    Records nested spans (menu actions, API calls, rendering) of a session as Chrome trace events, and profiles
+    the main thread with cProfile. Open the saved trace in chrome://tracing or https://ui.perfetto.dev, and the
+    profile with pstats or snakeviz.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: File the trace is saved to; the profile is saved next to it with a .prof suffix
+        @type path: String
+        """
+        self.path = path
+        self.events = []
+        self.profile = cProfile.Profile()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """
+        Record the time spent in the with block as a span. Spans nest by time within a thread.
+
+        @param name: Name shown for the span
+        @type name: String
+        @param args: Extra details shown with the span
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                     "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6}
+            if args:
+                event["args"] = {key: str(value) for key, value in args.items()}
+            with self._lock:
+                self.events.append(event)
+
+    def chrome_trace(self):
+        """
+        Return the recorded spans in the Chrome trace event format.
+
+        @return: dict
+        """
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def save(self):
+        """
+        Write the trace to path and the cProfile statistics to path + '.prof'.
+        @return: No return
+        """
+        with open(self.path, 'w') as trace:
+            json.dump(self.chrome_trace(), trace)
+        self.profile.dump_stats(self.path + '.prof')
 
 
+def start_tracing(path):
+    """
+    Start recording spans and profiling the main thread.
+
+    @param path: File the trace is saved to by stop_tracing
+    @type path: String
+    @return: The Tracer
+    """
+    global _tracer
+    _tracer = Tracer(path)
+    _tracer.profile.enable()
+    return _tracer
+
+
+def stop_tracing():
+    """
+    Stop tracing and save the trace and profile.
+    @return: The Tracer that was recording, None if tracing was off
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.profile.disable()
+        tracer.save()
+    return tracer
+
+
+def trace_span(name, **args):
+    """
+    Return a context manager recording a span when tracing is on, and doing nothing otherwise.
+
+    @param name: Name shown for the span
+    @type name: String
+    """
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, **args)
+
+
+def traced(name):
+    """
+    Decorator recording every call of a function as a span when tracing is on.
+
+    @param name: Name shown for the span
+    @type name: String
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@traced("get_calendar_api")
 def get_calendar_api():
     """
     Get an object which allows you to consume the Google Calendar API.
     You do not need to worry about what this function exactly does, nor create test cases for it.
     """
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
+    # The Google client libraries are slow to import, so they are only loaded once the API is actually needed.
+    # This keeps `import Calendar` (test runs, date helpers) within IMPORT_TIME_BUDGET.
+    from googleapiclient.discovery import build
+
+    return build('calendar', 'v3', credentials=get_credentials())
+
+
+def get_credentials(path=TOKEN_FILE):
+    """
+    Load the user's credentials from token.json, refreshing them or letting the user log in when needed.
+    You do not need to worry about what this function exactly does, nor create test cases for it.
+
+    @param path: The token file, e.g. the per user files of the HTTP server (CalendarServer --login)
+    @type path: String
+    """
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+
+    # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+    # time. The lock makes other processes wait for, and then reuse, a token
+    # this process is refreshing instead of refreshing it again.
+    with token_lock(path):
+        info = read_token_info(path)
+        creds = Credentials.from_authorized_user_info(info, SCOPES) if info else None
+
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    'credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run
+            write_token_info(json.loads(creds.to_json()), path)
+
+    return creds
 
-    return build('calendar', 'v3', credentials=creds)
 
+class EventCache:
+    """
+    Read-through cache of event lists keyed on (calendar, timeMin, timeMax, q, maxResults).
+
+    Entries expire after ttl seconds and the least recently used entry is evicted once maxsize windows are cached.
+    Concurrent misses on the same key share a single fetch: the first caller fetches, the others wait for its
+    result. Every caller gets its own deep copy of the value, so changing the returned events (e.g. the edits
+    of the menu) never changes the cached ones.
+    """
+
+    def __init__(self, ttl=EVENT_CACHE_TTL, maxsize=EVENT_CACHE_SIZE):
+        """
+        @param ttl: Seconds an entry is reused
+        @type ttl: Integer
+        @param maxsize: Maximum number of cached entries
+        @type maxsize: Integer
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # key -> (expiry time, value), least recently used first
+        self._entries = OrderedDict()
+        # key -> Future of the fetch in progress
+        self._in_flight = {}
+        # Incremented by clear, so fetches started before a clear are not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Return the cached value of key, calling fetch() to produce it on a miss.
+
+        @param key: Hashable cache key
+        @param fetch: Function without arguments returning the value
+        @type fetch: callable
+        @return: A deep copy of the cached or fetched value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            generation = self._generation
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            value = fetch()
+        except BaseException as error:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(error)
+            raise
+
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        future.set_result(value)
+        return copy.deepcopy(value)
+
+    def clear(self):
+        """
+        Drop every entry, e.g. after the events were changed.
+        @return: No return
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
 
-def get_upcoming_events(api, starting_time, number_of_events, time_Max, key_Word):
+
+def get_upcoming_events(api, starting_time, number_of_events, time_Max, key_Word, cache=None):
     """
     get_upcoming_events(api, starting_time, number_of_events)
 
@@ -66,15 +454,489 @@ def get_upcoming_events(api, starting_time, number_of_events, time_Max, key_Word
     @type starting_time: string in UTC format (YYYY-MM-DDT*HH:MM:SS), T* is separator between time and date
     @param number_of_events: maximum number of events to be printed
     @type number_of_events: Integer
+    @param cache: Cache to read the events through, None to always query the API
+    @type cache: EventCache
     """
 
     if number_of_events <= 0:
         raise ValueError("Number of events must be at least 1.")
 
-    events_result = api.events().list(calendarId='primary', timeMin=starting_time, timeMax=time_Max,
-                                      maxResults=number_of_events, singleEvents=True, q=key_Word,
-                                      orderBy='startTime').execute()
-    return events_result.get("items", [])
+    def fetch():
+        with trace_span("events.list", timeMin=starting_time, timeMax=time_Max, q=key_Word):
+            # Also run by the navigation prefetcher's threads, which need their own connection
+            events_result = execute_request(api.events().list(calendarId='primary', timeMin=starting_time,
+                                                              timeMax=time_Max, maxResults=number_of_events,
+                                                              singleEvents=True, q=key_Word, orderBy='startTime'))
+        events = events_result.get("items", [])
+        journal_events(events)
+        return events
+
+    if cache is None:
+        return fetch()
+    return cache.get_or_fetch(('primary', starting_time, time_Max, key_Word, number_of_events), fetch)
+
+
+def to_rfc3339(time_value):
+    """
+    Format a datetime as a zero padded RFC3339 UTC timestamp for timeMin/timeMax.
+
+    @param time_value: A time, naive values are taken to be in UTC
+    @type time_value: datetime class object
+    @return: String such as 2020-01-05T00:00:00Z
+    """
+    if time_value.tzinfo is not None:
+        time_value = time_value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time_value.isoformat() + 'Z'  # 'Z' indicates UTC time
+
+
+@functools.lru_cache(maxsize=64)
+def get_time_zone(name):
+    """
+    Return the tzinfo of an IANA time zone name such as 'Australia/Melbourne'. Zones are loaded from the tz
+    database once and cached, together with their offset transitions. Without a tz database (Python 3.8 without
+    backports.zoneinfo) or for an unknown name, UTC is returned, which is how days were bounded before, and a
+    RuntimeWarning is issued once for the name.
+
+    @param name: The time zone, e.g. the time_zone of get_calendar_metadata
+    @type name: String
+    @return: tzinfo
+    """
+    if not name or name == "UTC":
+        return datetime.timezone.utc
+    try:
+        from zoneinfo import ZoneInfo
+    except ImportError:
+        try:
+            from backports.zoneinfo import ZoneInfo
+        except ImportError:
+            # Cached per name, so each zone is warned about once
+            warnings.warn("No time zone database, days in " + name + " are bounded in UTC", RuntimeWarning)
+            return datetime.timezone.utc
+    try:
+        return ZoneInfo(name)
+    except (KeyError, ValueError):
+        # ZoneInfoNotFoundError is a KeyError; malformed names raise ValueError
+        warnings.warn("Unknown time zone " + name + ", days are bounded in UTC", RuntimeWarning)
+        return datetime.timezone.utc
+
+
+@functools.lru_cache(maxsize=1024)
+def day_bounds(time_year: int, time_month: int, time_day: int, time_zone=None):
+    """
+    Return the UTC bounds of a day in a time zone, from its midnight up to (excluding) the next midnight. Both
+    midnights are resolved separately, so days on which the zone changes its offset are 23 or 25 hours long.
+
+    @param time_year: a year
+    @type time_year: integer
+    @param time_month: a month
+    @type time_month: integer
+    @param time_day: a day
+    @type time_day: integer
+    @param time_zone: The calendar's time zone, e.g. 'Australia/Melbourne'; UTC when None
+    @type time_zone: String
+    @return: (timeMin, timeMax) strings in RFC3339 format
+    @raise ValueError: if the date does not exist
+    """
+    day = datetime.date(time_year, time_month, time_day)
+    zone = get_time_zone(time_zone)
+    start = datetime.datetime.combine(day, datetime.time(), zone)
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(), zone)
+    return to_rfc3339(start), to_rfc3339(end)
+
+
+# Matches the timestamps datetime.fromisoformat rejects before Python 3.11, e.g. 'Z' suffixes and 4 digit fractions
+_RFC3339_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?"
+                              r"(?:([Zz])|([+-])(\d{2}):?(\d{2}))?$")
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_rfc3339(value):
+    """
+    Parse a dateTime or date value of an event into a timezone aware datetime. Results are cached, so every
+    timestamp is only parsed once however often the event is rendered or indexed.
+
+    @param value: e.g. 2019-06-03T02:00:00+09:00, 2020-01-05T00:00:00Z or 2020-01-05 for all day events
+    @type value: String
+    @return: datetime class object, all day dates are midnight UTC
+    """
+    if len(value) == 10:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+    try:
+        parsed = datetime.datetime.fromisoformat(value[:-1] + "+00:00" if value[-1] in "Zz" else value)
+    except ValueError:
+        parsed = None
+    if parsed is None or parsed.tzinfo is None:
+        match = _RFC3339_PATTERN.match(value)
+        if match is None:
+            raise ValueError("Invalid RFC3339 timestamp: " + value)
+        (year, month, day, hour, minute, second, fraction, zulu, sign, offset_hours,
+         offset_minutes) = match.groups()
+        offset = datetime.timedelta(0)
+        if sign:
+            offset = datetime.timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+            if sign == "-":
+                offset = -offset
+        parsed = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                   int((fraction or "0")[:6].ljust(6, "0")), datetime.timezone(offset))
+    return parsed
+
+
+def event_time_value(event, key='start'):
+    """
+    Return the raw dateTime of an event boundary, or its date for all day events.
+
+    @param event: an event as returned by the API
+    @type event: dict
+    @param key: 'start' or 'end'
+    @type key: String
+    @return: String
+    """
+    return event[key].get('dateTime', event[key].get('date'))
+
+
+def event_start(event):
+    """
+    Return the start of an event as a timezone aware datetime.
+    """
+    return parse_rfc3339(event_time_value(event, 'start'))
+
+
+def event_end(event):
+    """
+    Return the end of an event as a timezone aware datetime.
+    """
+    return parse_rfc3339(event_time_value(event, 'end'))
+
+
+@traced("api.execute")
+def execute_request(request):
+    """
+    Execute an API request, giving every thread its own authorised connection when the request is run from a
+    worker thread (httplib2 is not thread safe). The connection is made with the credentials of the request's
+    own API, so one thread can run the requests of several users.
+
+    @param request: A request built from the api, e.g. api.events().list(...)
+    @type request: googleapiclient.http.HttpRequest
+    @return: The response of the request
+    """
+    if threading.current_thread() is threading.main_thread():
+        return request.execute()
+    try:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+    except ImportError:
+        return request.execute()
+
+    shared_http = getattr(request, 'http', None)
+    if not isinstance(shared_http, AuthorizedHttp):
+        return request.execute()
+    connections = getattr(_thread_local, 'connections', None)
+    if connections is None:
+        # Entries go away with the API connection they stand in for
+        connections = _thread_local.connections = weakref.WeakKeyDictionary()
+    http = connections.get(shared_http)
+    if http is None or http.credentials is not shared_http.credentials:
+        http = connections[shared_http] = AuthorizedHttp(shared_http.credentials, http=httplib2.Http())
+    return request.execute(http=http)
+
+
+def fetch_event_page(api, time_min, time_max, key_word="", page_size=PAGE_SIZE, page_token=None, **params):
+    """
+    Fetch one result page of events().list, recording its events in the change journal when journaling is on.
+    Every listing following pages goes through it.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param time_min: Lower bound (exclusive) of the events' end time
+    @type time_min: string in RFC3339 format
+    @param time_max: Upper bound (exclusive) of the events' start time
+    @type time_max: string in RFC3339 format
+    @param key_word: Events with this key word will be returned
+    @type key_word: String
+    @param page_size: Number of events requested per page
+    @type page_size: Integer
+    @param page_token: Token of the page to fetch, None for the first page
+    @type page_token: String
+    @param params: Any other events().list parameter
+    @return: The response of events().list, with the events in 'items' and the next page in 'nextPageToken'
+    """
+    request = api.events().list(calendarId='primary', timeMin=time_min, timeMax=time_max, maxResults=page_size,
+                                singleEvents=True, q=key_word, orderBy='startTime', pageToken=page_token, **params)
+    result = execute_request(request)
+    journal_events(result.get("items", []))
+    return result
+
+
+def list_events_in_window(api, time_min, time_max, key_word="", page_size=PAGE_SIZE, page_token=None, **params):
+    """
+    Return every event between time_min and time_max, following the result pages of events().list.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param time_min: Lower bound (exclusive) of the events' end time
+    @type time_min: string in RFC3339 format
+    @param time_max: Upper bound (exclusive) of the events' start time
+    @type time_max: string in RFC3339 format
+    @param key_word: Events with this key word will be returned
+    @type key_word: String
+    @param page_size: Number of events requested per page
+    @type page_size: Integer
+    @param page_token: Token of the first page to fetch, None to start at the first page
+    @type page_token: String
+    @param params: Any other events().list parameter
+    @return: list of events ordered by start time
+    """
+    events = []
+    while True:
+        result = fetch_event_page(api, time_min, time_max, key_word, page_size, page_token, **params)
+        events.extend(result.get("items", []))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return events
+
+
+def plan_time_shards(time_min, time_max, shard_days=SHARD_DAYS, max_shards=MAX_SHARDS):
+    """
+    Split [time_min, time_max) into consecutive shards of about shard_days days.
+
+    @param time_min: Start of the window
+    @type time_min: datetime class object
+    @param time_max: End of the window
+    @type time_max: datetime class object
+    @param shard_days: Preferred width of a shard in days
+    @type shard_days: Integer
+    @param max_shards: Upper limit of the number of shards
+    @type max_shards: Integer
+    @return: list of (start, end) datetime tuples in time order
+    """
+    span = time_max - time_min
+    if span <= datetime.timedelta(0):
+        return []
+    count = min(max_shards, max(1, math.ceil(span / datetime.timedelta(days=shard_days))))
+    step = span / count
+    bounds = [time_min + step * i for i in range(count)] + [time_max]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _fetch_shard(api, shard, key_word, params):
+    """
+    Fetch one shard. A shard holding more than one page of events is not fetched further, but split in two
+    halves that are fetched separately so dense periods get more parallelism.
+
+    @return: ("split", [first half, second half]) or ("events", list of events)
+    """
+    shard_min, shard_max = shard
+    result = fetch_event_page(api, to_rfc3339(shard_min), to_rfc3339(shard_max), key_word, **params)
+    page_token = result.get("nextPageToken")
+    if page_token and shard_max - shard_min > MIN_SHARD_SPAN:
+        middle = shard_min + (shard_max - shard_min) / 2
+        return "split", [(shard_min, middle), (middle, shard_max)]
+
+    events = result.get("items", [])
+    if page_token:
+        events.extend(list_events_in_window(api, to_rfc3339(shard_min), to_rfc3339(shard_max),
+                                            key_word, page_token=page_token, **params))
+    return "events", events
+
+
+def stream_events_sharded(api, time_min, time_max, key_word="", max_workers=MAX_PARALLEL_SHARDS,
+                          shard_days=SHARD_DAYS, **params):
+    """
+    Yield every event between time_min and time_max in start time order. The window is split into time shards
+    which are fetched concurrently by at most max_workers threads. Events overlapping a shard boundary are only
+    yielded once.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param time_min: Start of the window in UTC
+    @type time_min: datetime class object
+    @param time_max: End of the window in UTC
+    @type time_max: datetime class object
+    @param key_word: Events with this key word will be returned
+    @type key_word: String
+    @param max_workers: Maximum number of shards fetched at the same time
+    @type max_workers: Integer
+    @param shard_days: Preferred width of a shard in days
+    @type shard_days: Integer
+    @return: generator of events
+    """
+    seen = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Shards still to be yielded, in time order, each paired with the future fetching it
+        pending = [executor.submit(_fetch_shard, api, shard, key_word, params)
+                   for shard in plan_time_shards(time_min, time_max, shard_days)]
+        try:
+            while pending:
+                kind, value = pending.pop(0).result()
+                if kind == "split":
+                    pending[0:0] = [executor.submit(_fetch_shard, api, shard, key_word, params) for shard in value]
+                    continue
+                for event in value:
+                    if event['id'] not in seen:
+                        seen.add(event['id'])
+                        yield event
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_event_pages(api, time_min, time_max, key_word="", page_size=BROWSE_PAGE_SIZE, cache=None):
+    """
+    Yield the events between time_min and time_max one page at a time. While a page is being looked at, the
+    next one is already fetched in the background. With a cache, pages are read through it, so browsing the
+    same window again is served from memory until a mutation reaches the server.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param time_min: Lower bound (exclusive) of the events' end time
+    @type time_min: string in RFC3339 format
+    @param time_max: Upper bound (exclusive) of the events' start time
+    @type time_max: string in RFC3339 format
+    @param key_word: Events with this key word will be returned
+    @type key_word: String
+    @param page_size: Number of events per page
+    @type page_size: Integer
+    @param cache: Cache to read the pages through, None to always query the API
+    @type cache: EventCache
+    @return: generator of lists of events
+    """
+    def fetch(page_token):
+        def fetch_page():
+            return fetch_event_page(api, time_min, time_max, key_word, page_size, page_token)
+
+        if cache is None:
+            return fetch_page()
+        return cache.get_or_fetch(('primary', 'page', time_min, time_max, key_word, page_size, page_token),
+                                  fetch_page)
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        result = fetch(None)
+        while True:
+            page_token = result.get("nextPageToken")
+            upcoming = prefetcher.submit(fetch, page_token) if page_token else None
+            try:
+                yield result.get("items", [])
+            except GeneratorExit:
+                if upcoming is not None:
+                    upcoming.cancel()
+                raise
+            if upcoming is None:
+                return
+            result = upcoming.result()
+
+
+def browse_events(api, time_min, time_max, key_word="", page_size=BROWSE_PAGE_SIZE,
+                  default_reminder=DEFAULT_REMINDER, prepare=None, handles=None, cache=None):
+    """
+    Let the user page through the events between time_min and time_max. Only the visible page is fetched and
+    printed; pages already seen are kept so the user can go back.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param time_min: Lower bound (exclusive) of the events' end time
+    @type time_min: string in RFC3339 format
+    @param time_max: Upper bound (exclusive) of the events' start time
+    @type time_max: string in RFC3339 format
+    @param key_word: Events with this key word will be returned
+    @type key_word: String
+    @param page_size: Number of events per page
+    @type page_size: Integer
+    @param default_reminder: minutes shown for events using the calendar's default reminders
+    @type default_reminder: Integer
+    @param prepare: Applied to every page before it is shown, e.g. MutationQueue.apply_local
+    @type prepare: callable
+    @param handles: When given, events are numbered by their handle instead of their position on the page
+    @type handles: EventHandles
+    @param cache: Cache to read the pages through, see iter_event_pages
+    @type cache: EventCache
+    @return: The events of the page the user stopped at
+    """
+    pages = iter_event_pages(api, time_min, time_max, key_word, page_size, cache)
+    seen = []
+    current = 0
+    last_page = False
+    try:
+        while True:
+            if current == len(seen):
+                page = next(pages, None)
+                if page is None:
+                    last_page = True
+                    current -= 1
+                    if current < 0:
+                        print_events([], default_reminder)
+                        return []
+                    print("There are no more events.")
+                else:
+                    seen.append(prepare(page) if prepare is not None else page)
+            events = seen[current]
+            print("Page", current + 1)
+            print_events(events, default_reminder, handles)
+
+            choice = input("[N]ext page, [P]revious page, [D]one: ").upper()
+            if choice == "N" and not (last_page and current == len(seen) - 1):
+                current += 1
+            elif choice == "P" and current > 0:
+                current -= 1
+            elif choice == "D":
+                return events
+    finally:
+        pages.close()
+
+
+def get_calendar_metadata(api, calendar_id='primary', ttl=CALENDAR_METADATA_TTL):
+    """
+    Return the metadata of a calendar, fetching it from calendarList only when the cached copy has expired.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param calendar_id: The calendar to describe
+    @type calendar_id: String
+    @param ttl: Number of seconds a fetched copy stays valid
+    @type ttl: Integer
+    @return: dict with the keys default_reminder (minutes), time_zone and access_role
+    """
+    now = time.monotonic()
+    cached = _calendar_metadata_cache.get(calendar_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    with trace_span("calendarList.get", calendarId=calendar_id):
+        entry = api.calendarList().get(calendarId=calendar_id).execute()
+    reminders = entry.get("defaultReminders") or []
+    metadata = {
+        "default_reminder": reminders[0]["minutes"] if reminders else DEFAULT_REMINDER,
+        "time_zone": entry.get("timeZone", "UTC"),
+        "access_role": entry.get("accessRole"),
+    }
+    _calendar_metadata_cache[calendar_id] = (now + ttl, metadata)
+    return metadata
+
+
+def clear_calendar_metadata():
+    """
+    Forget every cached calendar metadata entry so the next lookup goes to the server.
+    @return: No return
+    """
+    _calendar_metadata_cache.clear()
+
+
+def get_reminder_minutes(event, default_reminder=DEFAULT_REMINDER):
+    """
+    Return the reminder of an event in minutes, or None when the event has no usable reminder.
+
+    @param event: an event as returned by the API
+    @type event: dict
+    @param default_reminder: minutes used when the event follows the calendar's default reminders
+    @type default_reminder: Integer
+    @return: Integer or None
+    """
+    reminders = event['reminders']
+    if reminders["useDefault"]:
+        return default_reminder
+    try:
+        return reminders['overrides'][0]['minutes']
+    except (KeyError, IndexError, TypeError):
+        return None
 
 
 # Add your methods here.
@@ -89,7 +951,7 @@ def sub_five_years(time_now: int) -> datetime:
     """
     # Solution from https://stackoverflow.com/questions/5158160/python-get-datetime-for-3-years-ago-today
     num_years = 5
-    return time_now.replace(time_now.year - num_years).isoformat() + 'Z'  # 'Z' indicates UTC time
+    return to_rfc3339(_shift_years(time_now, -num_years))
 
 
 def add_two_years(time_now: int) -> datetime:
@@ -103,29 +965,134 @@ def add_two_years(time_now: int) -> datetime:
     """
     # Solution from https://stackoverflow.com/questions/5158160/python-get-datetime-for-3-years-ago-today
     num_years = 2
-    return time_now.replace(time_now.year + num_years).isoformat() + 'Z'  # 'Z' indicates UTC time
+    return to_rfc3339(_shift_years(time_now, num_years))
 
 
-def get_all_events(api, time_now: int):
+def _shift_years(time_now, num_years):
+    """
+    Return time_now moved by num_years years. 29 February becomes 28 February in years without it.
     """
-    Retrieve all events between 5 years ago and 2 years from now
+    year = time_now.year + num_years
+    if time_now.month == 2 and time_now.day == 29 and not calendar.isleap(year):
+        return time_now.replace(year=year, day=28)
+    return time_now.replace(year=year)
+
+
+def default_window(time_now, viewed=None):
+    """
+    Window policy of 5 years ago up to 2 years from now.
+
+    @param time_now: The current time in UTC
+    @type time_now: datetime class object
+    @param viewed: The date the user is looking at, unused
+    @return: (start, end) datetime tuple
+    """
+    return _shift_years(time_now, -5), _shift_years(time_now, 2)
+
+
+def rolling_window(past_days, future_days):
+    """
+    Return a window policy covering past_days before up to future_days after the current time.
+
+    @param past_days: Days before now
+    @type past_days: Integer
+    @param future_days: Days after now
+    @type future_days: Integer
+    @return: window policy, a function (time_now, viewed=None) -> (start, end)
+    """
+    def window(time_now, viewed=None):
+        return time_now - datetime.timedelta(days=past_days), time_now + datetime.timedelta(days=future_days)
+    return window
+
+
+def centered_window(days):
+    """
+    Return a window policy of days days centered on the date the user is looking at (on now if none).
+
+    @param days: Width of the window in days
+    @type days: Integer
+    @return: window policy, a function (time_now, viewed=None) -> (start, end)
+    """
+    def window(time_now, viewed=None):
+        center = viewed if viewed is not None else time_now
+        half = datetime.timedelta(days=days) / 2
+        return center - half, center + half
+    return window
+
+
+def explicit_window(start, end):
+    """
+    Return a window policy always covering start up to end.
+
+    @param start: Start of the window in UTC
+    @type start: datetime class object
+    @param end: End of the window in UTC
+    @type end: datetime class object
+    @return: window policy, a function (time_now, viewed=None) -> (start, end)
+    """
+    def window(time_now, viewed=None):
+        return start, end
+    return window
+
+
+def parse_window_policy(text):
+    """
+    Return the window policy described by text: default, rolling:PAST_DAYS:FUTURE_DAYS, centered:DAYS or
+    explicit:YYYY-MM-DD:YYYY-MM-DD.
+
+    @param text: The description, e.g. from the CALENDAR_WINDOW environment variable
+    @type text: String
+    @return: window policy
+    @raise ValueError: if text does not describe a policy
+    """
+    kind, _, arguments = (text or "default").partition(":")
+    arguments = arguments.split(":") if arguments else []
+    if kind == "default" and not arguments:
+        return default_window
+    if kind == "rolling" and len(arguments) == 2:
+        return rolling_window(int(arguments[0]), int(arguments[1]))
+    if kind == "centered" and len(arguments) == 1:
+        return centered_window(int(arguments[0]))
+    if kind == "explicit" and len(arguments) == 2:
+        return explicit_window(datetime.datetime.strptime(arguments[0], "%Y-%m-%d"),
+                               datetime.datetime.strptime(arguments[1], "%Y-%m-%d"))
+    raise ValueError("Unknown window policy: " + text)
+
+
+def get_all_events(api, time_now: int, sharded=False, cache=None, window=None, viewed=None):
+    """
+    Retrieve all events between 5 years ago and 2 years from now, or in the window of the given policy
 
     @param api: Api for calendar (Google) used by the user
     @type api:  googleapiclient.discovery.build
     @param time_now: The current time in utc format
     @type time_now: datetime class object
+    @param sharded: Retrieve every event of the window through stream_events_sharded instead of the first 10
+    @type sharded: bool
+    @param cache: Cache to read the events through
+    @type cache: EventCache
+    @param window: Window policy, e.g. rolling_window(30, 90); None for 5 years ago up to 2 years from now
+    @type window: callable
+    @param viewed: The date the user is looking at, used by centered_window
+    @type viewed: datetime class object
     @return: void: Will print all events
     """
+    if sharded:
+        return list(stream_events_sharded(api, *(window or default_window)(time_now, viewed)))
+
     # starting_time is formatted as (YYYY-MM-DDT*HH:MM:SS), T* is separator between time and date
-    starting_time = sub_five_years(time_now)
-    end_time = add_two_years(time_now)
+    if window is None:
+        starting_time = sub_five_years(time_now)
+        end_time = add_two_years(time_now)
+    else:
+        starting_time, end_time = (to_rfc3339(bound) for bound in window(time_now, viewed))
     key_word = ""
 
-    events = get_upcoming_events(api, starting_time, 10, end_time, key_word)
+    events = get_upcoming_events(api, starting_time, 10, end_time, key_word, cache)
     return events
 
 
-def navigate_events(api, time_year: int, time_month: int, time_day: int):
+def navigate_events(api, time_year: int, time_month: int, time_day: int, cache=None, time_zone=None):
     """
     Navigate all events at a date-time selected by user.
 
@@ -137,21 +1104,85 @@ def navigate_events(api, time_year: int, time_month: int, time_day: int):
     @type time_month: integer
     @param time_day: a day entered by user
     @type time_day: integer
+    @param cache: Cache to read the events through
+    @type cache: EventCache
+    @param time_zone: The calendar's time zone the day is taken in, e.g. get_calendar_metadata(api)["time_zone"];
+                      UTC when None
+    @type time_zone: String
+    @raise ValueError: if the date does not exist
     """
-
-    # Convert it to a string type
-    str_year = str(time_year)
-    str_month = str(time_month)
-    str_day = str(time_day)
-
     num_result = 10
     key_word = ""
 
-    # Concatenate the strings to properly be fitted in the format
-    starting_time = str_year + "-" + str_month + "-" + str_day + "T00:00:00.0000" + 'Z'
-    time_Max = str_year + "-" + str_month + "-" + str_day + "T23:59:59.0000" + 'Z'
+    starting_time, time_Max = day_bounds(time_year, time_month, time_day, time_zone)
+
+    return get_upcoming_events(api, starting_time, num_result, time_Max, key_word, cache)
+
+
+class NavigationPrefetcher:
+    """
+    Warms an EventCache with the day the user is likely to navigate to next.
+
+    The next day is predicted from the last step the user took: moving from the 3rd to the 10th prefetches the
+    17th. Before a step is known, or after a jump of more than PREFETCH_MAX_STEP, both neighbouring days are
+    prefetched. Fetches run in the background, through navigate_events, so the user's next view is a cache hit.
+    """
+
+    PREFETCH_MAX_STEP = datetime.timedelta(days=31)
 
-    return get_upcoming_events(api, starting_time, num_result, time_Max, key_word)
+    def __init__(self, api, cache, max_workers=2, time_zone=None):
+        """
+        @param api: The build generated in get_calendar_api() function
+        @type api: googleapiclient.discovery.build
+        @param cache: The cache navigate_events reads through
+        @type cache: EventCache
+        @param max_workers: Number of days fetched at the same time
+        @type max_workers: Integer
+        @param time_zone: The time zone the user navigates in, as passed to navigate_events
+        @type time_zone: String
+        """
+        self.api = api
+        self.cache = cache
+        self.time_zone = time_zone
+        self._last = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Prefetches not finished yet
+        self._pending = set()
+
+    def observe(self, time_year: int, time_month: int, time_day: int):
+        """
+        Record that the user looked at a day and start prefetching the days predicted to come next.
+
+        @return: list of the predicted dates
+        """
+        viewed = datetime.date(time_year, time_month, time_day)
+        step = viewed - self._last if self._last is not None else None
+        self._last = viewed
+        if step and abs(step) <= self.PREFETCH_MAX_STEP:
+            predicted = [viewed + step]
+        else:
+            predicted = [viewed + datetime.timedelta(days=1), viewed - datetime.timedelta(days=1)]
+        for day in predicted:
+            future = self._executor.submit(self._prefetch, day)
+            self._pending.add(future)
+            future.add_done_callback(self._pending.discard)
+        return predicted
+
+    def _prefetch(self, day):
+        try:
+            navigate_events(self.api, day.year, day.month, day.day, self.cache, self.time_zone)
+        except Exception:
+            # A failed prefetch only means the next view is fetched on demand
+            pass
+
+    def close(self):
+        """
+        Stop prefetching, dropping the days not fetched yet.
+        @return: No return
+        """
+        for future in list(self._pending):
+            future.cancel()
+        self._executor.shutdown(wait=False)
 
 
 def delete_event(api, event_id):
@@ -164,6 +1195,7 @@ def delete_event(api, event_id):
     @return: No return
     """
     api.events().delete(calendarId='primary', eventId=event_id).execute()
+    journal_change(event_id, None)
 
 
 def edit_event(api, event_id, summary, editEvent: bool):
@@ -175,7 +1207,7 @@ def edit_event(api, event_id, summary, editEvent: bool):
         @param event_id: The id corresponding to the a specific event
         @type event_id: String
         @param editEvent: [True/False] - Whether the user would like to edit the edits or not
-        @return: No return
+        @return: The updated event
     """
     event = api.events().get(calendarId='primary', eventId=event_id).execute()
 
@@ -193,10 +1225,12 @@ def edit_event(api, event_id, summary, editEvent: bool):
             }
         )
 
-    api.events().update(calendarId='primary', eventId=event_id, body=event).execute()
+    updated = api.events().update(calendarId='primary', eventId=event_id, body=event).execute()
+    journal_change(event_id, updated)
+    return updated
 
 
-def search_all_events(api, time_now, key_word):
+def search_all_events(api, time_now, key_word, sharded=False, cache=None, window=None, viewed=None, filters=None):
     """
     Retrieve all events between 5 years ago and 2 years from now with specific key_word
 
@@ -206,17 +1240,273 @@ def search_all_events(api, time_now, key_word):
     @type time_now: datetime class object
     @param key_word: Events with this key word will be returned
     @type key_word: String
+    @param sharded: Retrieve every matching event through stream_events_sharded instead of the first 10
+    @type sharded: bool
+    @param cache: Cache to read the events through
+    @type cache: EventCache
+    @param window: Window policy, e.g. rolling_window(30, 90); None for 5 years ago up to 2 years from now
+    @type window: callable
+    @param viewed: The date the user is looking at, used by centered_window
+    @type viewed: datetime class object
+    @param filters: Further filters, e.g. {'attendee': ..., 'updated_min': ...}, see plan_event_query; every
+                    matching event is then returned through query_events
+    @type filters: dict
     @return: void: Will print all events
     """
+    if filters:
+        time_min, time_max = (window or default_window)(time_now, viewed)
+        return list(query_events(api, dict(filters, time_min=time_min, time_max=time_max, text=key_word)))
+    if sharded:
+        return list(stream_events_sharded(api, *(window or default_window)(time_now, viewed), key_word))
+
     # starting_time is formatted as (YYYY-MM-DDT*HH:MM:SS), T* is separator between time and date
-    starting_time = sub_five_years(time_now)
-    end_time = add_two_years(time_now)
+    if window is None:
+        starting_time = sub_five_years(time_now)
+        end_time = add_two_years(time_now)
+    else:
+        starting_time, end_time = (to_rfc3339(bound) for bound in window(time_now, viewed))
 
-    events = get_upcoming_events(api, starting_time, 10, end_time, key_word)
+    events = get_upcoming_events(api, starting_time, 10, end_time, key_word, cache)
 
     return events
 
 
+def validate_event_body(body):
+    """
+    Check an event body locally before it is sent to events().insert, so a bulk import does not spend requests
+    on bodies the server would reject.
+
+    @param body: The event to create
+    @type body: dict
+    @return: No return
+    @raise ValueError: if the body is not a valid event
+    """
+    if not isinstance(body, dict):
+        raise ValueError("An event must be a dict.")
+    bounds = []
+    for key in ('start', 'end'):
+        boundary = body.get(key)
+        if not isinstance(boundary, dict) or ('dateTime' in boundary) == ('date' in boundary):
+            raise ValueError(f"The event {key} must have either a dateTime or a date.")
+        bounds.append(parse_rfc3339(boundary.get('dateTime', boundary.get('date'))))
+    if ('date' in body['start']) != ('date' in body['end']):
+        raise ValueError("The event start and end must both be dates or both be dateTimes.")
+    if bounds[1] < bounds[0]:
+        raise ValueError("The event must not end before it starts.")
+    if 'summary' in body and not isinstance(body['summary'], str):
+        raise ValueError("The event summary must be a string.")
+    for override in (body.get('reminders') or {}).get('overrides') or []:
+        minutes = override.get('minutes')
+        if not isinstance(minutes, int) or not 0 <= minutes <= MAX_REMINDER_MINUTES:
+            raise ValueError(f"Reminder minutes must be between 0 and {MAX_REMINDER_MINUTES}.")
+
+
+def insert_event(api, body):
+    """
+    Create one event.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param body: The event to create
+    @type body: dict
+    @return: The id of the created event
+    @raise ValueError: if the body is not a valid event
+    """
+    validate_event_body(body)
+    created = api.events().insert(calendarId='primary', body=body).execute()
+    journal_change(created['id'], created)
+    return created['id']
+
+
+def insert_events(api, bodies, batch_size=BATCH_SIZE):
+    """
+    Create many events through batch HTTP requests, batch_size events per round trip. Every body is validated
+    before anything is sent. Events failing with 429 or 5xx are sent again in a later batch, up to BATCH_RETRIES
+    times.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param bodies: The events to create
+    @type bodies: list
+    @param batch_size: Number of events per batch request
+    @type batch_size: Integer
+    @return: (ids, errors): ids of the created events in the order of bodies, None where creating failed, and
+             a dict position in bodies -> the error of that event
+    @raise ValueError: if a body is not a valid event, nothing is created then
+    """
+    for position, body in enumerate(bodies):
+        try:
+            validate_event_body(body)
+        except ValueError as error:
+            raise ValueError(f"Event {position}: {error}") from error
+
+    ids = [None] * len(bodies)
+
+    def created(position, response):
+        ids[position] = response['id']
+        journal_change(response['id'], response)
+
+    errors = _run_batches(api, lambda position: api.events().insert(calendarId='primary', body=bodies[position]),
+                          len(bodies), created, batch_size, "events.insert batch")
+    return ids, errors
+
+
+def delete_events(api, event_ids, batch_size=BATCH_SIZE):
+    """
+    Delete many events through batch HTTP requests, batch_size events per round trip. Events already gone
+    (404/410) count as deleted. Events failing with 429 or 5xx are sent again in a later batch, up to
+    BATCH_RETRIES times.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param event_ids: The ids of the events to delete
+    @type event_ids: list
+    @param batch_size: Number of events per batch request
+    @type batch_size: Integer
+    @return: dict event id -> the error of the events that could not be deleted
+    """
+    def deleted(position, response):
+        journal_change(event_ids[position], None)
+
+    errors = _run_batches(api, lambda position: api.events().delete(calendarId='primary', eventId=event_ids[position]),
+                          len(event_ids), deleted, batch_size, "events.delete batch", done_statuses=(404, 410))
+    return {event_ids[position]: error for position, error in errors.items()}
+
+
+def _run_batches(api, build_request, count, on_success, batch_size, span_name, done_statuses=()):
+    """
+    Send count requests, build_request(position) for every position, batch_size per batch HTTP request. Requests
+    failing with 429 or 5xx are built and sent again in a later batch, up to BATCH_RETRIES times.
+
+    @return: dict position -> the error of the requests that failed
+    """
+    errors = {}
+    remaining = list(range(count))
+    for attempt in range(BATCH_RETRIES + 1):
+        retry = []
+
+        def callback(request_id, response, exception):
+            position = int(request_id)
+            status = None if exception is None else _error_status(exception)
+            if exception is None or status in done_statuses:
+                errors.pop(position, None)
+                on_success(position, response)
+                return
+            errors[position] = exception
+            if status is not None and (status == 429 or status >= 500):
+                retry.append(position)
+
+        for first in range(0, len(remaining), batch_size):
+            batch = api.new_batch_http_request(callback=callback)
+            for position in remaining[first:first + batch_size]:
+                batch.add(build_request(position), request_id=str(position))
+            with trace_span(span_name):
+                batch.execute()
+        if not retry or attempt == BATCH_RETRIES:
+            break
+        remaining = sorted(retry)
+        time.sleep(0.5 * 2 ** attempt)
+    return errors
+
+
+def plan_event_query(query):
+    """
+    Split a structured query into the parameters the events endpoint filters on and the predicates that have
+    to be applied locally to what it returns.
+
+    The query is a dict with any of the keys:
+    time_min, time_max (datetime, required), text, attendee, organizer, status, updated_min (datetime),
+    show_deleted (bool), time_zone, private_properties and shared_properties (dict of extended properties).
+
+    text, the window, updated_min, show_deleted, time_zone and the extended properties are pushed to the server.
+    attendee and organizer are pushed as extra free text terms, which the server matches against attendee and
+    organizer emails, and checked exactly locally. status is checked locally; asking for cancelled events also
+    pushes showDeleted, as the server leaves them out otherwise.
+
+    @param query: The query
+    @type query: dict
+    @return: (params, predicates, explanation): events().list parameters, list of (description, function)
+             local predicates, and a dict describing both
+    @raise ValueError: for an unknown filter or a missing time_min/time_max
+    """
+    known = {'time_min', 'time_max', 'text', 'attendee', 'organizer', 'status', 'updated_min', 'show_deleted',
+             'time_zone', 'private_properties', 'shared_properties'}
+    unknown = set(query) - known
+    if unknown:
+        raise ValueError("Unknown query filters: " + ", ".join(sorted(unknown)))
+    if query.get('time_min') is None or query.get('time_max') is None:
+        raise ValueError("A query needs time_min and time_max.")
+
+    params = {'timeMin': to_rfc3339(query['time_min']), 'timeMax': to_rfc3339(query['time_max'])}
+    terms = [query[key] for key in ('text', 'attendee', 'organizer') if query.get(key)]
+    if terms:
+        params['q'] = " ".join(terms)
+    if query.get('updated_min') is not None:
+        params['updatedMin'] = to_rfc3339(query['updated_min'])
+    if query.get('show_deleted') or query.get('status') == 'cancelled':
+        params['showDeleted'] = True
+    if query.get('time_zone'):
+        params['timeZone'] = query['time_zone']
+    for key, param in (('private_properties', 'privateExtendedProperty'),
+                       ('shared_properties', 'sharedExtendedProperty')):
+        if query.get(key):
+            params[param] = [f"{name}={value}" for name, value in sorted(query[key].items())]
+
+    predicates = []
+    if query.get('attendee'):
+        attendee = query['attendee'].lower()
+        predicates.append((f"attendee == {query['attendee']}",
+                           lambda event: any((person.get('email') or '').lower() == attendee
+                                             for person in event.get('attendees', []))))
+    if query.get('organizer'):
+        organizer = query['organizer'].lower()
+        predicates.append((f"organizer == {query['organizer']}",
+                           lambda event: ((event.get('organizer') or {}).get('email') or '').lower() == organizer))
+    if query.get('status'):
+        status = query['status']
+        predicates.append((f"status == {status}", lambda event: event.get('status', 'confirmed') == status))
+
+    explanation = {'pushed': dict(params), 'local': [description for description, predicate in predicates]}
+    return params, predicates, explanation
+
+
+def explain_query(query):
+    """
+    Return which filters of a query are evaluated by the server and which locally, see plan_event_query.
+
+    @param query: The query
+    @type query: dict
+    @return: dict with 'pushed' (the events().list parameters) and 'local' (descriptions of local predicates)
+    """
+    return plan_event_query(query)[2]
+
+
+def query_events(api, query, page_size=PAGE_SIZE):
+    """
+    Yield the events matching a structured query, letting the server filter as much as it can.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param query: The query, see plan_event_query
+    @type query: dict
+    @param page_size: Number of events requested per page
+    @type page_size: Integer
+    @return: generator of events ordered by start time
+    """
+    params, predicates, explanation = plan_event_query(query)
+    time_min, time_max = params.pop('timeMin'), params.pop('timeMax')
+    key_word = params.pop('q', "")
+    page_token = None
+    while True:
+        result = fetch_event_page(api, time_min, time_max, key_word, page_size, page_token, **params)
+        for event in result.get("items", []):
+            if all(predicate(event) for description, predicate in predicates):
+                yield event
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return
+
+
 def cancel_event(api, event_id):
     """
     updates a given event by its corresponding event id
@@ -224,93 +1514,875 @@ def cancel_event(api, event_id):
     @type api: googleapiclient.discovery.build
     @param event_id: The id corresponding to the a specific event
     @type event_id: String
-    @return: No return
+    @return: The cancelled event
     """
     event = api.events().get(calendarId='primary', eventId=event_id).execute()
 
     event['status'] = 'cancelled'
 
-    api.events().update(calendarId='primary', eventId=event_id, body=event).execute()
+    updated = api.events().update(calendarId='primary', eventId=event_id, body=event).execute()
+    journal_change(event_id, updated)
+    return updated
+
+
+def patch_event(api, event_id, fields):
+    """
+    Change some fields of an event without fetching it first, e.g. the fields of build_edit_fields.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param event_id: The id corresponding to the a specific event
+    @type event_id: String
+    @param fields: The fields to change
+    @type fields: dict
+    @return: The updated event
+    """
+    updated = api.events().patch(calendarId='primary', eventId=event_id, body=fields).execute()
+    journal_change(event_id, updated)
+    return updated
+
+
+def build_edit_fields(summary, reminder_minutes=None):
+    """
+    Return the fields edit_event changes, for queueing the same edit with MutationQueue.patch.
+
+    @param summary: The new summary of the event
+    @type summary: String
+    @param reminder_minutes: New popup reminder in minutes, None to keep the current reminders
+    @type reminder_minutes: Integer
+    @return: dict of event fields
+    """
+    fields = {'summary': summary}
+    if reminder_minutes is not None:
+        fields['reminders'] = {
+            "useDefault": False,
+            "overrides": [
+                {
+                    "method": "popup",
+                    "minutes": reminder_minutes
+                }
+            ]
+        }
+    return fields
+
+
+def _error_status(error):
+    """
+    Return the HTTP status of an API error, or None when the request did not get a response (e.g. offline).
+    """
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+
+def _is_offline(error):
+    """
+    Return whether an error without an HTTP status means the server could not be reached: socket and TLS errors,
+    timeouts, httplib2's ServerNotFoundError and failed token refreshes.
+    """
+    if isinstance(error, OSError):
+        return True
+    return type(error).__module__.startswith('httplib2') or type(error).__name__ == 'TransportError'
+
+
+class MutationQueue:
+    """
+    Durable write-ahead queue of event mutations.
+
+    Mutations are stored in SQLite straight away and can be applied to the local list of events with
+    apply_local, so the menu does not wait for the server. flush (or the background worker started with start)
+    sends them to the API. Mutations of the same event are coalesced: repeated edits are merged into one patch
+    and a delete replaces any pending patch. A patch rejected because the event changed on the server
+    (412, stale ETag) is resolved in favour of the local change by resending it without the ETag.
+    """
+
+    def __init__(self, api, path=MUTATION_QUEUE_FILE, flush_interval=QUEUE_FLUSH_INTERVAL, on_sent=None):
+        """
+        @param api: The build generated in get_calendar_api() function
+        @type api: googleapiclient.discovery.build
+        @param path: SQLite file of the queue, ':memory:' for a queue that does not survive the process
+        @type path: String
+        @param flush_interval: Seconds between two flushes of the background worker
+        @type flush_interval: Integer
+        @param on_sent: Called without arguments after a flush sent mutations, e.g. EventCache.clear
+        @type on_sent: callable
+        """
+        self.api = api
+        self.flush_interval = flush_interval
+        self.on_sent = on_sent
+        # (event_id, operation, reason) of mutations the server refused, reason being the HTTP status or the
+        # error of a mutation that failed MAX_SEND_ATTEMPTS times without one
+        self.failed = []
+        self._attempts = {}
+        self._lock = threading.RLock()
+        # Serialises flushes, so the worker and close never send the same mutation twice
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("CREATE TABLE IF NOT EXISTS mutations ("
+                         "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "event_id TEXT NOT NULL UNIQUE, "
+                         "operation TEXT NOT NULL, "
+                         "body TEXT NOT NULL, "
+                         "etag TEXT)")
+
+    def patch(self, event_id, fields, etag=None):
+        """
+        Queue a change of some fields of an event, merged into any patch already pending for it.
+
+        @param event_id: The id corresponding to the a specific event
+        @type event_id: String
+        @param fields: The event fields to change
+        @type fields: dict
+        @param etag: ETag of the event the change is based on
+        @type etag: String
+        @return: dict of all fields pending for the event
+        """
+        with self._lock:
+            row = self._db.execute("SELECT operation, body, etag FROM mutations WHERE event_id = ?",
+                                   (event_id,)).fetchone()
+            if row is None:
+                self._db.execute("INSERT INTO mutations (event_id, operation, body, etag) VALUES (?, 'patch', ?, ?)",
+                                 (event_id, json.dumps(fields), etag))
+                return dict(fields)
+            if row[0] == 'delete':
+                return {}
+            merged = json.loads(row[1])
+            merged.update(fields)
+            self._db.execute("UPDATE mutations SET body = ? WHERE event_id = ?", (json.dumps(merged), event_id))
+            return merged
+
+    def delete(self, event_id, etag=None):
+        """
+        Queue the deletion of an event, replacing any change pending for it.
+
+        @param event_id: The id corresponding to the a specific event
+        @type event_id: String
+        @param etag: ETag of the event the deletion is based on
+        @type etag: String
+        @return: No return
+        """
+        with self._lock:
+            self._db.execute("INSERT INTO mutations (event_id, operation, body, etag) VALUES (?, 'delete', '{}', ?) "
+                             "ON CONFLICT(event_id) DO UPDATE SET operation = 'delete', body = '{}', "
+                             "etag = excluded.etag", (event_id, etag))
+
+    def cancel(self, event_id, etag=None):
+        """
+        Queue the cancellation of an event, see cancel_event.
+        """
+        return self.patch(event_id, {'status': 'cancelled'}, etag)
+
+    def pending(self):
+        """
+        Return the mutations not yet sent, oldest first.
+
+        @return: list of (event_id, operation, fields, etag) tuples
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT event_id, operation, body, etag FROM mutations ORDER BY seq").fetchall()
+        return [(event_id, operation, json.loads(body), etag) for event_id, operation, body, etag in rows]
+
+    def apply_local(self, events):
+        """
+        Return events as they will be once the pending mutations reach the server.
+
+        @param events: an array of events
+        @type events: array
+        @return: a new array, changed events are copies
+        """
+        changes = {event_id: (operation, fields) for event_id, operation, fields, etag in self.pending()}
+        if not changes:
+            return list(events)
+        result = []
+        for event in events:
+            operation, fields = changes.get(event['id'], (None, None))
+            if operation == 'delete':
+                continue
+            if operation == 'patch':
+                event = dict(event, **fields)
+            result.append(event)
+        return result
+
+    @traced("queue.flush")
+    def flush(self):
+        """
+        Send the pending mutations to the API in the order they were made. Stops at the first mutation that
+        could not reach the server, it is retried on the next flush. A mutation failing for another reason than
+        an HTTP status is retried on MAX_SEND_ATTEMPTS flushes, then moved to failed.
+
+        The queue is only locked while reading and removing rows, never during a request, so the menu can
+        queue mutations while a flush waits for the server.
+
+        @return: Number of mutations sent
+        """
+        sent = 0
+        with self._flush_lock:
+            with self._lock:
+                rows = self._db.execute("SELECT event_id, operation, body, etag FROM mutations "
+                                        "ORDER BY seq").fetchall()
+            for event_id, operation, body, etag in rows:
+                try:
+                    result = self._send(event_id, operation, json.loads(body), etag)
+                    journal_change(event_id, None if operation == 'delete' else result)
+                except Exception as error:
+                    status = _error_status(error)
+                    if status is None:
+                        if _is_offline(error):
+                            break
+                        attempts = self._attempts.get(event_id, 0) + 1
+                        self._attempts[event_id] = attempts
+                        if attempts < MAX_SEND_ATTEMPTS:
+                            break
+                        self.failed.append((event_id, operation, repr(error)))
+                    elif status == 429 or status >= 500:
+                        break
+                    elif not (operation == 'delete' and status in (404, 410)):
+                        self.failed.append((event_id, operation, status))
+                self._attempts.pop(event_id, None)
+                with self._lock:
+                    # A mutation queued for the event meanwhile changed the row; it is sent on the next flush
+                    self._db.execute("DELETE FROM mutations WHERE event_id = ? AND operation = ? AND body = ?",
+                                     (event_id, operation, body))
+                sent += 1
+        if sent and self.on_sent is not None:
+            self.on_sent()
+        return sent
+
+    def take_failed(self):
+        """
+        Return the mutations the server refused since the last call, and forget them.
+
+        @return: list of (event_id, operation, reason) tuples, see failed
+        """
+        with self._lock:
+            failed, self.failed = self.failed, []
+        return failed
+
+    def _send(self, event_id, operation, fields, etag):
+        """
+        Send one mutation, resending a patch without its ETag when the event changed on the server meanwhile.
+        """
+        if operation == 'delete':
+            request = self.api.events().delete(calendarId='primary', eventId=event_id)
+        else:
+            request = self.api.events().patch(calendarId='primary', eventId=event_id, body=fields)
+        if etag:
+            request.headers['If-Match'] = etag
+        try:
+            return execute_request(request)
+        except Exception as error:
+            if _error_status(error) != 412 or operation == 'delete':
+                raise
+        # The local change wins over the concurrent one
+        return execute_request(self.api.events().patch(calendarId='primary', eventId=event_id, body=fields))
+
+    def start(self):
+        """
+        Start the background worker flushing the queue every flush_interval seconds.
+        @return: No return
+        """
+        if self._worker is None:
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="mutation-queue", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """
+        Stop the background worker, make a last attempt to flush, and close the queue.
+        @return: Number of mutations still pending, they are sent once a queue is opened on the same file again
+        """
+        if self._worker is not None:
+            self._stop.set()
+            self._worker.join()
+            self._worker = None
+        self.flush()
+        remaining = len(self.pending())
+        self._db.close()
+        return remaining
+
+
+class ChangeJournal:
+    """
+    Append-only journal of event changes, answering what the calendar looked like at any earlier time.
+
+    Every change is a JSON line {"ts": epoch seconds, "id": event id, "event": the event, null once deleted}.
+    Every checkpoint_interval records the whole calendar is written to a checkpoint file next to the journal,
+    named after the journal offset it covers. A point in time view loads the last checkpoint before it and
+    replays the records written since, so it costs O(changes since the checkpoint).
+    """
+
+    _CHECKPOINT_NAME = re.compile(r"\.(\d+)-(\d+\.\d+)\.checkpoint$")
+
+    def __init__(self, path, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """
+        @param path: The journal file, created when missing
+        @type path: String
+        @param checkpoint_interval: Number of records between two checkpoints
+        @type checkpoint_interval: Integer
+        """
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self._lock = threading.Lock()
+        # (ts, offset, checkpoint file) ordered by offset
+        self._checkpoints = self._find_checkpoints()
+        # The calendar as of the end of the journal, event id -> event
+        self._state, self._last_ts, end, self._since_checkpoint = self._replay(None)
+        self._file = open(path, 'ab')
+        # Drop a record left half written by a crash
+        self._file.truncate(end)
+
+    def _find_checkpoints(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path)
+        checkpoints = []
+        for name in os.listdir(directory):
+            match = self._CHECKPOINT_NAME.search(name)
+            if name.startswith(prefix) and match and len(prefix) == match.start():
+                checkpoints.append((float(match.group(2)), int(match.group(1)), os.path.join(directory, name)))
+        return sorted(checkpoints, key=lambda checkpoint: checkpoint[1])
+
+    def _replay(self, until):
+        """
+        Return (state, ts of the last record applied, offset after it, records applied after the checkpoint) of
+        the journal up to the records at time until, the whole journal when until is None.
+        """
+        state, last_ts, offset = {}, 0.0, 0
+        for ts, checkpoint_offset, checkpoint_path in reversed(self._checkpoints):
+            if until is None or ts <= until:
+                with open(checkpoint_path) as checkpoint:
+                    state = json.load(checkpoint)
+                last_ts, offset = ts, checkpoint_offset
+                break
+        applied = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal:
+                journal.seek(offset)
+                for line in journal:
+                    if not line.endswith(b"\n"):
+                        break
+                    record = json.loads(line)
+                    if until is not None and record["ts"] > until:
+                        break
+                    if record["event"] is None:
+                        state.pop(record["id"], None)
+                    else:
+                        state[record["id"]] = record["event"]
+                    last_ts = record["ts"]
+                    offset += len(line)
+                    applied += 1
+        return state, last_ts, offset, applied
+
+    def record(self, event_id, event, ts=None):
+        """
+        Append a change to the journal.
+
+        @param event_id: The id of the changed event
+        @type event_id: String
+        @param event: The event after the change, None when it was deleted
+        @type event: dict
+        @param ts: Time of the change in epoch seconds, now when None
+        @type ts: float
+        @return: No return
+        """
+        with self._lock:
+            # Records stay in time order even if the clock goes back
+            ts = max(time.time() if ts is None else ts, self._last_ts)
+            line = json.dumps({"ts": ts, "id": event_id, "event": event}, separators=(",", ":")) + "\n"
+            self._file.write(line.encode("utf-8"))
+            self._file.flush()
+            if event is None:
+                self._state.pop(event_id, None)
+            else:
+                self._state[event_id] = event
+            self._last_ts = ts
+            self._since_checkpoint += 1
+            if self._since_checkpoint >= self.checkpoint_interval:
+                self._checkpoint()
+
+    def observe(self, events, ts=None):
+        """
+        Record the events seen through a listing that differ from what the journal last saw of them.
+
+        @param events: an array of events
+        @type events: array
+        @param ts: Time they were seen in epoch seconds, now when None
+        @type ts: float
+        @return: Number of changes recorded
+        """
+        changed = [event for event in events if event.get('id') and self._state.get(event['id']) != event]
+        for event in changed:
+            self.record(event['id'], event, ts)
+        return len(changed)
+
+    def _checkpoint(self):
+        offset = self._file.tell()
+        path = f"{self.path}.{offset}-{self._last_ts:.6f}.checkpoint"
+        with atomic_write(path, ".checkpoint-") as checkpoint:
+            json.dump(self._state, checkpoint, separators=(",", ":"))
+        self._checkpoints.append((self._last_ts, offset, path))
+        self._since_checkpoint = 0
+
+    def view_at(self, when=None):
+        """
+        Return the calendar as it was at a point in time.
+
+        @param when: The time, naive values are UTC; the latest state when None
+        @type when: datetime class object
+        @return: list of the events not deleted or cancelled at that time, ordered by start time
+        """
+        with self._lock:
+            if when is None:
+                state = dict(self._state)
+            else:
+                if when.tzinfo is None:
+                    when = when.replace(tzinfo=datetime.timezone.utc)
+                state = self._replay(when.timestamp())[0]
+        events = [event for event in state.values() if event.get('status') != 'cancelled']
+        return sorted(events, key=event_start)
+
+    def close(self):
+        """
+        Close the journal file.
+        @return: No return
+        """
+        with self._lock:
+            self._file.close()
+
+
+def start_journal(path, checkpoint_interval=CHECKPOINT_INTERVAL):
+    """
+    Start journaling every event change seen through listings and made through the mutation functions.
+
+    @param path: The journal file
+    @type path: String
+    @return: The ChangeJournal
+    """
+    global _journal
+    _journal = ChangeJournal(path, checkpoint_interval)
+    return _journal
+
+
+def stop_journal():
+    """
+    Stop journaling and close the journal.
+    @return: The ChangeJournal that was recording, None if journaling was off
+    """
+    global _journal
+    journal, _journal = _journal, None
+    if journal is not None:
+        journal.close()
+    return journal
+
+
+def journal_change(event_id, event):
+    """
+    Record a change made by this session when journaling is on.
+
+    @param event_id: The id of the changed event
+    @type event_id: String
+    @param event: The event after the change, None when it was deleted
+    @type event: dict
+    """
+    if _journal is not None:
+        _journal.record(event_id, event)
+
+
+def journal_events(events):
+    """
+    Record the changes seen in a listing when journaling is on.
+
+    @param events: an array of events
+    @type events: array
+    """
+    if _journal is not None:
+        _journal.observe(events)
 
 
-def print_events(events):
+class EventHandles:
+    """
+    Session table of short handles for events.
+
+    An event keeps its handle for the whole session, however often it is fetched again or wherever it appears in
+    a list, so the menu can act on it without refetching the list it was picked from. Lookups are O(1).
+    """
+
+    def __init__(self):
+        # handle -> last seen event resource (holding its id and ETag)
+        self._events = {}
+        # event id -> handle
+        self._handles = {}
+        self._next_handle = 1
+
+    def register(self, events):
+        """
+        Give every event a handle, keeping the handles of events seen before, and remember the latest copy.
+
+        @param events: an array of events
+        @type events: array
+        @return: list of the handles of events, in the same order
+        """
+        handles = []
+        for event in events:
+            handle = self._handles.get(event['id'])
+            if handle is None:
+                handle = self._next_handle
+                self._next_handle += 1
+                self._handles[event['id']] = handle
+            self._events[handle] = event
+            handles.append(handle)
+        return handles
+
+    def handle_of(self, event_id):
+        """
+        Return the handle of an event, or None if it was never registered.
+        """
+        return self._handles.get(event_id)
+
+    def lookup(self, handle):
+        """
+        Return (event id, ETag) of a handle, or None for an unknown handle.
+
+        @param handle: A handle shown by print_events
+        @type handle: Integer
+        @return: tuple or None
+        """
+        event = self._events.get(handle)
+        if event is None:
+            return None
+        return event['id'], event.get('etag')
+
+    def event(self, handle):
+        """
+        Return the last seen copy of the event of a handle, or None for an unknown handle.
+        """
+        return self._events.get(handle)
+
+    def forget(self, event_id):
+        """
+        Drop the handle of an event, e.g. once it is deleted.
+        @return: No return
+        """
+        handle = self._handles.pop(event_id, None)
+        self._events.pop(handle, None)
+
+
+def _event_row(event, default_reminder=DEFAULT_REMINDER, show_missing=False):
+    """
+    Return the text print_events shows after the number of an event. Events without reminder get a
+    "No reminder" row when show_missing is set, and no row (None) otherwise.
+    """
+    minutes = get_reminder_minutes(event, default_reminder)
+    if minutes is None:
+        return f"{event_time_value(event, 'start')} {event['summary']} | No reminder" if show_missing else None
+    return f"{event_time_value(event, 'start')} {event['summary']} | Reminder:  {minutes} minutes before"
+
+
+def _event_rows(events, default_reminder=DEFAULT_REMINDER):
+    """
+    Return the text print_events shows after the number of each event, leaving out events without reminder.
+    Runs in worker processes, so it only depends on its arguments.
+    """
+    rows = (_event_row(event, default_reminder) for event in events)
+    return [row for row in rows if row is not None]
+
+
+def _map_chunks(function, events, processes, chunk_size):
+    """
+    Yield function(chunk) for consecutive chunks of events, computed by a pool of processes, in order.
+    """
+    chunks = [events[first:first + chunk_size] for first in range(0, len(events), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        yield from executor.map(function, chunks)
+
+
+@traced("render.print_events")
+def print_events(events, default_reminder=DEFAULT_REMINDER, handles=None, processes=None,
+                 chunk_size=PARALLEL_CHUNK_SIZE):
     """
     prints an array that holds a series of events
     @param events: an array of events
     @type events: array
+    @param default_reminder: minutes shown for events using the calendar's default reminders
+    @type default_reminder: Integer
+    @param handles: When given, events are registered and numbered by their handle instead of their position,
+                    and events without reminder are listed as "No reminder" instead of being left out
+    @type handles: EventHandles
+    @param processes: When given, lists longer than chunk_size are formatted by this many processes
+    @type processes: Integer
+    @param chunk_size: Number of events formatted per process task
+    @type chunk_size: Integer
     @return: No return
     """
     if not events:
         print('No upcoming events found.')
+    if processes and handles is None and len(events) > chunk_size:
+        num = 1
+        for rows in _map_chunks(functools.partial(_event_rows, default_reminder=default_reminder), events,
+                                processes, chunk_size):
+            for row in rows:
+                print("Events: ", num, row)
+                num += 1
+        return
     num = 1
     for event in events:
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        reminder = event['reminders']
-        if event['reminders']["useDefault"]:
-            reminder = str(DEFAULT_REMINDER) + " minutes before"
-        elif not event['reminders']['useDefault']:
-            try:
-                reminder = str(event['reminders']['overrides'][0]['minutes']) + " minutes before"
-            except:
-                continue
-        print("Events: ", num, start, event['summary'], "| Reminder: ", reminder)
+        # Every event shown with a handle can be selected, so those without reminder are listed too
+        row = _event_row(event, default_reminder, show_missing=handles is not None)
+        if row is None:
+            continue
+        label = num if handles is None else handles.register([event])[0]
+        print("Events: ", label, row)
         # print(event["id"])
         num += 1
 
 
-def print_events_detail(events):
+def apply_event_change(events, event_id, changed=None):
     """
-    prints a detail of each event
+    Update a list of events in place after a mutation: the event is replaced by its changed copy, or removed
+    when changed is None.
+
     @param events: an array of events
     @type events: array
-    @return: string
+    @param event_id: The id of the event that changed
+    @type event_id: String
+    @param changed: The changed event as returned by edit_event/cancel_event, None if it was deleted
+    @type changed: dict
+    @return: The position the event had in events, or None if it was not listed
     """
-    if not events:
-        print('No upcoming events found.')
-    num = 1
-    output = ""
+    for position, event in enumerate(events):
+        if event['id'] == event_id:
+            if changed is None:
+                del events[position]
+            else:
+                events[position] = changed
+            return position
+    return None
+
+
+def print_event_delta(event_id, changed=None, default_reminder=DEFAULT_REMINDER, handles=None):
+    """
+    Print only what a mutation changed instead of the whole list: the new row of a changed event on one line,
+    "No reminder" included, or a line saying a deleted event was removed.
+
+    @param event_id: The id of the event that changed
+    @type event_id: String
+    @param changed: The changed event, None if it was deleted
+    @type changed: dict
+    @param default_reminder: minutes shown for events using the calendar's default reminders
+    @type default_reminder: Integer
+    @param handles: When given, the event is labelled by its handle
+    @type handles: EventHandles
+    @return: No return
+    """
+    if changed is None:
+        label = handles.handle_of(event_id) if handles is not None else event_id
+        print("Removed: ", label)
+    else:
+        label = handles.register([changed])[0] if handles is not None else event_id
+        print("Updated: ", label, _event_row(changed, default_reminder, show_missing=True))
+
+
+def local_directory_lookup(emails):
+    """
+    Stand-in for a directory service: derives a display name from each address, e.g. jane.doe@example.com
+    becomes Jane Doe.
+
+    @param emails: the addresses to resolve
+    @type emails: list
+    @return: dict email -> {"displayName": name}
+    """
+    people = {}
+    for email in emails:
+        parts = re.split(r"[._+-]+", email.split("@")[0])
+        people[email] = {"displayName": " ".join(part.capitalize() for part in parts if part)}
+    return people
+
+
+def collect_emails(events):
+    """
+    Return the distinct creator, organizer and attendee addresses of events, in the order first seen.
+
+    @param events: an array of events
+    @type events: array
+    @return: list of email addresses
+    """
+    emails = {}
     for event in events:
-        try:
-            output += f"This event is created on: {event['created']} \n"
-        except KeyError:
-            output += "There is no creation date \n"
+        people = [event.get('creator', {}), event.get('organizer', {})] + event.get('attendees', [])
+        for person in people:
+            if person.get('email'):
+                emails[person['email']] = None
+    return list(emails)
 
-        try:
-            output += "A list of organisers email address: \n"
-            output += f"{event['creator']['email']} \n"
-        except KeyError:
-            output += "There is no creators' email address \n"
 
-        try:
-            output += "A list of organisers email address: \n"
-            output += f"{event['organizer'].get('email')} \n"
-        except KeyError:
-            output += "There is no organisers' email address \n"
+def resolve_people(emails, lookup=local_directory_lookup, batch_size=DIRECTORY_BATCH_SIZE,
+                   max_workers=DIRECTORY_WORKERS):
+    """
+    Resolve addresses through a directory lookup. Only addresses not resolved earlier in the session are looked
+    up, in batches of batch_size run in parallel.
+
+    @param emails: the addresses to resolve
+    @type emails: list
+    @param lookup: Function resolving a list of addresses into a dict email -> person
+    @type lookup: callable
+    @param batch_size: Number of addresses per lookup call
+    @type batch_size: Integer
+    @param max_workers: Number of lookup calls made at the same time
+    @type max_workers: Integer
+    @return: dict email -> person for the addresses the directory knows
+    """
+    with _directory_lock:
+        missing = [email for email in dict.fromkeys(emails) if email not in _directory_cache]
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    if batches:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch, people in zip(batches, executor.map(lookup, batches)):
+                with _directory_lock:
+                    for email in batch:
+                        # Unknown addresses are remembered too, so they are not looked up again
+                        _directory_cache[email] = people.get(email)
+    with _directory_lock:
+        return {email: _directory_cache[email] for email in emails if _directory_cache.get(email) is not None}
+
+
+def clear_directory_cache():
+    """
+    Forget every resolved person so the next lookup goes to the directory.
+    @return: No return
+    """
+    with _directory_lock:
+        _directory_cache.clear()
 
-        try:
-            output += "A list of attendees email address: \n"
-            for i in range(len(event['attendees'])):
-                output += f"{i}: "
-                output += f"{event['attendees'][i].get('email')} \n"
-        except KeyError:
-            output += "There is no attendees' email address \n"
 
-        try:
-            output += f"Description: {event['description']} \n"
-        except KeyError:
-            output += "There is no description \n"
+@traced("enrich_events")
+def enrich_events(events, lookup=local_directory_lookup):
+    """
+    Resolve every person appearing in events, looking each address up once for the whole set of events.
 
-        try:
-            output += f"Location: {event['location']} \n"
-        except KeyError:
-            output += "There is no location \n"
+    @param events: an array of events
+    @type events: array
+    @param lookup: Function resolving a list of addresses into a dict email -> person
+    @type lookup: callable
+    @return: dict email -> person, to be passed to print_events_detail
+    """
+    return resolve_people(collect_emails(events), lookup)
 
-        num += 1
 
-    return print(output)
+def _describe_person(email, entry, people):
+    """
+    Return an address followed by the person's name and response status when they are known.
+    """
+    text = f"{email}"
+    if people is None:
+        return text
+    name = entry.get('displayName') or (people.get(email) or {}).get('displayName')
+    if name:
+        text += f" ({name})"
+    if entry.get('responseStatus'):
+        text += f" - {entry['responseStatus']}"
+    return text
+
+
+def format_event_detail(event, people=None):
+    """
+    Return the details of one event as printed by print_events_detail.
+
+    @param event: an event as returned by the API
+    @type event: dict
+    @param people: Resolved people from enrich_events, used to show names and response status
+    @type people: dict
+    @return: string
+    """
+    output = ""
+    try:
+        output += f"This event is created on: {event['created']} \n"
+    except KeyError:
+        output += "There is no creation date \n"
+
+    try:
+        output += "A list of organisers email address: \n"
+        output += f"{_describe_person(event['creator']['email'], event['creator'], people)} \n"
+    except KeyError:
+        output += "There is no creators' email address \n"
+
+    try:
+        output += "A list of organisers email address: \n"
+        output += f"{_describe_person(event['organizer'].get('email'), event['organizer'], people)} \n"
+    except KeyError:
+        output += "There is no organisers' email address \n"
+
+    try:
+        output += "A list of attendees email address: \n"
+        for i in range(len(event['attendees'])):
+            output += f"{i}: "
+            attendee = event['attendees'][i]
+            output += f"{_describe_person(attendee.get('email'), attendee, people)} \n"
+    except KeyError:
+        output += "There is no attendees' email address \n"
+
+    try:
+        output += f"Description: {event['description']} \n"
+    except KeyError:
+        output += "There is no description \n"
+
+    try:
+        output += f"Location: {event['location']} \n"
+    except KeyError:
+        output += "There is no location \n"
+
+    return output
+
+
+def _event_details(events, people=None):
+    """
+    Return the details of a chunk of events. Runs in worker processes.
+    """
+    return "".join(format_event_detail(event, people) for event in events)
+
+
+@traced("render.print_events_detail")
+def print_events_detail(events, people=None, processes=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    prints a detail of each event
+    @param events: an array of events
+    @type events: array
+    @param people: Resolved people from enrich_events, used to show names and response status
+    @type people: dict
+    @param processes: When given, lists longer than chunk_size are formatted by this many processes and written
+                      chunk by chunk, in order, as they are ready
+    @type processes: Integer
+    @param chunk_size: Number of events formatted per process task
+    @type chunk_size: Integer
+    @return: string
+    """
+    if not events:
+        print('No upcoming events found.')
+    if processes and len(events) > chunk_size:
+        for output in _map_chunks(functools.partial(_event_details, people=people), events, processes, chunk_size):
+            sys.stdout.write(output)
+        return print()
+
+    return print(_event_details(events, people))
 
 
 # Main Menu Function
+def print_failed_mutations(failed):
+    """
+    Tell the user about the changes the server refused.
+
+    @param failed: (event_id, operation, reason) tuples, see MutationQueue.failed
+    @type failed: list
+    @return: No return
+    """
+    for event_id, operation, reason in failed:
+        if isinstance(reason, int):
+            reason = "HTTP " + str(reason)
+        print("Could not %s event %s: %s" % (operation, event_id, reason))
+
+
 def print_menu() -> None:
     """
     Display menu to be used to guide user to use
@@ -329,99 +2401,187 @@ def print_menu() -> None:
     print("7. Quit")
 
 
-def main():
+def run_menu():
+    """
+    Run the interactive menu until the user quits.
+    """
     api = get_calendar_api()
     time_now = datetime.datetime.utcnow()
-
-    calendarLists = api.calendarList().get(calendarId='primary').execute()
-    DEFAULT_REMINDER = calendarLists["defaultReminders"][0]["minutes"]
+    # Repeated views of the same window are served from memory until a mutation reaches the server
+    cache = EventCache()
+    # Mutations are applied locally at once and sent to the server in the background
+    queue = MutationQueue(api, on_sent=cache.clear)
+    queue.start()
+    # Events are selected by a handle that stays the same for the whole session
+    handles = EventHandles()
+    # Days the user is likely to navigate to next are fetched in the background
+    prefetcher = NavigationPrefetcher(api, cache, time_zone=get_calendar_metadata(api)["time_zone"])
+    window = parse_window_policy(os.environ.get(WINDOW_POLICY_VARIABLE))
+    # The last day navigated to, the centre of a centered window
+    viewed = None
 
     # Show the main menu:
     user_exit = False
     # Global events variable
     events = []
-    while not user_exit:
-        print_menu()
-        user_input = int(input("Input option: "))
-
-        if user_input == 1:
-            events = get_all_events(api, time_now)
-            print_events(events)
-
-
-        elif user_input == 2:
-            key_word = input("Key words for event: ")
-            events = search_all_events(api, time_now, key_word)
-            print_events(events)
-
-        elif user_input == 3:
-            event_id = int(input("Select event to delete: "))
-            if (events == []) or (event_id < 1) or (event_id > len(events)):
-                print("Invalid input")
-                continue
-            else:
-                # print(events[event_id - 1]["id"])
-                if events[event_id - 1]['reminders'].get('overrides'):
-                    events[event_id - 1]['reminders']['overrides'] = None
-                else:
-                    return print("No reminder is set")
-
-                delete_event(api, events[event_id - 1]["id"])
-                events = get_all_events(api, time_now)
-                print_events(events)
-
-
-        elif user_input == 4:
-            event_id = int(input("Select event to edit: "))
-            summary = input("Enter your summary message: ")
-            if (events == []) or (event_id < 1) or (event_id > len(events)):
-                print("Invalid input")
-                continue
-            else:
-                # print(events[event_id - 1]["id"])
-                response = input("Would you like to change the reminders? [Y/N] ")
-                while response.upper() != "Y" and response.upper() != "N":
-                    response = input("Would you like to change the reminders? [Y/N] ")
-                if response.upper() == "Y":
-                    response = True
-                elif response.upper() == "N":
-                    response = False
-                edit_event(api, events[event_id - 1]['id'], summary, response)
-
-
-        elif user_input == 5:
-            event_id = int(input("Select event to canceled: "))
-            if (events == []) or (event_id < 1) or (event_id > len(events)):
-                print("Invalid input")
-                continue
-            else:
-                # print(events[event_id - 1]["id"])
-                cancel_event(api, events[event_id - 1]['id'])
-                print("Event has been cancelled")
-
-        elif user_input == 6:
-            year_choice = int(input("Input a year: "))
-            month_choice = int(input("Input a month: "))
-            day_choice = int(input("input a day: "))
-
-            if month_choice > 12 or month_choice < 1:
-                print("Invalid input for months")
-                if month_choice == 11 or month_choice == 9 or month_choice == 6 or month_choice == 4:
-                    if day_choice > 30:
-                        print("Invalid input for a day. Nov, September, June, or April do not have more than 30 days.")
-
-            if year_choice < 0:
-                print("Invalid input for years")
-
-            if day_choice < 1 or day_choice > 31:
-                print("Invalid input for days")
+    # The queue is closed however the menu ends, so the changes made are sent or kept for next time
+    try:
+        while not user_exit:
+            # Served from the cache; only refetched once CALENDAR_METADATA_TTL has passed
+            metadata = get_calendar_metadata(api)
+            print_failed_mutations(queue.take_failed())
+            print_menu()
+            user_input = int(input("Input option: "))
+
+            with trace_span("menu", option=user_input):
+                if user_input == 1:
+                    time_min, time_max = window(time_now, viewed)
+                    events = browse_events(api, to_rfc3339(time_min), to_rfc3339(time_max),
+                                           default_reminder=metadata["default_reminder"], prepare=queue.apply_local,
+                                           handles=handles, cache=cache)
+
+
+                elif user_input == 2:
+                    key_word = input("Key words for event: ")
+                    time_min, time_max = window(time_now, viewed)
+                    events = browse_events(api, to_rfc3339(time_min), to_rfc3339(time_max), key_word,
+                                           default_reminder=metadata["default_reminder"], prepare=queue.apply_local,
+                                           handles=handles, cache=cache)
+
+                elif user_input == 3:
+                    selected = handles.event(int(input("Select event to delete: ")))
+                    if selected is None:
+                        print("Invalid input")
+                        continue
+                    else:
+                        if selected['reminders'].get('overrides'):
+                            selected['reminders']['overrides'] = None
+                        else:
+                            print("No reminder is set")
+                            continue
+
+                        queue.delete(selected["id"], selected.get("etag"))
+                        apply_event_change(events, selected["id"])
+                        print_event_delta(selected["id"], None, metadata["default_reminder"], handles)
+                        handles.forget(selected["id"])
+
+
+                elif user_input == 4:
+                    handle = int(input("Select event to edit: "))
+                    summary = input("Enter your summary message: ")
+                    selected = handles.event(handle)
+                    if selected is None:
+                        print("Invalid input")
+                        continue
+                    else:
+                        response = input("Would you like to change the reminders? [Y/N] ")
+                        while response.upper() != "Y" and response.upper() != "N":
+                            response = input("Would you like to change the reminders? [Y/N] ")
+                        reminder_minutes = None
+                        if response.upper() == "Y":
+                            reminder_minutes = int(input("Input new reminder time in minutes: "))
+                        fields = queue.patch(selected['id'], build_edit_fields(summary, reminder_minutes),
+                                             selected.get('etag'))
+                        changed = dict(selected, **fields)
+                        apply_event_change(events, selected['id'], changed)
+                        print_event_delta(selected['id'], changed, metadata["default_reminder"], handles)
+
+
+                elif user_input == 5:
+                    selected = handles.event(int(input("Select event to canceled: ")))
+                    if selected is None:
+                        print("Invalid input")
+                        continue
+                    else:
+                        fields = queue.cancel(selected['id'], selected.get('etag'))
+                        changed = dict(selected, **fields)
+                        apply_event_change(events, selected['id'], changed)
+                        print_event_delta(selected['id'], changed, metadata["default_reminder"], handles)
+
+                elif user_input == 6:
+                    year_choice = int(input("Input a year: "))
+                    month_choice = int(input("Input a month: "))
+                    day_choice = int(input("input a day: "))
+
+                    if month_choice > 12 or month_choice < 1:
+                        print("Invalid input for months")
+                        if month_choice == 11 or month_choice == 9 or month_choice == 6 or month_choice == 4:
+                            if day_choice > 30:
+                                print("Invalid input for a day. Nov, September, June, or April do not have more "
+                                      "than 30 days.")
+
+                    if year_choice < 0:
+                        print("Invalid input for years")
+
+                    if day_choice < 1 or day_choice > 31:
+                        print("Invalid input for days")
+
+                    try:
+                        events = queue.apply_local(navigate_events(api, year_choice, month_choice, day_choice, cache,
+                                                                      metadata["time_zone"]))
+                    except ValueError:
+                        print("Invalid date")
+                        continue
+                    prefetcher.observe(year_choice, month_choice, day_choice)
+                    viewed = datetime.datetime(year_choice, month_choice, day_choice)
+                    print_events(events, metadata["default_reminder"], handles)
+                    print_events_detail(events, enrich_events(events))
+
+                elif user_input == 7:
+                    user_exit = True
+    finally:
+        prefetcher.close()
+        remaining = queue.close()
+        print_failed_mutations(queue.take_failed())
+        if remaining:
+            print("Some changes could not be sent yet, they will be sent next time.")
+
+
+def run_export(path):
+    """
+    Write every event of the window policy (CALENDAR_WINDOW) to a JSONL file in start order. Events are
+    streamed page by page, so the export holds only a few pages in memory however large the calendar.
 
-            events = navigate_events(api, year_choice, month_choice, day_choice)
-            print_events(events)
-            print_events_detail(events)
+    @param path: The export file
+    @type path: String
+    @return: Number of events written
+    """
+    import Streaming
 
-        elif user_input == 7:
-            user_exit = True
+    api = get_calendar_api()
+    time_min, time_max = parse_window_policy(os.environ.get(WINDOW_POLICY_VARIABLE))(datetime.datetime.utcnow(),
+                                                                                     None)
+    return Streaming.export_jsonl(Streaming.buffered(Streaming.fetch_events(api, time_min, time_max)), path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Google Calendar menu")
+    parser.add_argument("--trace", metavar="FILE", default=os.environ.get(TRACE_VARIABLE),
+                        help="record a Chrome trace of the session to FILE and a cProfile dump to FILE.prof "
+                             "(also set by the %s environment variable)" % TRACE_VARIABLE)
+    parser.add_argument("--journal", metavar="FILE", default=os.environ.get(JOURNAL_VARIABLE),
+                        help="append every event change seen or made during the session to the journal FILE "
+                             "(also set by the %s environment variable)" % JOURNAL_VARIABLE)
+    parser.add_argument("--export", metavar="FILE",
+                        help="write every event of the window (see %s) to FILE as JSON lines instead of running "
+                             "the menu" % WINDOW_POLICY_VARIABLE)
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        start_tracing(args.trace)
+    if args.journal:
+        start_journal(args.journal)
+    try:
+        if args.export:
+            print(run_export(args.export), "events exported to", args.export)
+        else:
+            run_menu()
+    finally:
+        if args.journal:
+            stop_journal()
+        if args.trace:
+            stop_tracing()
+            print("Trace saved to", args.trace)
 
 
 if __name__ == "__main__":  # Prevents the main() function from being called by the test suite runner
@@ -0,0 +1,535 @@
+# HTTP/JSON front end over the Calendar functions, for services that cannot drive the interactive menu.
+#
+# One asyncio process serves every user. Every request carries the user's own API key as an
+# "Authorization: Bearer KEY" header; the key names the user, and requests without a known key are refused
+# with 401 before any of the user's credentials are touched. The keys file only holds SHA-256 hashes of the keys
+# (see --add-user). The server calls Google with the user's own token, TOKENS/USER.json, which --login USER
+# obtains through the OAuth flow of the menu with its read and write scopes. Each user gets a pooled UserClient
+# holding their API object and an EventCache, so identical reads arriving together are answered by a single
+# upstream request and repeated reads are served from memory until a mutation clears the cache. The Calendar
+# functions block, so they run in a thread pool while the event loop keeps accepting requests.
+#
+# Endpoints (JSON bodies and responses, errors as {"error": message}):
+#   GET    /events?window=POLICY&q=TEXT          events of a window policy (see Calendar.parse_window_policy)
+#   GET    /search?q=&attendee=&organizer=&status=&updated_min=YYYY-MM-DD&time_zone=&window=&explain=1
+#                                                 structured search, see Calendar.plan_event_query
+#   GET    /navigate?date=YYYY-MM-DD&time_zone=   events of one day in a time zone
+#   GET    /export?window=POLICY&q=TEXT          every event of the window as a chunked JSON lines stream
+#   POST   /events                               create an event, or a list of events in batches
+#   PATCH  /events/ID                            change fields; reminder_minutes sets a popup reminder
+#   POST   /events/ID/cancel                     cancel an event
+#   DELETE /events/ID                            delete an event
+from __future__ import print_function
+import argparse
+import asyncio
+import datetime
+import hashlib
+import http
+import json
+import os
+import re
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import Calendar
+import Streaming
+
+# Number of users whose client stays pooled
+POOL_SIZE = 64
+# Threads running the blocking Calendar functions
+SERVER_WORKERS = 16
+# Events sent per chunk of a streamed response
+STREAM_BATCH = 500
+# Largest request body accepted, in bytes
+MAX_BODY = 10 * 1024 * 1024
+_USER_PATTERN = re.compile(r"^[A-Za-z0-9_.@-]{1,128}$")
+_BEARER = re.compile(r"^Bearer\s+(\S+)$", re.IGNORECASE)
+_EVENT_PATH = re.compile(r"^/events/([^/]+)(/cancel)?$")
+
+
+class HttpProblem(Exception):
+    """
+    An error answered with its HTTP status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class UserClient:
+    """
+    The pooled state of one user: their API object, the cache coalescing their reads, and a lock serialising the
+    requests sent through the API's shared connection.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.cache = Calendar.EventCache()
+        self.lock = threading.Lock()
+
+
+class ClientPool:
+    """
+    Least recently used pool of UserClients, created on first use by factory(user).
+
+    The factory runs outside the pool lock, as building an API object may read files and refresh credentials
+    over the network; concurrent first requests of the same user share a single build, like EventCache fetches.
+    """
+
+    def __init__(self, factory, maxsize=POOL_SIZE):
+        """
+        @param factory: Returns the API object of a user, e.g. token_directory_factory(directory)
+        @type factory: callable
+        @param maxsize: Number of users kept
+        @type maxsize: Integer
+        """
+        self.factory = factory
+        self.maxsize = maxsize
+        self._clients = OrderedDict()
+        # user -> Future of the client being built
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """
+        Return the client of a user, creating it when the user is not pooled.
+
+        @param user: The authenticated user
+        @type user: String
+        @return: UserClient
+        """
+        with self._lock:
+            client = self._clients.get(user)
+            if client is not None:
+                self._clients.move_to_end(user)
+                return client
+            future = self._building.get(user)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._building[user] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            client = UserClient(self.factory(user))
+        except BaseException as error:
+            with self._lock:
+                self._building.pop(user, None)
+            future.set_exception(error)
+            raise
+
+        with self._lock:
+            self._building.pop(user, None)
+            self._clients[user] = client
+            while len(self._clients) > self.maxsize:
+                self._clients.popitem(last=False)
+        future.set_result(client)
+        return client
+
+
+def token_path(directory, user):
+    """
+    Return the token file of a user, directory/USER.json.
+    """
+    if not _USER_PATTERN.match(user):
+        raise ValueError("Invalid user name: " + user)
+    return os.path.join(directory, user + ".json")
+
+
+def login(directory, user):
+    """
+    Let a user log in with the OAuth flow of the menu (credentials.json, Calendar.SCOPES, read and write access to
+    events) and store their token in the token directory.
+
+    @param directory: The directory of the token files, created when missing
+    @type directory: String
+    @param user: The user, named like in the keys file
+    @type user: String
+    @return: The token file written
+    """
+    path = token_path(directory, user)
+    os.makedirs(directory, exist_ok=True)
+    Calendar.get_credentials(path)
+    return path
+
+
+def token_directory_factory(directory):
+    """
+    Return a ClientPool factory building the API of a user from the token file directory/USER.json, written by
+    --login USER. Tokens need the scopes of Calendar.SCOPES; a read only token such as the one of quickstart.py
+    is refused by the server on every change.
+
+    @param directory: The directory of the token files
+    @type directory: String
+    """
+    def factory(user):
+        info = Calendar.read_token_info(token_path(directory, user))
+        if not info:
+            raise HttpProblem(403, "No credentials stored for " + user + ", log in with --login " + user)
+        from googleapiclient.discovery import build
+        from google.oauth2.credentials import Credentials
+
+        return build('calendar', 'v3', credentials=Credentials.from_authorized_user_info(info, Calendar.SCOPES))
+    return factory
+
+
+def hash_key(key):
+    """
+    Return the hash an API key is stored as in the keys file.
+
+    @param key: The API key
+    @type key: String
+    @return: String, hex SHA-256 digest
+    """
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def read_api_keys(path):
+    """
+    Read a keys file, {"user": "hash of their API key"}.
+
+    @param path: The keys file
+    @type path: String
+    @return: dict user -> hash, empty when the file does not exist
+    """
+    try:
+        with open(path) as keys:
+            return json.load(keys)
+    except FileNotFoundError:
+        return {}
+
+
+def add_user(path, user):
+    """
+    Give a user a new API key, replacing any key they had, and store its hash in the keys file.
+
+    @param path: The keys file
+    @type path: String
+    @param user: The user, named like their token file
+    @type user: String
+    @return: The new API key, shown once and never stored
+    """
+    if not _USER_PATTERN.match(user):
+        raise ValueError("Invalid user name: " + user)
+    keys = read_api_keys(path)
+    key = secrets.token_urlsafe(32)
+    keys[user] = hash_key(key)
+    with Calendar.atomic_write(path, ".keys-") as stored:
+        json.dump(keys, stored, indent=1, sort_keys=True)
+    return key
+
+
+def bearer_authenticator(key_hashes):
+    """
+    Return an authenticate(headers) function naming the user whose API key is sent as a bearer token.
+
+    @param key_hashes: user -> hash of their API key, see read_api_keys
+    @type key_hashes: dict
+    @return: callable raising HttpProblem(401) when the key is missing or unknown
+    """
+    users = {key_hash: user for user, key_hash in key_hashes.items()}
+
+    def authenticate(headers):
+        match = _BEARER.match(headers.get("authorization", ""))
+        user = users.get(hash_key(match.group(1))) if match else None
+        if user is None:
+            raise HttpProblem(401, "A valid API key must be sent as a bearer token")
+        return user
+    return authenticate
+
+
+def _parse_date(text, name):
+    try:
+        return datetime.datetime.strptime(text, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise HttpProblem(400, name + " must be a YYYY-MM-DD date")
+
+
+def _take(iterator, count):
+    """
+    Return the next count items of iterator, fewer once it is exhausted.
+    """
+    items = []
+    for item in iterator:
+        items.append(item)
+        if len(items) == count:
+            break
+    return items
+
+
+class CalendarServer:
+    """
+    The asyncio HTTP server, see the module comment for its endpoints.
+    """
+
+    def __init__(self, pool, authenticate, host="127.0.0.1", port=8080, workers=SERVER_WORKERS):
+        """
+        @param pool: The pool of per user clients
+        @type pool: ClientPool
+        @param authenticate: Returns the user making a request from its headers, e.g. bearer_authenticator(...)
+        @type authenticate: callable
+        @param host: Address to listen on
+        @type host: String
+        @param port: Port to listen on, 0 for any free port
+        @type port: Integer
+        @param workers: Threads running the Calendar functions
+        @type workers: Integer
+        """
+        self.pool = pool
+        self.authenticate = authenticate
+        self.host = host
+        self.port = port
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="calendar-server")
+        self._server = None
+
+    async def start(self):
+        """
+        Start listening; port is updated to the bound port.
+        @return: No return
+        """
+        self._server = await asyncio.start_server(self._serve_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stop listening and wait for the running Calendar calls.
+        @return: No return
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self._executor.shutdown(wait=True)
+
+    def _run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    return
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {"error": "Request body too large"}, False)
+                    return
+                body = await reader.readexactly(length) if length else b""
+                if not await self._dispatch(writer, method, target, headers, body, keep_alive) or not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        data = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}", f"Content-Length: {len(data)}",
+                "Connection: " + ("keep-alive" if keep_alive else "close")]
+        if payload is not None:
+            head.append("Content-Type: application/json")
+        if status == 401:
+            head.append("WWW-Authenticate: Bearer")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+    async def _stream(self, writer, events, keep_alive):
+        """
+        Send events as a chunked JSON lines response, reading the next batch only once the client took the last.
+        The first batch is read before the status line, so a request the upstream refuses outright (bad
+        credentials, quota) is answered with its error status; later failures can only cut the stream short.
+        @return: True when the whole stream was sent
+        @raise Exception: the error of the first batch, nothing has been sent then
+        """
+        try:
+            batch = await self._run(_take, events, STREAM_BATCH)
+        except BaseException:
+            await self._run(events.close)
+            raise
+        head = ["HTTP/1.1 200 OK", "Content-Type: application/x-ndjson", "Transfer-Encoding: chunked",
+                "Connection: " + ("keep-alive" if keep_alive else "close")]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        try:
+            while batch:
+                data = "".join(json.dumps(event) + "\n" for event in batch).encode("utf-8")
+                writer.write(b"%x\r\n" % len(data) + data + b"\r\n")
+                await writer.drain()
+                batch = await self._run(_take, events, STREAM_BATCH)
+        except Exception:
+            # The status line is gone already; closing without the last chunk tells the client it failed
+            return False
+        finally:
+            await self._run(events.close)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
+
+    async def _dispatch(self, writer, method, target, headers, body, keep_alive):
+        """
+        Answer one request.
+        @return: False when the connection must be closed
+        """
+        try:
+            # Checked before the pool, so no user's credentials are loaded for an unauthenticated request
+            user = self.authenticate(headers)
+            url = urlsplit(target)
+            query = dict(parse_qsl(url.query))
+            try:
+                payload = json.loads(body) if body else None
+            except ValueError:
+                raise HttpProblem(400, "The body is not JSON")
+            client = await self._run(self.pool.get, user)
+
+            if method == "GET" and url.path == "/export":
+                events = await self._run(self._export, client, query)
+                return await self._stream(writer, events, keep_alive)
+            status, result = await self._run(self._route, client, method, url.path, query, payload)
+        except HttpProblem as problem:
+            status, result = problem.status, {"error": str(problem)}
+        except ValueError as error:
+            status, result = 400, {"error": str(error)}
+        except Exception as error:
+            status = Calendar._error_status(error) or 500
+            result = {"error": str(error) or type(error).__name__}
+        await self._respond(writer, status, result, keep_alive)
+        return True
+
+    def _route(self, client, method, path, query, payload):
+        """
+        Run the Calendar function of a request in a worker thread.
+        @return: (status, response payload)
+        """
+        if method == "GET" and path == "/events":
+            key = ("events", query.get("window"), query.get("q", ""))
+            return 200, {"events": client.cache.get_or_fetch(key, lambda: self._list(client, query))}
+        if method == "GET" and path == "/search":
+            filters = self._search_filters(query)
+            if query.get("explain"):
+                return 200, Calendar.explain_query(filters)
+            key = ("search",) + tuple(sorted(query.items()))
+            return 200, {"events": client.cache.get_or_fetch(
+                key, lambda: list(Calendar.query_events(client.api, filters)))}
+        if method == "GET" and path == "/navigate":
+            day = _parse_date(query.get("date"), "date")
+            time_min, time_max = Calendar.day_bounds(day.year, day.month, day.day, query.get("time_zone"))
+            key = ("navigate", time_min, time_max)
+            return 200, {"events": client.cache.get_or_fetch(
+                key, lambda: Calendar.list_events_in_window(client.api, time_min, time_max))}
+
+        if method == "POST" and path == "/events":
+            with client.lock:
+                if isinstance(payload, list):
+                    ids, errors = Calendar.insert_events(client.api, payload)
+                    result = {"ids": ids, "errors": {str(position): Calendar._error_status(error) or str(error)
+                                                     for position, error in errors.items()}}
+                else:
+                    result = {"id": Calendar.insert_event(client.api, payload or {})}
+            client.cache.clear()
+            return 201, result
+        match = _EVENT_PATH.match(path)
+        if match is None:
+            raise HttpProblem(404, "No such endpoint: " + path)
+        event_id, cancel = unquote(match.group(1)), match.group(2)
+        with client.lock:
+            if method == "POST" and cancel:
+                status, result = 200, Calendar.cancel_event(client.api, event_id)
+            elif method == "PATCH" and not cancel:
+                fields = dict(payload or {})
+                if "reminder_minutes" in fields:
+                    fields["reminders"] = {"useDefault": False, "overrides": [
+                        {"method": "popup", "minutes": int(fields.pop("reminder_minutes"))}]}
+                status, result = 200, Calendar.patch_event(client.api, event_id, fields)
+            elif method == "DELETE" and not cancel:
+                Calendar.delete_event(client.api, event_id)
+                status, result = 204, None
+            else:
+                raise HttpProblem(405, method + " is not supported on " + path)
+        client.cache.clear()
+        return status, result
+
+    @staticmethod
+    def _window(query):
+        time_now = datetime.datetime.utcnow()
+        return Calendar.parse_window_policy(query.get("window"))(time_now)
+
+    def _list(self, client, query):
+        return list(Calendar.stream_events_sharded(client.api, *self._window(query), query.get("q", "")))
+
+    def _search_filters(self, query):
+        time_min, time_max = self._window(query)
+        filters = {"time_min": time_min, "time_max": time_max}
+        for name in ("attendee", "organizer", "status", "time_zone"):
+            if query.get(name):
+                filters[name] = query[name]
+        if query.get("q"):
+            filters["text"] = query["q"]
+        if query.get("updated_min"):
+            filters["updated_min"] = _parse_date(query["updated_min"], "updated_min")
+        if query.get("show_deleted"):
+            filters["show_deleted"] = True
+        return filters
+
+    def _export(self, client, query):
+        time_min, time_max = self._window(query)
+        return Streaming.fetch_events(client.api, time_min, time_max, query.get("q", ""))
+
+
+async def serve(pool, authenticate, host, port, workers=SERVER_WORKERS):
+    """
+    Serve until cancelled.
+    """
+    server = CalendarServer(pool, authenticate, host, port, workers)
+    await server.start()
+    print("Serving on", server.host, server.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP/JSON server over the Google Calendar functions")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tokens", metavar="DIRECTORY", default="tokens",
+                        help="directory of the users' token files, named USER.json")
+    parser.add_argument("--keys", metavar="FILE", default="api-keys.json",
+                        help="file of the hashes of the users' API keys")
+    parser.add_argument("--add-user", metavar="USER",
+                        help="give USER a new API key, print it and exit")
+    parser.add_argument("--login", metavar="USER",
+                        help="log USER in to Google Calendar, store their token in the token directory and exit")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    args = parser.parse_args(argv)
+    if args.add_user:
+        print("API key of", args.add_user + ":", add_user(args.keys, args.add_user))
+        return
+    if args.login:
+        print("Token of", args.login, "saved to", login(args.tokens, args.login))
+        return
+    key_hashes = read_api_keys(args.keys)
+    if not key_hashes:
+        parser.error("no API keys in " + args.keys + ", add users with --add-user")
+    try:
+        asyncio.run(serve(ClientPool(token_directory_factory(args.tokens)), bearer_authenticator(key_hashes),
+                          args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,25 @@ import unittest
 from unittest.mock import MagicMock, patch
 # Add other imports here if needed
 import Calendar
+import CalendarServer
+import Cassette
+import Dedup
+import LoadTest
+import Snapshot
+import Streaming
+import asyncio
 import datetime
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import http.client
+import importlib.util
 import io
+import json
+import os
+import subprocess
 import sys
+import tempfile
+import threading
+import warnings
+from urllib.parse import parse_qsl, urlsplit
 
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly', 'https://www.googleapis.com/auth/calendar.events']
 
@@ -53,6 +66,19 @@ class CalendarTest(unittest.TestCase):
         # Set the return values for events
         self.events = self.mock_api.events().list().execute()
 
+    @staticmethod
+    def make_event(event_id, start, end, summary="test"):
+        """
+        Build an event resource lasting from start to end (naive UTC datetimes).
+        """
+        return {
+            "id": event_id,
+            "summary": summary,
+            "start": {"dateTime": start.isoformat() + "Z"},
+            "end": {"dateTime": end.isoformat() + "Z"},
+            "reminders": {"useDefault": True}
+        }
+
     # This test tests number of upcoming events.
     def test_get_upcoming_events_number(self):
         """
@@ -269,10 +295,9 @@ class CalendarTest(unittest.TestCase):
 
         events = self.mock_api.events.return_value.list.return_value.execute.return_value
 
-        # Calculate starting_time and time_max
-        # Concatenate the strings to properly be fitted in the format
-        starting_time = str(time_year) + "-" + str(time_month) + "-" + str(time_day) + "T00:00:00.0000" + 'Z'
-        time_Max = str(time_year) + "-" + str(time_month) + "-" + str(time_day) + "T23:59:59.0000" + 'Z'
+        # The bounds are zero padded and cover the whole day up to the next midnight
+        starting_time = "2020-10-03T00:00:00Z"
+        time_Max = "2020-10-04T00:00:00Z"
 
         # Check if the function is called correctly:
         self.assertEqual(
@@ -305,6 +330,1330 @@ class CalendarTest(unittest.TestCase):
 
         self.assertEqual(predicted_event, capturedOutput.getvalue())
 
+    def test_calendar_metadata_cached(self):
+        """
+        This test fetches the calendar metadata twice and checks calendarList is only called once.
+
+        Function involved: get_calendar_metadata(api, calendar_id, ttl)
+        """
+        Calendar.clear_calendar_metadata()
+        mock_api = MagicMock()
+        mock_api.calendarList.return_value.get.return_value.execute.return_value = {
+            "defaultReminders": [{"method": "popup", "minutes": 30}],
+            "timeZone": "Australia/Melbourne",
+            "accessRole": "owner"
+        }
+
+        metadata = Calendar.get_calendar_metadata(mock_api)
+        Calendar.get_calendar_metadata(mock_api)
+
+        self.assertEqual(mock_api.calendarList.return_value.get.return_value.execute.call_count, 1)
+        self.assertEqual(metadata["default_reminder"], 30)
+        self.assertEqual(metadata["time_zone"], "Australia/Melbourne")
+        self.assertEqual(metadata["access_role"], "owner")
+
+        # An expired entry is fetched again
+        Calendar.clear_calendar_metadata()
+        Calendar.get_calendar_metadata(mock_api, ttl=0)
+        Calendar.get_calendar_metadata(mock_api, ttl=0)
+        self.assertEqual(mock_api.calendarList.return_value.get.return_value.execute.call_count, 3)
+        Calendar.clear_calendar_metadata()
+
+    def test_print_events_default_reminder(self):
+        """
+        This test checks that the default reminder passed in is the one printed for events using default reminders.
+
+        Function involved: print_events(events, default_reminder)
+        """
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        Calendar.print_events(self.events[:1], 30)
+        sys.stdout = sys.__stdout__
+
+        start = self.events[0]['start']['dateTime']
+        self.assertEqual("Events:  1 " + start + " test | Reminder:  30 minutes before\n", capturedOutput.getvalue())
+
+    def test_import_is_lazy(self):
+        """
+        This test imports Calendar in a fresh interpreter and checks the Google client libraries are not loaded
+        and that the import stays within Calendar.IMPORT_TIME_BUDGET.
+        """
+        script = ("import sys, time\n"
+                  "start = time.perf_counter()\n"
+                  "import Calendar\n"
+                  "elapsed = time.perf_counter() - start\n"
+                  "print(elapsed, 'googleapiclient.discovery' in sys.modules, 'google_auth_oauthlib.flow' in sys.modules)")
+        directory = os.path.dirname(os.path.abspath(__file__))
+        result = subprocess.run([sys.executable, "-c", script], cwd=directory, capture_output=True, text=True,
+                                check=True)
+        elapsed, discovery_loaded, flow_loaded = result.stdout.split()
+
+        self.assertEqual(discovery_loaded, "False")
+        self.assertEqual(flow_loaded, "False")
+        self.assertLess(float(elapsed), Calendar.IMPORT_TIME_BUDGET)
+
+    def test_token_store(self):
+        """
+        This test writes token info to the JSON credential store, reads it back, and checks that writing
+        identical info leaves the file untouched and that a failed write leaves the old file in place.
+
+        Functions involved: write_token_info(info, path), read_token_info(path), atomic_write(path, prefix)
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "token.json")
+            info = {"token": "abc", "refresh_token": "def", "client_id": "id", "client_secret": "secret"}
+
+            self.assertIsNone(Calendar.read_token_info(path))
+            self.assertTrue(Calendar.write_token_info(info, path))
+            self.assertEqual(Calendar.read_token_info(path), info)
+            # Only the token file remains, the temporary file was renamed over it
+            self.assertEqual(os.listdir(directory), ["token.json"])
+
+            mtime = os.stat(path).st_mtime_ns
+            self.assertFalse(Calendar.write_token_info(dict(info), path))
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+            info["token"] = "refreshed"
+            with Calendar.token_lock(path):
+                self.assertTrue(Calendar.write_token_info(info, path))
+            self.assertEqual(Calendar.read_token_info(path)["token"], "refreshed")
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+            # A write that fails leaves the old file and no temporary file behind
+            with self.assertRaises(TypeError):
+                Calendar.write_token_info({"token": object()}, path)
+            self.assertEqual(Calendar.read_token_info(path)["token"], "refreshed")
+            self.assertEqual(sorted(os.listdir(directory)), ["token.json", "token.json.lock"])
+
+    def test_plan_time_shards(self):
+        """
+        This test splits a seven year window and checks the shards are consecutive and cover the whole window.
+
+        Function involved: plan_time_shards(time_min, time_max, shard_days, max_shards)
+        """
+        time_min = datetime.datetime(2015, 1, 1)
+        time_max = datetime.datetime(2022, 1, 1)
+        shards = Calendar.plan_time_shards(time_min, time_max, shard_days=366)
+
+        self.assertEqual(len(shards), 7)
+        self.assertEqual(shards[0][0], time_min)
+        self.assertEqual(shards[-1][1], time_max)
+        for previous, following in zip(shards, shards[1:]):
+            self.assertEqual(previous[1], following[0])
+        self.assertEqual(len(Calendar.plan_time_shards(time_min, time_max, shard_days=1, max_shards=5)), 5)
+        self.assertEqual(Calendar.plan_time_shards(time_max, time_min), [])
+
+    @staticmethod
+    def make_list_api(stored_events):
+        """
+        Build a mock api whose events().list honours timeMin, timeMax, maxResults and pageToken over stored_events.
+        """
+        def parse(value):
+            return datetime.datetime.fromisoformat(value.replace("Z", ""))
+
+        def list_events(**kwargs):
+            time_min, time_max = parse(kwargs["timeMin"]), parse(kwargs["timeMax"])
+            matching = sorted((event for event in stored_events
+                               if parse(event["end"]["dateTime"]) > time_min
+                               and parse(event["start"]["dateTime"]) < time_max),
+                              key=lambda event: event["start"]["dateTime"])
+            offset = int(kwargs.get("pageToken") or 0)
+            page_end = offset + kwargs["maxResults"]
+            result = {"items": matching[offset:page_end]}
+            if page_end < len(matching):
+                result["nextPageToken"] = str(page_end)
+            request = MagicMock()
+            request.execute.return_value = result
+            return request
+
+        api = MagicMock()
+        api.events.return_value.list.side_effect = list_events
+        return api
+
+    @patch('Calendar.PAGE_SIZE', 2)
+    def test_stream_events_sharded(self):
+        """
+        This test fetches a window in parallel shards and checks every event is returned once, in start time order,
+        including an event crossing a shard boundary and a dense shard that has to be split.
+
+        Function involved: stream_events_sharded(api, time_min, time_max, key_word, max_workers, shard_days)
+        """
+        start = datetime.datetime(2020, 1, 1)
+        stored_events = [self.make_event("e" + str(day), start + datetime.timedelta(days=day),
+                                         start + datetime.timedelta(days=day, hours=1)) for day in range(0, 60, 3)]
+        # Crosses the boundary between the first two 10 day shards
+        stored_events.append(self.make_event("long", start + datetime.timedelta(days=8),
+                                             start + datetime.timedelta(days=12)))
+        # Five events on one day make that shard denser than a page
+        stored_events += [self.make_event("busy" + str(hour), start + datetime.timedelta(days=40, hours=hour),
+                                          start + datetime.timedelta(days=40, hours=hour, minutes=30))
+                          for hour in range(5)]
+        api = self.make_list_api(stored_events)
+
+        events = list(Calendar.stream_events_sharded(api, start, start + datetime.timedelta(days=60), shard_days=10))
+
+        expected = sorted(stored_events, key=lambda event: event["start"]["dateTime"])
+        self.assertEqual([event["id"] for event in events], [event["id"] for event in expected])
+
+    def test_parse_rfc3339(self):
+        """
+        This test parses the timestamp formats found in events and checks they become the same aware datetimes.
+
+        Functions involved: parse_rfc3339(value), event_start(event), event_end(event)
+        """
+        utc = datetime.timezone.utc
+        expected = datetime.datetime(2019, 6, 2, 17, 0, tzinfo=utc)
+
+        self.assertEqual(Calendar.parse_rfc3339("2019-06-03T02:00:00+09:00"), expected)
+        self.assertEqual(Calendar.parse_rfc3339("2019-06-02T17:00:00Z"), expected)
+        self.assertEqual(Calendar.parse_rfc3339("2019-06-02T17:00:00.0000Z"), expected)
+        self.assertEqual(Calendar.parse_rfc3339("2019-06-02"), datetime.datetime(2019, 6, 2, tzinfo=utc))
+        self.assertEqual(Calendar.event_start(self.events[0]), expected)
+        self.assertEqual(Calendar.event_end(self.events[0]), datetime.datetime(2019, 6, 2, 17, 45, tzinfo=utc))
+        self.assertRaises(ValueError, Calendar.parse_rfc3339, "3 June 2019")
+
+    def test_day_bounds(self):
+        """
+        This test checks the bounds of a day are zero padded and that impossible dates are rejected.
+
+        Functions involved: day_bounds(time_year, time_month, time_day), to_rfc3339(time_value)
+        """
+        self.assertEqual(Calendar.day_bounds(2020, 1, 5), ("2020-01-05T00:00:00Z", "2020-01-06T00:00:00Z"))
+        self.assertEqual(Calendar.day_bounds(2020, 12, 31), ("2020-12-31T00:00:00Z", "2021-01-01T00:00:00Z"))
+        self.assertRaises(ValueError, Calendar.day_bounds, 2021, 2, 29)
+
+        melbourne = datetime.timezone(datetime.timedelta(hours=11))
+        self.assertEqual(Calendar.to_rfc3339(datetime.datetime(2020, 1, 5, 9, 30, tzinfo=melbourne)),
+                         "2020-01-04T22:30:00Z")
+
+    def test_mutation_queue_coalesces(self):
+        """
+        This test queues several changes of one event and checks they are applied locally at once and sent as a
+        single patch, and that a delete replaces the pending changes.
+
+        Functions involved: MutationQueue.patch, MutationQueue.delete, MutationQueue.apply_local, MutationQueue.flush
+        """
+        mock_api = MagicMock()
+        queue = Calendar.MutationQueue(mock_api, ":memory:")
+
+        queue.patch("ABCDEFIGHIT", Calendar.build_edit_fields("first"))
+        queue.patch("ABCDEFIGHIT", Calendar.build_edit_fields("second", 15))
+        queue.cancel("ABCDEFIGHIT")
+        queue.patch("ABCDEFIGHIG", {"summary": "gone"})
+        queue.delete("ABCDEFIGHIG")
+        self.assertEqual(len(queue.pending()), 2)
+
+        # Applied locally before anything is sent
+        events = queue.apply_local(self.events)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["summary"], "second")
+        self.assertEqual(events[0]["status"], "cancelled")
+        self.assertEqual(events[0]["reminders"]["overrides"][0]["minutes"], 15)
+        self.assertEqual(mock_api.events.return_value.patch.call_count, 0)
+
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(mock_api.events.return_value.patch.call_count, 1)
+        args, kwargs = mock_api.events.return_value.patch.call_args_list[0]
+        self.assertEqual(kwargs["body"], {"summary": "second", "status": "cancelled",
+                                          "reminders": events[0]["reminders"]})
+        args, kwargs = mock_api.events.return_value.delete.call_args_list[0]
+        self.assertEqual(kwargs["eventId"], "ABCDEFIGHIG")
+        self.assertEqual(queue.pending(), [])
+        self.assertEqual(queue.close(), 0)
+
+    def test_mutation_queue_offline(self):
+        """
+        This test flushes the queue while the server cannot be reached and checks the mutation is kept in the
+        queue file and sent by the next queue opened on it. A stale ETag is resolved by resending the patch.
+
+        Functions involved: MutationQueue.flush, MutationQueue.close
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mutations.db")
+            mock_api = MagicMock()
+            mock_api.events.return_value.patch.return_value.execute.side_effect = OSError("offline")
+            queue = Calendar.MutationQueue(mock_api, path)
+            queue.patch("ABCDEFIGHIT", {"summary": "offline edit"}, etag='"1"')
+            self.assertEqual(queue.close(), 1)
+
+            stale = Exception("precondition failed")
+            stale.resp = MagicMock(status=412)
+            mock_api = MagicMock()
+            mock_api.events.return_value.patch.return_value.execute.side_effect = [stale, {"id": "ABCDEFIGHIT"}]
+            queue = Calendar.MutationQueue(mock_api, path)
+            self.assertEqual(queue.flush(), 1)
+            self.assertEqual(mock_api.events.return_value.patch.return_value.execute.call_count, 2)
+            self.assertEqual(queue.failed, [])
+            self.assertEqual(queue.close(), 0)
+
+    def test_mutation_queue_unexpected_error(self):
+        """
+        This test sends a mutation failing with an error that is neither an HTTP status nor a network error and
+        checks it is given up after MAX_SEND_ATTEMPTS flushes, and that the queue stays usable during a flush.
+
+        Functions involved: MutationQueue.flush, MutationQueue.take_failed
+        """
+        mock_api = MagicMock()
+        queue = Calendar.MutationQueue(mock_api, ":memory:")
+
+        def send_edit(*args, **kwargs):
+            if mock_api.events.return_value.patch.return_value.execute.call_count == Calendar.MAX_SEND_ATTEMPTS:
+                # Queued while the request is in flight, it must not be dropped with the row being sent
+                queue.patch("ABCDEFIGHIT", {"summary": "later edit"})
+            raise ValueError("unexpected")
+
+        mock_api.events.return_value.patch.return_value.execute.side_effect = send_edit
+        queue.patch("ABCDEFIGHIT", {"summary": "first edit"})
+        for attempt in range(Calendar.MAX_SEND_ATTEMPTS - 1):
+            self.assertEqual(queue.flush(), 0)
+        self.assertEqual(queue.flush(), 1)
+        self.assertEqual(queue.take_failed(), [("ABCDEFIGHIT", "patch", "ValueError('unexpected')")])
+        self.assertEqual(queue.failed, [])
+        self.assertEqual(queue.pending(), [("ABCDEFIGHIT", "patch", {"summary": "later edit"}, None)])
+
+    @patch('Calendar.input')
+    def test_run_menu_sends_changes(self, mock_input):
+        """
+        This test edits an event from the menu and then leaves the menu through an invalid input, and checks the
+        edit still reaches the server, and that deleting an event without reminder does not end the menu.
+
+        Functions involved: run_menu(), MutationQueue.close
+        """
+        time_now = datetime.datetime.utcnow().replace(microsecond=0)
+        stored_events = [self.make_event("e" + str(number), time_now + datetime.timedelta(days=number),
+                                         time_now + datetime.timedelta(days=number, hours=1))
+                         for number in range(1, 3)]
+        server = LoadTest.FakeEventsServer(stored_events)
+        mock_input.side_effect = ["1", "D", "4", "1", "renamed", "N", "3", "2", "x"]
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory, patch('Calendar.get_calendar_api', return_value=server), \
+                patch('sys.stdout', new=io.StringIO()) as output:
+            # The mutation queue file is created in the working directory
+            os.chdir(directory)
+            try:
+                self.assertRaises(ValueError, Calendar.run_menu)
+            finally:
+                os.chdir(working_directory)
+        self.assertIn("No reminder is set", output.getvalue())
+        self.assertEqual(server.call_now(server._get, {"calendarId": "primary", "eventId": "e1"}, {})["summary"],
+                         "renamed")
+
+    def test_event_cache(self):
+        """
+        This test reads the same window twice through the cache and checks the API is only queried once, and that
+        a cleared cache queries it again.
+
+        Functions involved: get_upcoming_events(..., cache), EventCache.clear
+        """
+        mock_api = MagicMock()
+        cache = Calendar.EventCache()
+        time = datetime.datetime(2020, 10, 3)
+
+        Calendar.get_all_events(mock_api, time, cache=cache)
+        Calendar.get_all_events(mock_api, time, cache=cache)
+        Calendar.navigate_events(mock_api, 2020, 10, 3, cache)
+        self.assertEqual(mock_api.events.return_value.list.return_value.execute.return_value.get.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        cache.clear()
+        Calendar.get_all_events(mock_api, time, cache=cache)
+        self.assertEqual(mock_api.events.return_value.list.return_value.execute.return_value.get.call_count, 3)
+
+    def test_event_cache_single_flight(self):
+        """
+        This test makes several threads miss the cache on the same key at once and checks only one fetch is made,
+        that changing the returned events leaves the cached ones unchanged, and that the least recently used entry
+        is evicted once the cache is full.
+
+        Function involved: EventCache.get_or_fetch(key, fetch)
+        """
+        cache = Calendar.EventCache(maxsize=2)
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return [{"summary": "event"}]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch("window", fetch)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[{"summary": "event"}]] * 5)
+
+        # Callers get deep copies: the menu's edits of a listed event must not reach the cached one
+        results[0][0]["summary"] = "edited"
+        cache.get_or_fetch("window", fetch)[0]["summary"] = "edited"
+        self.assertEqual(cache.get_or_fetch("window", fetch), [{"summary": "event"}])
+
+        cache.get_or_fetch("second", lambda: [])
+        cache.get_or_fetch("window", fetch)
+        cache.get_or_fetch("third", lambda: [])
+        self.assertEqual(cache.get_or_fetch("second", lambda: ["refetched"]), ["refetched"])
+
+    @patch('Calendar.input')
+    def test_browse_events(self, mock_input):
+        """
+        This test pages forward and back through 25 events, 10 per page, and checks only the pages needed are
+        fetched and the events of the page the user stopped at are returned, and that browsing through a cache
+        fetches every page once.
+
+        Functions involved: browse_events(api, time_min, time_max, ...), iter_event_pages(...)
+        """
+        start = datetime.datetime(2020, 1, 1)
+        stored_events = [self.make_event("e" + str(day), start + datetime.timedelta(days=day),
+                                         start + datetime.timedelta(days=day, hours=1)) for day in range(25)]
+        api = self.make_list_api(stored_events)
+        time_min, time_max = Calendar.to_rfc3339(start), Calendar.to_rfc3339(start + datetime.timedelta(days=30))
+
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        mock_input.side_effect = ["N", "P", "D"]
+        events = Calendar.browse_events(api, time_min, time_max, page_size=10)
+        sys.stdout = sys.__stdout__
+
+        self.assertEqual([event["id"] for event in events], ["e" + str(day) for day in range(10)])
+        # The first two pages, going back does not fetch again. The third page may have been prefetched before
+        # browsing ended and the prefetch was cancelled.
+        self.assertIn(api.events.return_value.list.call_count, (2, 3))
+        self.assertIn("Page 2", capturedOutput.getvalue())
+
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        mock_input.side_effect = ["N", "N", "N", "D"]
+        events = Calendar.browse_events(api, time_min, time_max, page_size=10)
+        sys.stdout = sys.__stdout__
+        self.assertEqual([event["id"] for event in events], ["e" + str(day) for day in range(20, 25)])
+
+        # Browsed through a cache, the same pages are not fetched twice
+        cache = Calendar.EventCache()
+        calls = api.events.return_value.list.call_count
+        for browse in range(2):
+            sys.stdout = io.StringIO()
+            mock_input.side_effect = ["N", "N", "D"]
+            events = Calendar.browse_events(api, time_min, time_max, page_size=10, cache=cache)
+            sys.stdout = sys.__stdout__
+            self.assertEqual([event["id"] for event in events], ["e" + str(day) for day in range(20, 25)])
+        self.assertEqual(api.events.return_value.list.call_count - calls, 3)
+
+    def test_event_handles(self):
+        """
+        This test registers events from two different lists and checks every event keeps the handle it was first
+        given, that a handle resolves to the event id and ETag, and that events without reminder get a handle.
+
+        Functions involved: EventHandles.register, EventHandles.lookup, print_events(events, ..., handles)
+        """
+        handles = Calendar.EventHandles()
+        first, second = self.events
+        first = dict(first, etag='"1"')
+
+        self.assertEqual(handles.register([first, second]), [1, 2])
+        # Refetched in a different order with a new ETag
+        self.assertEqual(handles.register([dict(second), dict(first, etag='"2"')]), [2, 1])
+        self.assertEqual(handles.lookup(1), (first["id"], '"2"'))
+        self.assertEqual(handles.lookup(2), (second["id"], None))
+        self.assertIsNone(handles.lookup(3))
+
+        handles.forget(second["id"])
+        self.assertIsNone(handles.lookup(2))
+        self.assertEqual(handles.register([second]), [3])
+
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        Calendar.print_events([second, first], 0, handles)
+        sys.stdout = sys.__stdout__
+        self.assertEqual([line.split()[1] for line in capturedOutput.getvalue().splitlines()], ["3", "1"])
+
+        # An event without reminder is listed and registered, so it can be selected too
+        silent = dict(first, id="ABCDEFIGHIS", reminders={"useDefault": False})
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        Calendar.print_events([silent], 0, handles)
+        sys.stdout = sys.__stdout__
+        self.assertEqual(capturedOutput.getvalue(), "Events:  4 2019-06-03T02:00:00+09:00 test | No reminder\n")
+        self.assertEqual(handles.lookup(4), ("ABCDEFIGHIS", '"1"'))
+
+    def test_apply_event_change(self):
+        """
+        This test applies an edit and a deletion to a list of events in place and checks that only the changed
+        rows are printed.
+
+        Functions involved: apply_event_change(events, event_id, changed), print_event_delta(...), cancel_event
+        """
+        mock_api = MagicMock()
+        cancelled = dict(self.events[0], status="cancelled")
+        mock_api.events.return_value.update.return_value.execute.return_value = cancelled
+        events = list(self.events)
+        handles = Calendar.EventHandles()
+        handles.register(events)
+
+        changed = Calendar.cancel_event(mock_api, cancelled["id"])
+        self.assertEqual(changed, cancelled)
+        self.assertEqual(Calendar.apply_event_change(events, changed["id"], changed), 0)
+        self.assertIs(events[0], cancelled)
+
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        Calendar.print_event_delta(changed["id"], changed, 0, handles)
+        self.assertEqual(Calendar.apply_event_change(events, "ABCDEFIGHIG"), 1)
+        Calendar.print_event_delta("ABCDEFIGHIG", None, 0, handles)
+        Calendar.print_event_delta(changed["id"], dict(changed, reminders={"useDefault": False}), 0, handles)
+        sys.stdout = sys.__stdout__
+
+        self.assertEqual(events, [cancelled])
+        self.assertIsNone(Calendar.apply_event_change(events, "ABCDEFIGHIG"))
+        lines = capturedOutput.getvalue().splitlines()
+        self.assertEqual(lines, ["Updated:  1 2019-06-03T02:00:00+09:00 test | Reminder:  0 minutes before",
+                                 "Removed:  2",
+                                 "Updated:  1 2019-06-03T02:00:00+09:00 test | No reminder"])
+
+    def test_enrich_events(self):
+        """
+        This test enriches two events sharing attendees and checks every address is looked up once for the session,
+        and that names and response status are shown in the details.
+
+        Functions involved: enrich_events(events, lookup), print_events_detail(events, people)
+        """
+        Calendar.clear_directory_cache()
+        looked_up = []
+
+        def lookup(emails):
+            looked_up.extend(emails)
+            return Calendar.local_directory_lookup(emails)
+
+        events = [
+            dict(self.events[0], creator={"email": "jane.doe@example.com"}, organizer={"email": "jane.doe@example.com"},
+                 attendees=[{"email": "john_smith@example.com", "responseStatus": "accepted"},
+                            {"email": "room@example.com", "displayName": "Board Room"}]),
+            dict(self.events[1], creator={"email": "john_smith@example.com"},
+                 organizer={"email": "jane.doe@example.com"},
+                 attendees=[{"email": "jane.doe@example.com", "responseStatus": "tentative"}]),
+        ]
+        people = Calendar.enrich_events(events, lookup)
+        self.assertEqual(sorted(looked_up), ["jane.doe@example.com", "john_smith@example.com", "room@example.com"])
+        self.assertEqual(people["john_smith@example.com"]["displayName"], "John Smith")
+
+        Calendar.enrich_events(events, lookup)
+        self.assertEqual(len(looked_up), 3)
+
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        Calendar.print_events_detail(events, people)
+        sys.stdout = sys.__stdout__
+        output = capturedOutput.getvalue()
+        self.assertIn("0: john_smith@example.com (John Smith) - accepted", output)
+        self.assertIn("1: room@example.com (Board Room)", output)
+        self.assertIn("0: jane.doe@example.com (Jane Doe) - tentative", output)
+        Calendar.clear_directory_cache()
+
+    def test_load_harness(self):
+        """
+        This test runs the load harness briefly against the fake server and checks every operation of the mix was
+        run, that injected errors are counted, and that only the measured call of an operation is timed.
+
+        Functions involved: LoadTest.run_load(api, duration, workers, mix, time_now, seed)
+        """
+        time_now = datetime.datetime(2020, 10, 3)
+        server = LoadTest.FakeEventsServer(LoadTest.generate_events(200, time_now, seed=1), seed=1)
+        mix = {"list": 1, "search": 1, "navigate": 1, "edit": 1, "cancel": 1, "delete": 1}
+
+        result = LoadTest.run_load(server, 0.3, workers=4, mix=mix, time_now=time_now, seed=1)
+
+        for operation in mix:
+            self.assertGreater(len(result["latencies"][operation]), 0)
+            self.assertEqual(result["errors"][operation], 0)
+        self.assertEqual(len(server.event_ids()), 200)
+        self.assertGreaterEqual(len(result["memory"]), 2)
+
+        server.error_rate = 1
+        result = LoadTest.run_load(server, 0.1, workers=2, mix={"list": 1}, time_now=time_now, seed=1)
+        self.assertEqual(result["errors"]["list"], len(result["latencies"]["list"]))
+
+        # A delete is timed without the get and the insert that put the event back, one request each
+        server = LoadTest.FakeEventsServer(LoadTest.generate_events(20, time_now, seed=1), latency=0.1)
+        result = LoadTest.run_load(server, 0.3, workers=1, mix={"delete": 1}, time_now=time_now, seed=1)
+        self.assertGreater(len(result["latencies"]["delete"]), 0)
+        self.assertLess(max(result["latencies"]["delete"]), 0.2)
+
+    def test_window_policies(self):
+        """
+        This test checks the bounds of every window policy and that get_all_events queries the policy's window.
+
+        Functions involved: parse_window_policy(text), get_all_events(api, time_now, ..., window, viewed)
+        """
+        time_now = datetime.datetime(2020, 10, 3, 12)
+        viewed = datetime.datetime(2019, 1, 10)
+
+        self.assertEqual(Calendar.parse_window_policy(None)(time_now),
+                         (datetime.datetime(2015, 10, 3, 12), datetime.datetime(2022, 10, 3, 12)))
+        self.assertEqual(Calendar.parse_window_policy("rolling:30:90")(time_now, viewed),
+                         (datetime.datetime(2020, 9, 3, 12), datetime.datetime(2021, 1, 1, 12)))
+        self.assertEqual(Calendar.parse_window_policy("centered:14")(time_now, viewed),
+                         (datetime.datetime(2019, 1, 3), datetime.datetime(2019, 1, 17)))
+        self.assertEqual(Calendar.parse_window_policy("explicit:2020-01-01:2020-02-01")(time_now),
+                         (datetime.datetime(2020, 1, 1), datetime.datetime(2020, 2, 1)))
+        self.assertRaises(ValueError, Calendar.parse_window_policy, "weekly")
+
+        mock_api = MagicMock()
+        Calendar.get_all_events(mock_api, time_now, window=Calendar.centered_window(2), viewed=viewed)
+        args, kwargs = mock_api.events.return_value.list.call_args_list[0]
+        self.assertEqual(kwargs['timeMin'], "2019-01-09T00:00:00Z")
+        self.assertEqual(kwargs['timeMax'], "2019-01-11T00:00:00Z")
+
+    def test_navigation_prefetcher(self):
+        """
+        This test navigates forward by a week twice and checks the following week is prefetched into the cache, so
+        navigating there is served without querying the API.
+
+        Function involved: NavigationPrefetcher.observe(time_year, time_month, time_day)
+        """
+        mock_api = MagicMock()
+        cache = Calendar.EventCache()
+        prefetcher = Calendar.NavigationPrefetcher(mock_api, cache)
+
+        self.assertEqual(prefetcher.observe(2020, 10, 3), [datetime.date(2020, 10, 4), datetime.date(2020, 10, 2)])
+        self.assertEqual(prefetcher.observe(2020, 10, 10), [datetime.date(2020, 10, 17)])
+        prefetcher._executor.shutdown(wait=True)
+
+        calls = mock_api.events.return_value.list.call_count
+        Calendar.navigate_events(mock_api, 2020, 10, 17, cache)
+        self.assertEqual(mock_api.events.return_value.list.call_count, calls)
+        prefetcher.close()
+
+    def test_snapshot_round_trip(self):
+        """
+        This test writes events to a columnar snapshot, opens it again, and checks the events come back in start
+        order with their original date or dateTime values and all their other fields, that the start column is read
+        without copying, and that a time range is found by bisection.
+
+        Functions involved: Snapshot.write_snapshot(events, path), Snapshot.open_snapshot(path)
+        """
+        start = datetime.datetime(2020, 1, 1)
+        events = [self.make_event("e" + str(day), start + datetime.timedelta(days=day),
+                                  start + datetime.timedelta(days=day, hours=1)) for day in range(600, 0, -1)]
+        events[0].update(organizer={"email": "jane.doe@example.com"}, location="Room 1", status="confirmed",
+                         description="Bring the slides")
+        events[1]["reminders"] = {"useDefault": False, "overrides": [{"method": "popup", "minutes": 15}]}
+        # All-day events and UTC offsets come back as written
+        events[2].update(start={"date": "2021-08-21"}, end={"date": "2021-08-22"})
+        events[3].update(start={"dateTime": "2021-08-20T10:00:00+10:00", "timeZone": "Australia/Melbourne"},
+                         end={"dateTime": "2021-08-20T11:00:00+10:00", "timeZone": "Australia/Melbourne"})
+        # Fields without a column come back too, as do the parts of those only partly held by one
+        events[4].update(attendees=[{"email": "john@example.com", "responseStatus": "accepted"}], etag='"3181"',
+                         creator={"email": "jane.doe@example.com"}, updated="2020-01-02T10:00:00.000Z",
+                         organizer={"email": "jane.doe@example.com", "displayName": "Jane"},
+                         extendedProperties={"private": {"room": "1"}},
+                         reminders={"useDefault": False, "overrides": [{"method": "email", "minutes": 60},
+                                                                       {"method": "popup", "minutes": 10}]})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "calendar.snap")
+            self.assertEqual(Snapshot.write_snapshot(events, path), 600)
+
+            with Snapshot.open_snapshot(path) as snapshot:
+                self.assertEqual(len(snapshot), 600)
+                self.assertIsInstance(snapshot.starts, memoryview)
+                self.assertEqual(list(snapshot), sorted(events, key=Calendar.event_start))
+                self.assertEqual(snapshot.event(599), events[0])
+                self.assertEqual(snapshot.event(598)["reminders"], events[1]["reminders"])
+                self.assertEqual(snapshot.event(597), events[2])
+                self.assertEqual(snapshot.event(596), events[3])
+                self.assertEqual(snapshot.event(595), events[4])
+                snapshot.event(595)["attendees"].append({"email": "jim@example.com"})
+                self.assertEqual(snapshot.event(595), events[4])
+
+                found = snapshot.events_between(start + datetime.timedelta(days=10),
+                                                start + datetime.timedelta(days=13))
+                self.assertEqual([event["id"] for event in found], ["e10", "e11", "e12"])
+
+            with open(path, "wb") as not_a_snapshot:
+                not_a_snapshot.write(b"{}")
+            self.assertRaises(ValueError, Snapshot.open_snapshot, path)
+
+    def test_print_events_processes(self):
+        """
+        This test prints a list of events and their details with a pool of processes and checks the output is the
+        same as when printed by a single process.
+
+        Functions involved: print_events(events, ..., processes, chunk_size), print_events_detail(events, ...)
+        """
+        start = datetime.datetime(2020, 1, 1)
+        events = [self.make_event("e" + str(day), start + datetime.timedelta(days=day),
+                                  start + datetime.timedelta(days=day, hours=1), "event " + str(day))
+                  for day in range(50)]
+        for event in events[::7]:
+            event.update(creator={"email": "jane.doe@example.com"}, location="Room 1",
+                         attendees=[{"email": "john@example.com"}])
+        # Events without reminder are left out, numbering must still be consecutive
+        events[3]["reminders"] = {"useDefault": False}
+
+        outputs = []
+        for processes in (None, 2):
+            capturedOutput = io.StringIO()
+            sys.stdout = capturedOutput
+            Calendar.print_events(events, 10, processes=processes, chunk_size=8)
+            Calendar.print_events_detail(events, processes=processes, chunk_size=8)
+            sys.stdout = sys.__stdout__
+            outputs.append(capturedOutput.getvalue())
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn("Events:  49 2020-02-19T00:00:00Z event 49 | Reminder:  10 minutes before", outputs[1])
+
+    def test_trace_mode(self):
+        """
+        This test traces a metadata lookup and a render and checks the spans nest in the saved Chrome trace and
+        that a cProfile dump is written next to it.
+
+        Functions involved: start_tracing(path), trace_span(name), stop_tracing()
+        """
+        Calendar.clear_calendar_metadata()
+        mock_api = MagicMock()
+        mock_api.calendarList.return_value.get.return_value.execute.return_value = {"defaultReminders": []}
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.json")
+            Calendar.start_tracing(path)
+            capturedOutput = io.StringIO()
+            sys.stdout = capturedOutput
+            with Calendar.trace_span("menu", option=1):
+                Calendar.get_calendar_metadata(mock_api)
+                Calendar.print_events(self.events)
+            sys.stdout = sys.__stdout__
+            self.assertIsNotNone(Calendar.stop_tracing())
+
+            with open(path) as trace:
+                spans = {event["name"]: event for event in json.load(trace)["traceEvents"]}
+            self.assertTrue(os.path.exists(path + ".prof"))
+
+        self.assertEqual(set(spans), {"menu", "calendarList.get", "render.print_events"})
+        self.assertEqual(spans["menu"]["args"], {"option": "1"})
+        for name in ("calendarList.get", "render.print_events"):
+            self.assertGreaterEqual(spans[name]["ts"], spans["menu"]["ts"])
+            self.assertLessEqual(spans[name]["ts"] + spans[name]["dur"], spans["menu"]["ts"] + spans["menu"]["dur"])
+        # Tracing is off again
+        self.assertIsNone(Calendar.stop_tracing())
+        Calendar.clear_calendar_metadata()
+
+    def test_insert_events(self):
+        """
+        This test creates 120 events in batches of 50 and checks they are sent in 3 round trips and their ids are
+        returned in order, and that invalid bodies are rejected before anything is sent.
+
+        Functions involved: insert_events(api, bodies, batch_size), insert_event(api, body), validate_event_body
+        """
+        server = LoadTest.FakeEventsServer()
+        start = datetime.datetime(2020, 1, 1)
+        bodies = [self.make_event("imported" + str(number), start + datetime.timedelta(hours=number),
+                                  start + datetime.timedelta(hours=number, minutes=30)) for number in range(120)]
+
+        ids, errors = Calendar.insert_events(server, bodies, batch_size=50)
+
+        self.assertEqual(ids, [body["id"] for body in bodies])
+        self.assertEqual(errors, {})
+        # 3 batch round trips, each counted once, plus the 120 requests inside them
+        self.assertEqual(server.requests, 123)
+        self.assertEqual(len(server.event_ids()), 120)
+        self.assertEqual(Calendar.insert_event(server, dict(bodies[0], id="single")), "single")
+
+        invalid = dict(bodies[1], end={"dateTime": "2019-01-01T00:00:00Z"})
+        with self.assertRaises(ValueError):
+            Calendar.insert_events(server, [bodies[2], invalid])
+        self.assertRaises(ValueError, Calendar.validate_event_body, dict(bodies[1], start={"date": "2020-01-01"}))
+        self.assertRaises(ValueError, Calendar.validate_event_body,
+                          dict(bodies[1], reminders={"useDefault": False, "overrides": [{"minutes": -5}]}))
+        self.assertEqual(len(server.event_ids()), 121)
+
+    @patch('Calendar.time.sleep')
+    def test_delete_events_retries(self, mock_sleep):
+        """
+        This test deletes events while the server keeps answering 503 and checks every event is sent
+        BATCH_RETRIES + 1 times, with a back off between attempts but none after the last one.
+
+        Functions involved: delete_events(api, event_ids, batch_size)
+        """
+        unavailable = Exception("backend error")
+        unavailable.resp = MagicMock(status=503)
+        sent = []
+
+        def new_batch_http_request(callback):
+            batch = MagicMock()
+            batch.add.side_effect = lambda request, request_id: sent.append(request_id)
+            batch.execute.side_effect = lambda: [callback(request_id, None, unavailable)
+                                                 for request_id in list(sent)[-batch.add.call_count:]]
+            return batch
+
+        mock_api = MagicMock()
+        mock_api.new_batch_http_request.side_effect = new_batch_http_request
+        errors = Calendar.delete_events(mock_api, ["a", "b"], batch_size=50)
+
+        self.assertEqual(errors, {"a": unavailable, "b": unavailable})
+        self.assertEqual(len(sent), 2 * (Calendar.BATCH_RETRIES + 1))
+        self.assertEqual([call.args[0] for call in mock_sleep.call_args_list],
+                         [0.5 * 2 ** attempt for attempt in range(Calendar.BATCH_RETRIES)])
+
+    def test_query_events_pushdown(self):
+        """
+        This test runs a structured query and checks every filter the events endpoint supports is sent to it, that
+        only attendee and status are checked locally, and that the matching events are returned.
+
+        Functions involved: query_events(api, query), explain_query(query)
+        """
+        start = datetime.datetime(2020, 1, 1)
+        stored_events = [self.make_event("e" + str(day), start + datetime.timedelta(days=day),
+                                         start + datetime.timedelta(days=day, hours=1), "review " + str(day))
+                         for day in range(10)]
+        for event in stored_events[:6]:
+            event["attendees"] = [{"email": "jane@example.com"}]
+            event["extendedProperties"] = {"private": {"source": "import"}}
+        stored_events[2]["status"] = "cancelled"
+        stored_events[4]["attendees"] = [{"email": "not.jane@example.com"}]
+        for event in stored_events:
+            event["updated"] = "2020-01-01T00:00:00Z"
+        query = {"time_min": start, "time_max": start + datetime.timedelta(days=30), "text": "review",
+                 "attendee": "jane@example.com", "status": "confirmed", "time_zone": "Australia/Melbourne",
+                 "private_properties": {"source": "import"}, "updated_min": datetime.datetime(2019, 1, 1)}
+
+        explanation = Calendar.explain_query(query)
+        self.assertEqual(explanation["pushed"], {
+            "timeMin": "2020-01-01T00:00:00Z", "timeMax": "2020-01-31T00:00:00Z", "q": "review jane@example.com",
+            "updatedMin": "2019-01-01T00:00:00Z", "timeZone": "Australia/Melbourne",
+            "privateExtendedProperty": ["source=import"]})
+        self.assertEqual(explanation["local"], ["attendee == jane@example.com", "status == confirmed"])
+
+        server = LoadTest.FakeEventsServer(stored_events)
+        events = list(Calendar.query_events(server, query))
+        self.assertEqual([event["id"] for event in events], ["e0", "e1", "e3", "e5"])
+
+        cancelled = list(Calendar.query_events(server, dict(query, status="cancelled")))
+        self.assertEqual([event["id"] for event in cancelled], ["e2"])
+        searched = Calendar.search_all_events(server, start, "review", window=Calendar.rolling_window(0, 30),
+                                              filters={"attendee": "jane@example.com"})
+        self.assertEqual([event["id"] for event in searched], ["e0", "e1", "e3", "e5"])
+        self.assertRaises(ValueError, Calendar.explain_query, dict(query, colour="red"))
+
+    @staticmethod
+    def make_fake_http(stored_events):
+        """
+        Build an httplib2.Http stand-in answering events().list with pages of 2 events from stored_events, for
+        recording.
+        """
+        class FakeHttp:
+            def __init__(self):
+                self.requests = 0
+
+            def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+                self.requests += 1
+                query = dict(parse_qsl(urlsplit(uri).query))
+                first = int(query.get("pageToken", 0))
+                page = {"items": stored_events[first:first + 2]}
+                if first + 2 < len(stored_events):
+                    page["nextPageToken"] = str(first + 2)
+                return (Cassette.CassetteResponse(200, "OK", {"content-type": "application/json"}),
+                        json.dumps(page).encode("utf-8"))
+
+        return FakeHttp()
+
+    def test_cassette_replay(self):
+        """
+        This test records exchanges through a CassetteHttp, saves the cassette and replays it without the recorded
+        connection, checking requests match whatever the order of their query parameters and JSON keys, that
+        repeated requests are served in recorded order, and that unknown requests are refused.
+
+        Functions involved: Cassette.CassetteHttp(path, mode, http)
+        """
+        stored_events = [self.make_event("e" + str(day), datetime.datetime(2020, 1, day),
+                                         datetime.datetime(2020, 1, day, 1))
+                         for day in range(1, 6)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "calendar.cassette")
+            http = self.make_fake_http(stored_events)
+            recorder = Cassette.CassetteHttp(path, Cassette.RECORD, http)
+            uri = "https://www.googleapis.com/calendar/v3/calendars/primary/events?maxResults=2&pageToken=2"
+            recorded = recorder.request(uri)[1]
+            recorder.request(uri, "POST", '{"summary": "a", "id": "x"}', {"content-type": "application/json"})
+            stored_events[2]["summary"] = "changed"
+            changed = recorder.request(uri)[1]
+            self.assertEqual(recorder.save(), 3)
+
+            player = Cassette.CassetteHttp(path)
+            reordered = "https://www.googleapis.com/calendar/v3/calendars/primary/events?pageToken=2&maxResults=2"
+            response, content = player.request(reordered)
+            self.assertEqual((response.status, content), (200, recorded))
+            self.assertEqual(response["content-type"], "application/json")
+            self.assertEqual(player.request(uri, "POST", b'{"id": "x", "summary": "a"}')[0].status, 200)
+            self.assertEqual(player.request(uri)[1], changed)
+            self.assertEqual(player.request(uri)[1], changed)
+            self.assertRaises(Cassette.CassetteError, player.request, uri.replace("pageToken=2", "pageToken=4"))
+            player.rewind()
+            self.assertEqual(player.request(uri)[1], recorded)
+            self.assertEqual(http.requests, 3)
+
+    @unittest.skipUnless(importlib.util.find_spec("googleapiclient"), "googleapiclient is not installed")
+    def test_cassette_get_all_events(self):
+        """
+        This test records get_all_events through the real googleapiclient request path and replays it from the
+        cassette, following every result page, without the recorded connection.
+
+        Functions involved: Cassette.build_api(http), get_all_events(api, time_now, sharded=True)
+        """
+        stored_events = [self.make_event("e" + str(day), datetime.datetime(2020, 1, day),
+                                         datetime.datetime(2020, 1, day, 1))
+                         for day in range(1, 6)]
+        time_now = datetime.datetime(2020, 1, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "calendar.cassette")
+            recorder = Cassette.CassetteHttp(path, Cassette.RECORD, self.make_fake_http(stored_events))
+            window = Calendar.explicit_window(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 2, 1))
+            recorded = Calendar.get_all_events(Cassette.build_api(recorder), time_now, sharded=True, window=window)
+            recorder.save()
+
+            api, player = Cassette.replaying_api(path)
+            replayed = Calendar.get_all_events(api, time_now, sharded=True, window=window)
+            self.assertEqual(replayed, recorded)
+            self.assertEqual(len(replayed), 5)
+            self.assertEqual(player.requests, recorder.requests)
+
+    def test_streaming_pipeline(self):
+        """
+        This test streams events from the fake server through a buffered stage and an external sort whose memory
+        ceiling forces spilling to disk, exports them, and checks the order, the clean up of the spilled runs, and
+        that a buffered stage does not run ahead of its consumer. The --export option exports the window.
+
+        Functions involved: Streaming.fetch_events, Streaming.buffered, Streaming.external_sort,
+                            Streaming.export_jsonl, Streaming.print_event_stream, run_export(path)
+        """
+        start = datetime.datetime(2020, 1, 1)
+        stored_events = [self.make_event("e" + str(number), start + datetime.timedelta(hours=number),
+                                         start + datetime.timedelta(hours=number, minutes=30),
+                                         "event " + str(number % 7))
+                         for number in range(300)]
+        server = LoadTest.FakeEventsServer(stored_events)
+        by_summary = lambda event: (event["summary"], Calendar.event_start(event))
+
+        with tempfile.TemporaryDirectory() as directory:
+            events = Streaming.fetch_events(server, start, start + datetime.timedelta(days=30), page_size=50)
+            ordered = Streaming.external_sort(Streaming.buffered(events, max_items=20), key=by_summary,
+                                              memory_ceiling=5000, directory=directory)
+            first = next(ordered)
+            self.assertEqual(first["id"], "e0")
+            spilled = os.listdir(directory)
+            self.assertEqual(len(spilled), 1)
+            self.assertGreater(len(os.listdir(os.path.join(directory, spilled[0]))), 1)
+
+            path = os.path.join(directory, "events.jsonl")
+            self.assertEqual(Streaming.export_jsonl(ordered, path), 299)
+            self.assertEqual(os.listdir(directory), ["events.jsonl"])
+            with open(path) as export:
+                exported = [first] + [json.loads(line) for line in export]
+            self.assertEqual([event["id"] for event in exported],
+                             [event["id"] for event in sorted(stored_events, key=by_summary)])
+
+        produced = []
+
+        def upstream():
+            for number in range(1000):
+                produced.append(number)
+                yield {"id": str(number)}
+
+        stream = Streaming.buffered(upstream(), max_items=10)
+        next(stream)
+        threading.Event().wait(0.3)
+        self.assertLessEqual(len(produced), 12)
+        stream.close()
+
+        with patch('sys.stdout', new=io.StringIO()) as output:
+            self.assertEqual(Streaming.print_event_stream(iter(stored_events[:2])), 2)
+        self.assertEqual(output.getvalue().splitlines()[1],
+                         "Events:  2 2020-01-01T01:00:00Z event 1 | Reminder:  0 minutes before")
+
+        # The --export option runs the pipeline over the window policy
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('Calendar.get_calendar_api', return_value=server), \
+                patch.dict(os.environ, {Calendar.WINDOW_POLICY_VARIABLE: "explicit:2020-01-02:2020-01-03"}), \
+                patch('sys.stdout', new=io.StringIO()) as output:
+            path = os.path.join(directory, "events.jsonl")
+            Calendar.main(["--export", path])
+            with open(path) as export:
+                exported = [json.loads(line)["id"] for line in export]
+        self.assertEqual(exported, ["e" + str(number) for number in range(24, 48)])
+        self.assertEqual(output.getvalue(), "24 events exported to " + path + "\n")
+
+    def test_shift_years_leap_day(self):
+        """
+        This test checks the default window of 29 February falls on 28 February of years without it.
+
+        Functions involved: sub_five_years(time_now), add_two_years(time_now), default_window(time_now)
+        """
+        time_now = datetime.datetime(2020, 2, 29, 12)
+        self.assertEqual(Calendar.sub_five_years(time_now), "2015-02-28T12:00:00Z")
+        self.assertEqual(Calendar.add_two_years(time_now), "2022-02-28T12:00:00Z")
+        self.assertEqual(Calendar.default_window(datetime.datetime(2021, 2, 28))[1], datetime.datetime(2023, 2, 28))
+        aware = datetime.datetime(2020, 3, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(Calendar.add_two_years(aware), "2022-03-01T00:00:00Z")
+
+    @unittest.skipIf(Calendar.get_time_zone("Australia/Melbourne") is datetime.timezone.utc,
+                     "no time zone database")
+    def test_navigate_events_time_zone(self):
+        """
+        This test navigates to a day in the calendar's time zone and checks a single query is issued, bounded by
+        the local midnights, including on the 25 hour day daylight saving time ends.
+
+        Functions involved: navigate_events(api, ..., time_zone), day_bounds(..., time_zone)
+        """
+        self.assertEqual(Calendar.day_bounds(2020, 1, 5, "Australia/Melbourne"),
+                         ("2020-01-04T13:00:00Z", "2020-01-05T13:00:00Z"))
+        self.assertEqual(Calendar.day_bounds(2020, 1, 5, "Not/A_Zone"), Calendar.day_bounds(2020, 1, 5))
+
+        mock_api = MagicMock()
+        Calendar.navigate_events(mock_api, 2020, 4, 5, time_zone="Australia/Melbourne")
+        self.assertEqual(mock_api.events.return_value.list.call_count, 1)
+        kwargs = mock_api.events.return_value.list.call_args.kwargs
+        self.assertEqual((kwargs["timeMin"], kwargs["timeMax"]), ("2020-04-04T13:00:00Z", "2020-04-05T14:00:00Z"))
+
+    def test_time_zone_fallback_warns(self):
+        """
+        This test checks a time zone that cannot be loaded falls back to UTC with a warning, issued once per name,
+        while UTC itself gives no warning.
+
+        Functions involved: get_time_zone(name)
+        """
+        Calendar.get_time_zone.cache_clear()
+        with self.assertWarns(RuntimeWarning):
+            self.assertIs(Calendar.get_time_zone("Not/A_Zone"), datetime.timezone.utc)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            self.assertIs(Calendar.get_time_zone("Not/A_Zone"), datetime.timezone.utc)
+            self.assertIs(Calendar.get_time_zone("UTC"), datetime.timezone.utc)
+
+    def test_change_journal(self):
+        """
+        This test journals changes at known times, reopens the journal, and checks point in time views, that they
+        replay from the last checkpoint before them, and that mutations and listings are journaled while journaling
+        is on.
+
+        Functions involved: ChangeJournal.record, ChangeJournal.observe, ChangeJournal.view_at,
+                            start_journal(path), stop_journal(), delete_event(api, event_id), fetch_event_page
+        """
+        start = datetime.datetime(2020, 1, 1)
+        epoch = lambda day: (start + datetime.timedelta(days=day)).replace(tzinfo=datetime.timezone.utc).timestamp()
+        events = [self.make_event("e" + str(number), start + datetime.timedelta(days=number),
+                                  start + datetime.timedelta(days=number, hours=1)) for number in range(5)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal.jsonl")
+            journal = Calendar.ChangeJournal(path, checkpoint_interval=3)
+            self.assertEqual(journal.observe(events, ts=epoch(0)), 5)
+            self.assertEqual(journal.observe(events, ts=epoch(1)), 0)
+            journal.record("e1", dict(events[1], summary="renamed"), ts=epoch(2))
+            journal.record("e2", None, ts=epoch(3))
+            journal.record("e3", dict(events[3], status="cancelled"), ts=epoch(4))
+            journal.close()
+            with open(path, "ab") as torn:
+                torn.write(b'{"ts": 1')
+
+            journal = Calendar.ChangeJournal(path, checkpoint_interval=3)
+            self.assertEqual(len(journal._checkpoints), 2)
+            ids = lambda when: [event["id"] for event in journal.view_at(start + datetime.timedelta(days=when))]
+            self.assertEqual(ids(-1), [])
+            self.assertEqual(ids(1), ["e0", "e1", "e2", "e3", "e4"])
+            self.assertEqual(journal.view_at(start + datetime.timedelta(days=2))[1]["summary"], "renamed")
+            self.assertEqual(ids(3), ["e0", "e1", "e3", "e4"])
+            self.assertEqual(ids(5), ["e0", "e1", "e4"])
+            self.assertEqual([event["id"] for event in journal.view_at()], ["e0", "e1", "e4"])
+            # The view after the second checkpoint only replays the records written since
+            self.assertEqual(journal._replay(epoch(5))[3], 2)
+
+            journal.close()
+
+            Calendar.start_journal(path, checkpoint_interval=3)
+            try:
+                Calendar.delete_event(MagicMock(), "e4")
+                # Every listing path journals the events it sees
+                server = LoadTest.FakeEventsServer([dict(events[0], summary="paged"),
+                                                    dict(events[1], summary="sharded"),
+                                                    dict(events[2], summary="queried")])
+                time_min, time_max = Calendar.to_rfc3339(start), Calendar.to_rfc3339(start + datetime.timedelta(1))
+                list(Calendar.iter_event_pages(server, time_min, time_max))
+                list(Calendar.stream_events_sharded(server, start + datetime.timedelta(1),
+                                                    start + datetime.timedelta(2)))
+                list(Calendar.query_events(server, {"time_min": start + datetime.timedelta(2),
+                                                    "time_max": start + datetime.timedelta(3)}))
+            finally:
+                journal = Calendar.stop_journal()
+            with open(path) as lines:
+                self.assertEqual([json.loads(line)["id"] for line in lines.readlines()[-4:]], ["e4", "e0", "e1", "e2"])
+            self.assertEqual([event["summary"] for event in journal.view_at()], ["paged", "sharded", "queried"])
+
+    def test_calendar_server(self):
+        """
+        This test runs the HTTP server over fake per user APIs and checks navigation, coalescing of concurrent
+        identical reads into one upstream request, streamed export, mutations, error statuses (an export refused
+        upstream included), and that requests without a valid API key are refused.
+
+        Functions involved: CalendarServer.CalendarServer, CalendarServer.ClientPool
+        """
+        start = datetime.datetime(2020, 10, 3)
+        stored_events = [self.make_event("e" + str(hour), start + datetime.timedelta(hours=hour),
+                                         start + datetime.timedelta(hours=hour, minutes=30))
+                         for hour in range(0, 48, 2)]
+        apis = {}
+
+        def factory(user):
+            apis[user] = LoadTest.FakeEventsServer(stored_events, latency=0.1)
+            if user == "revoked":
+                # Every upstream request is refused, e.g. the user revoked the app's access
+                forbidden = Exception("access revoked")
+                forbidden.resp = MagicMock(status=403)
+                apis[user] = MagicMock()
+                apis[user].events.return_value.list.return_value.execute.side_effect = forbidden
+            return apis[user]
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        keys = {"jane": "jane-key", "john": "john-key", "revoked": "revoked-key"}
+        authenticate = CalendarServer.bearer_authenticator({user: CalendarServer.hash_key(key)
+                                                            for user, key in keys.items()})
+        server = CalendarServer.CalendarServer(CalendarServer.ClientPool(factory), authenticate, port=0)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+
+        def request(method, path, body=None, key=keys["jane"]):
+            connection = http.client.HTTPConnection(server.host, server.port, timeout=10)
+            headers = {"Authorization": "Bearer " + key} if key else {}
+            connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            connection.close()
+            return response.status, data
+
+        try:
+            results = []
+            readers = [threading.Thread(target=lambda: results.append(request("GET", "/navigate?date=2020-10-03")))
+                       for _ in range(5)]
+            for reader in readers:
+                reader.start()
+            for reader in readers:
+                reader.join()
+            self.assertEqual({status for status, data in results}, {200})
+            self.assertEqual(len(json.loads(results[0][1])["events"]), 12)
+            self.assertEqual(apis["jane"].requests, 1)
+
+            status, data = request("GET", "/export?window=explicit:2020-10-01:2020-10-10")
+            self.assertEqual(status, 200)
+            self.assertEqual([json.loads(line)["id"] for line in data.splitlines()],
+                             [event["id"] for event in stored_events])
+
+            status, data = request("POST", "/events", {"summary": "new", "start": {"date": "2020-10-03"},
+                                                       "end": {"date": "2020-10-04"}})
+            self.assertEqual(status, 201)
+            new_id = json.loads(data)["id"]
+            status, data = request("PATCH", "/events/" + new_id, {"summary": "renamed", "reminder_minutes": 15})
+            self.assertEqual((status, json.loads(data)["summary"]), (200, "renamed"))
+            self.assertEqual(request("DELETE", "/events/e0")[0], 204)
+            status, data = request("GET", "/navigate?date=2020-10-03")
+            self.assertEqual(len(json.loads(data)["events"]), 12)
+            self.assertNotIn("e0", [event["id"] for event in json.loads(data)["events"]])
+
+            self.assertEqual(request("DELETE", "/events/e0")[0], 410)
+            self.assertEqual(request("GET", "/navigate?date=2020-13-03")[0], 400)
+            self.assertEqual(request("GET", "/nowhere")[0], 404)
+            self.assertEqual(request("GET", "/navigate?date=2020-10-03", key=None)[0], 401)
+            self.assertEqual(request("GET", "/navigate?date=2020-10-03", key="jane")[0], 401)
+            self.assertEqual(request("GET", "/navigate?date=2020-10-03", key=keys["john"])[0], 200)
+            self.assertEqual((sorted(apis), apis["john"].requests), (["jane", "john"], 1))
+            # An export refused upstream gets the upstream status, not a 200 cut short
+            status, data = request("GET", "/export?window=explicit:2020-10-01:2020-10-10", key=keys["revoked"])
+            self.assertEqual((status, json.loads(data)), (403, {"error": "access revoked"}))
+        finally:
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    @unittest.skipUnless(importlib.util.find_spec("googleapiclient") and
+                         importlib.util.find_spec("google_auth_httplib2"),
+                         "googleapiclient or google_auth_httplib2 is not installed")
+    def test_calendar_server_credentials(self):
+        """
+        This test serves two users from a single worker thread through the real googleapiclient request path and
+        checks every upstream request carries the bearer token of the user it is made for.
+
+        Functions involved: CalendarServer.CalendarServer, execute_request(request)
+        """
+        from googleapiclient.discovery import build
+        from google.oauth2.credentials import Credentials
+        from google_auth_httplib2 import AuthorizedHttp
+        import httplib2
+
+        seen = []
+        make_event = self.make_event
+
+        class TokenTransport:
+            """
+            httplib2.Http stand-in answering every listing with one event named after the request's bearer token.
+            """
+
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+                token = (headers or {}).get("authorization", "").split()[-1]
+                seen.append((token, urlsplit(uri).path))
+                event = make_event(token, datetime.datetime(2020, 10, 3, 9), datetime.datetime(2020, 10, 3, 10),
+                                   token)
+                response = httplib2.Response({"status": "200", "content-type": "application/json"})
+                return response, json.dumps({"items": [event]}).encode("utf-8")
+
+        def factory(user):
+            http = AuthorizedHttp(Credentials(user.upper()), http=TokenTransport())
+            return build('calendar', 'v3', http=http, static_discovery=True)
+
+        keys = {"jane": "jane-key", "john": "john-key"}
+        authenticate = CalendarServer.bearer_authenticator({user: CalendarServer.hash_key(key)
+                                                            for user, key in keys.items()})
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        # One worker, so both users' requests run on the same thread
+        server = CalendarServer.CalendarServer(CalendarServer.ClientPool(factory), authenticate, port=0, workers=1)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+
+        def request(path, user):
+            connection = http.client.HTTPConnection(server.host, server.port, timeout=10)
+            connection.request("GET", path, headers={"Authorization": "Bearer " + keys[user]})
+            response = connection.getresponse()
+            data = response.read()
+            connection.close()
+            return response.status, data
+
+        try:
+            with patch('httplib2.Http', TokenTransport):
+                # Days not read before, so every read goes upstream
+                for day, user in ((3, "jane"), (3, "john"), (4, "jane")):
+                    status, data = request("/navigate?date=2020-10-0" + str(day), user)
+                    self.assertEqual(status, 200)
+                    self.assertEqual([event["summary"] for event in json.loads(data)["events"]], [user.upper()])
+                status, data = request("/export?window=explicit:2020-10-01:2020-10-10", "john")
+                self.assertEqual((status, [json.loads(line)["id"] for line in data.splitlines()]), (200, ["JOHN"]))
+        finally:
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.assertEqual([token for token, path in seen], ["JANE", "JOHN", "JANE", "JOHN"])
+
+    def test_client_pool_single_flight(self):
+        """
+        This test builds the client of a user slowly and checks other users are served meanwhile, that
+        concurrent first requests of the same user share one build, and that users without a token are refused.
+
+        Functions involved: CalendarServer.ClientPool.get(user), CalendarServer.token_directory_factory(directory)
+        """
+        release = threading.Event()
+        built = []
+
+        def factory(user):
+            built.append(user)
+            if user == "slow":
+                release.wait(5)
+            return MagicMock(name=user)
+
+        pool = CalendarServer.ClientPool(factory)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(pool.get("slow"))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while not built:
+            threading.Event().wait(0.01)
+        # Not blocked behind the slow build
+        quick = threading.Thread(target=pool.get, args=("quick",))
+        quick.start()
+        quick.join(2)
+        self.assertFalse(quick.is_alive())
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(built), ["quick", "slow"])
+        self.assertEqual(len({id(client) for client in results}), 1)
+        self.assertIs(pool.get("slow"), results[0])
+
+        # Users without a token from --login are refused, names never leave the token directory
+        with tempfile.TemporaryDirectory() as directory:
+            factory = CalendarServer.token_directory_factory(directory)
+            with self.assertRaises(CalendarServer.HttpProblem) as refused:
+                factory("jane")
+            self.assertEqual(refused.exception.status, 403)
+            self.assertRaises(ValueError, factory, "../jane")
+
+    def test_find_duplicates(self):
+        """
+        This test finds exact and near duplicates among events, checks back to back events and chains of matches
+        are not grouped, plans their cleanup keeping the event created first, and deletes the duplicates in batches.
+
+        Functions involved: Dedup.find_duplicates(events), Dedup.plan_cleanup(groups), Dedup.execute_cleanup(api, plan),
+                            delete_events(api, event_ids)
+        """
+        start = datetime.datetime(2020, 1, 6, 9)
+        hour = datetime.timedelta(hours=1)
+        team = [{"email": "jane@example.com"}, {"email": "john@example.com"}]
+
+        def event(event_id, summary, offset=datetime.timedelta(), attendees=team, created="2020-01-01"):
+            made = self.make_event(event_id, start + offset, start + offset + hour, summary)
+            made.update(attendees=attendees, created=created)
+            return made
+
+        events = [
+            event("a1", "Team standup", created="2020-01-02"),
+            event("a2", "team  standup", created="2020-01-01"),
+            event("a3", "Copy of Team Standup (2)", datetime.timedelta(minutes=5), created="2020-01-03"),
+            event("a4", "Team standup", datetime.timedelta(days=1)),
+            event("b1", "Quarterly planning review", hour * 3),
+            event("b2", "Quarterly planning review!", hour * 3, [{"email": "JANE@example.com"},
+                                                                  {"email": "john@example.com"}]),
+            event("c1", "Quarterly planning review", hour * 3, [{"email": "someone@example.com"}]),
+            event("d1", "Café sync", hour * 5),
+            event("d2", "cafe sync", hour * 5),
+            dict(event("d3", "Cafe sync", hour * 5), status="cancelled"),
+        ]
+        self.assertEqual(Dedup.normalize_summary("Copy of  Café: Sync (2)"), "cafe sync")
+
+        groups = Dedup.find_duplicates(events)
+        self.assertEqual([[member["id"] for member in group] for group in groups],
+                         [["a1", "a2", "a3"], ["b1", "b2"], ["d1", "d2"]])
+
+        # Back to back slots with the same summary and attendee are not duplicates of each other
+        slots = [event("s" + str(number), "Interview slot", datetime.timedelta(days=2, minutes=15 * number),
+                       [{"email": "recruiter@example.com"}]) for number in range(5)]
+        for slot in slots:
+            slot["end"] = {"dateTime": Calendar.to_rfc3339(Calendar.event_start(slot) +
+                                                           datetime.timedelta(minutes=15))}
+        self.assertEqual(Dedup.find_duplicates(slots), [])
+        # Matches do not chain: x3 is 10 minutes from x2 but 20 from x1, the event kept
+        chain = [event("x" + str(number), "Design review", datetime.timedelta(days=3, minutes=10 * number),
+                       created="2020-01-0" + str(number)) for number in range(1, 4)]
+        self.assertEqual([[member["id"] for member in group] for group in Dedup.find_duplicates(chain)],
+                         [["x1", "x2"]])
+
+        plan = Dedup.plan_cleanup(groups, batch_size=2)
+        self.assertEqual(plan["keep"], {"a2": ["a1", "a3"], "b1": ["b2"], "d1": ["d2"]})
+        self.assertEqual(plan["batches"], [["a1", "a3"], ["b2", "d2"]])
+
+        server = LoadTest.FakeEventsServer(events)
+        server.call_now(server._delete, {"calendarId": "primary", "eventId": "d2"}, {})
+        self.assertEqual(Dedup.execute_cleanup(server, plan), {})
+        self.assertEqual(sorted(server.event_ids()), ["a2", "a4", "b1", "c1", "d1", "d3"])
+        self.assertEqual(list(Calendar.delete_events(server, ["a4", "missing"])), [])
+        # 1 direct delete, then 3 batch round trips, each counted once, plus the 6 deletions inside them
+        self.assertEqual(server.requests, 10)
+
 
 def main():
     # Create the test suite from the cases above.
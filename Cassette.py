@@ -0,0 +1,232 @@
+# Record/replay transport for the Google Calendar API.
+#
+# A CassetteHttp stands in for the httplib2 connection googleapiclient sends its requests through. In record mode
+# it forwards every request to a real connection and keeps the exchange; save() writes them to a cassette file.
+# In replay mode it answers from the cassette without any network, so the real googleapiclient request path
+# (discovery, pagination, batch parsing, HttpError) runs against recorded payloads in milliseconds.
+#
+# Requests are matched on method, URI (query parameters sorted) and body. Request headers are never recorded,
+# so cassettes hold no credentials. The same request recorded several times is replayed in recorded order, and
+# the last recording keeps being served once they run out, e.g. when a benchmark repeats get_all_events.
+from __future__ import print_function
+import base64
+import json
+import re
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import Calendar
+
+RECORD = "record"
+REPLAY = "replay"
+CASSETTE_VERSION = 1
+# Response headers left out of cassettes
+_SKIPPED_HEADERS = {"set-cookie", "date", "expires", "server", "alt-svc"}
+# Content-ID headers of batch requests embed a random uuid before the part number
+_CONTENT_ID = re.compile(r"<[0-9a-fA-F-]+\+")
+
+
+class CassetteError(Exception):
+    """
+    Raised when a replayed request was not recorded in the cassette.
+    """
+
+
+class CassetteResponse(dict):
+    """
+    Response headers with the status and reason attributes googleapiclient reads from httplib2.Response.
+    """
+
+    def __init__(self, status, reason, headers):
+        super().__init__(headers)
+        self.status = status
+        self.reason = reason
+        self["status"] = str(status)
+
+
+def _encode(content):
+    if content is None:
+        return None
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    try:
+        return {"text": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(content).decode("ascii")}
+
+
+def _decode(stored):
+    if stored is None:
+        return b""
+    if "base64" in stored:
+        return base64.b64decode(stored["base64"])
+    return stored["text"].encode("utf-8")
+
+
+def _normalize_uri(uri):
+    parts = urlsplit(uri)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))
+
+
+def _normalize_body(body, headers):
+    """
+    Return a body comparable between runs: JSON with sorted keys, batch bodies without their random boundary
+    and Content-ID prefixes.
+    """
+    if body is None:
+        return ""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    content_type = ""
+    for name, value in (headers or {}).items():
+        if name.lower() == "content-type":
+            content_type = value
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type)
+    if boundary:
+        body = body.replace(boundary.group(1), "BOUNDARY")
+        return _CONTENT_ID.sub("<+", body)
+    try:
+        return json.dumps(json.loads(body), sort_keys=True)
+    except ValueError:
+        return body
+
+
+def request_key(method, uri, body=None, headers=None):
+    """
+    Return the key a request is matched on.
+
+    @param method: HTTP method
+    @type method: String
+    @param uri: Request URI
+    @type uri: String
+    @param body: Request body
+    @type body: String or bytes
+    @param headers: Request headers, only the content type is used
+    @type headers: dict
+    @return: String
+    """
+    return "\n".join((method.upper(), _normalize_uri(uri), _normalize_body(body, headers)))
+
+
+class CassetteHttp:
+    """
+    httplib2.Http stand-in recording to or replaying from a cassette file, see the module comment.
+    """
+
+    def __init__(self, path, mode=REPLAY, http=None):
+        """
+        @param path: The cassette file
+        @type path: String
+        @param mode: RECORD or REPLAY
+        @type mode: String
+        @param http: The connection requests are forwarded to when recording, e.g. an AuthorizedHttp
+        @type http: httplib2.Http
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"mode must be {RECORD!r} or {REPLAY!r}")
+        if mode == RECORD and http is None:
+            raise ValueError("Recording needs the http connection to record from.")
+        self.path = path
+        self.mode = mode
+        self._http = http
+        self._lock = threading.Lock()
+        self._interactions = []
+        self._served = {}
+        self.requests = 0
+        if mode == REPLAY:
+            with open(path) as cassette:
+                data = json.load(cassette)
+            if data.get("version") != CASSETTE_VERSION:
+                raise CassetteError(path + " has an unsupported cassette version")
+            self._interactions = data["interactions"]
+        self._recorded = {}
+        for interaction in self._interactions:
+            self._recorded.setdefault(interaction["key"], []).append(interaction["response"])
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        """
+        Answer a request the way httplib2.Http.request does.
+
+        @return: (response, content)
+        @raise CassetteError: when replaying a request that is not in the cassette
+        """
+        key = request_key(method, uri, body, headers)
+        with self._lock:
+            self.requests += 1
+            if self.mode == RECORD:
+                response, content = self._http.request(uri, method=method, body=body, headers=headers,
+                                                       redirections=redirections, connection_type=connection_type)
+                stored = {"status": int(response.status), "reason": getattr(response, "reason", ""),
+                          "headers": {name: value for name, value in response.items()
+                                      if name.lower() not in _SKIPPED_HEADERS and name != "status"},
+                          "body": _encode(content)}
+                self._interactions.append({"key": key, "response": stored})
+                self._recorded.setdefault(key, []).append(stored)
+                return response, content
+
+            responses = self._recorded.get(key)
+            if not responses:
+                raise CassetteError("No recorded response for " + method + " " + uri)
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            stored = responses[min(served, len(responses) - 1)]
+        return CassetteResponse(stored["status"], stored["reason"], stored["headers"]), _decode(stored["body"])
+
+    def rewind(self):
+        """
+        Replay the cassette from its first recording again.
+        @return: No return
+        """
+        with self._lock:
+            self._served = {}
+
+    def save(self):
+        """
+        Write the recorded exchanges to the cassette file, replacing it atomically.
+        @return: Number of exchanges written
+        """
+        with self._lock:
+            interactions = list(self._interactions)
+        with Calendar.atomic_write(self.path, ".cassette-") as cassette:
+            json.dump({"version": CASSETTE_VERSION, "interactions": interactions}, cassette, indent=1, sort_keys=True)
+        return len(interactions)
+
+
+def build_api(http):
+    """
+    Build the calendar API on top of a CassetteHttp (or any httplib2.Http like connection).
+
+    @param http: The connection the requests are sent through
+    @type http: CassetteHttp
+    @return: googleapiclient.discovery.build
+    """
+    from googleapiclient.discovery import build
+
+    return build('calendar', 'v3', http=http, static_discovery=True)
+
+
+def recording_api(path):
+    """
+    Return (api, cassette): the calendar API of the logged in user, recording every exchange to cassette.
+    Call cassette.save() once done.
+
+    @param path: The cassette file
+    @type path: String
+    """
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+
+    cassette = CassetteHttp(path, RECORD, AuthorizedHttp(Calendar.get_credentials(), http=httplib2.Http()))
+    return build_api(cassette), cassette
+
+
+def replaying_api(path):
+    """
+    Return (api, cassette): a calendar API answering from a recorded cassette, without network or credentials.
+
+    @param path: The cassette file
+    @type path: String
+    """
+    cassette = CassetteHttp(path, REPLAY)
+    return build_api(cassette), cassette
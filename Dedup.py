@@ -0,0 +1,180 @@
+# Duplicate and near duplicate event detection.
+#
+# Duplicates are found in two passes, both close to linear in the number of events:
+#  - exact duplicates share a hash key of normalised summary, start, end and attendees, and are grouped in a dict;
+#  - near duplicates are only compared within blocks: events starting in the same or a neighbouring window of
+#    tolerance seconds that share one of the first tokens of their summary (prefix filtering, tokens taken rarest
+#    first). Two events sharing no such token cannot reach the summary similarity, so they are never compared.
+#    Candidates are duplicates when their time intervals overlap, both their starts and their ends are within
+#    tolerance of each other, and both their summary tokens and their attendees have a Jaccard similarity of at
+#    least similarity. Back to back events, such as a series of interview slots, never overlap.
+# Matching is not transitive, so groups are not closed over chains of matches: events are taken in the order
+# plan_cleanup keeps them in, and each event not grouped yet forms a group with the events matching it directly.
+# Every duplicate in a group therefore matches the event that is kept. plan_cleanup keeps one event per group and
+# lists the others in batches for Calendar.delete_events.
+from __future__ import print_function
+import functools
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+import Calendar
+
+# Seconds between the starts of two events that can still be duplicates
+DUPLICATE_TOLERANCE = 15 * 60
+# Jaccard similarity of summary tokens and of attendees from which events are duplicates
+SUMMARY_SIMILARITY = 0.8
+# Copy markers added by imports and copies, e.g. "Copy of Standup (2)"
+_COPY_MARKERS = re.compile(r"^(copy of )+|( \(\d+\)| copy)+$")
+_NOT_WORD = re.compile(r"[\W_]+")
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_summary(summary):
+    """
+    Return a summary reduced to what tells events apart: case folded, accents and punctuation removed, blanks
+    collapsed, and copy markers such as "Copy of" or " (2)" dropped. Results are cached, as duplicates share
+    their summaries.
+
+    @param summary: The summary of an event
+    @type summary: String
+    @return: String
+    """
+    text = summary or ""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(character for character in text if not unicodedata.combining(character))
+    text = " ".join(text.casefold().split())
+    text = _COPY_MARKERS.sub("", text)
+    return " ".join(_NOT_WORD.sub(" ", text).split())
+
+
+def _attendees(event):
+    return frozenset((person.get("email") or "").lower() for person in event.get("attendees", [])
+                     if person.get("email"))
+
+
+def _jaccard(first, second):
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+def _overlap(first_start, first_end, second_start, second_end):
+    # Events without duration overlap the events starting at the same time
+    return first_start < second_end and second_start < first_end or first_start == second_start
+
+
+def _keep_order(event):
+    # The original is the event created first; events without a creation time are kept last
+    return event.get("created") or "\uffff", event.get("id", "")
+
+
+def find_duplicates(events, tolerance=DUPLICATE_TOLERANCE, similarity=SUMMARY_SIMILARITY):
+    """
+    Group the events that are duplicates of each other, see the module comment. Cancelled events are ignored.
+
+    @param events: an array of events
+    @type events: array
+    @param tolerance: Seconds between the starts, and between the ends, of two events that can still be
+                      duplicates
+    @type tolerance: Integer
+    @param similarity: Jaccard similarity of summary tokens and of attendees from which events are duplicates
+    @type similarity: float
+    @return: list of groups, each a list of at least 2 events in the order of events; groups are ordered by
+             their first event
+    """
+    events = [event for event in events if event.get("status") != "cancelled"]
+    starts = [Calendar.event_start(event).timestamp() for event in events]
+    ends = [Calendar.event_end(event).timestamp() for event in events]
+    summaries = [normalize_summary(event.get("summary")) for event in events]
+    attendees = [_attendees(event) for event in events]
+
+    # Exact pass: identical keys are duplicates, only the first event of a key goes on to the near pass
+    first_of_key = {}
+    # representative -> the events sharing its key, itself included
+    members = defaultdict(list)
+    for index, event in enumerate(events):
+        key = (summaries[index], starts[index], ends[index], attendees[index])
+        members[first_of_key.setdefault(key, index)].append(index)
+    representatives = list(members)
+    representative_of = {index: first for first, indexes in members.items() for index in indexes}
+
+    # Near pass over the representatives, blocked by start window and summary prefix tokens
+    tokens = {index: frozenset(summaries[index].split()) for index in representatives}
+    matches = defaultdict(list)
+    frequency = Counter(token for index in representatives for token in tokens[index])
+    blocks = defaultdict(list)
+    for index in sorted(representatives, key=starts.__getitem__):
+        if not tokens[index]:
+            continue
+        ordered = sorted(tokens[index], key=lambda token: (frequency[token], token))
+        prefix = ordered[:len(ordered) - math.ceil(similarity * len(ordered)) + 1]
+        window = int(starts[index] // tolerance) if tolerance else int(starts[index])
+        candidates = set()
+        for token in prefix:
+            for neighbour in (window - 1, window, window + 1):
+                candidates.update(blocks.get((neighbour, token), ()))
+        for other in candidates:
+            if (abs(starts[index] - starts[other]) <= tolerance
+                    and abs(ends[index] - ends[other]) <= tolerance
+                    and _overlap(starts[index], ends[index], starts[other], ends[other])
+                    and _jaccard(tokens[index], tokens[other]) >= similarity
+                    and _jaccard(attendees[index], attendees[other]) >= similarity):
+                matches[index].append(other)
+                matches[other].append(index)
+        for token in prefix:
+            blocks[(window, token)].append(index)
+
+    # Group every event with the events matching it directly, in the order plan_cleanup keeps them in
+    grouped = set()
+    groups = []
+    for index in sorted(range(len(events)), key=lambda index: _keep_order(events[index])):
+        if index in grouped:
+            continue
+        first = representative_of[index]
+        group = [index]
+        for representative in [first] + matches[first]:
+            group.extend(other for other in members[representative] if other != index and other not in grouped)
+        if len(group) > 1:
+            grouped.update(group)
+            groups.append(sorted(group))
+    return [[events[index] for index in group] for group in sorted(groups)]
+
+
+def plan_cleanup(groups, batch_size=Calendar.BATCH_SIZE):
+    """
+    Plan the removal of duplicates: the event created first in every group is kept, the others are deleted.
+
+    @param groups: The groups of find_duplicates
+    @type groups: list
+    @param batch_size: Number of deletions per batch request
+    @type batch_size: Integer
+    @return: dict with 'keep' (event id -> ids of its duplicates), 'delete' (ids to delete) and 'batches' (the
+             ids to delete split by batch_size)
+    """
+    keep = {}
+    delete = []
+    for group in groups:
+        original, *duplicates = sorted(group, key=_keep_order)
+        keep[original["id"]] = [event["id"] for event in duplicates]
+        delete.extend(keep[original["id"]])
+    batches = [delete[first:first + batch_size] for first in range(0, len(delete), batch_size)]
+    return {"keep": keep, "delete": delete, "batches": batches}
+
+
+def execute_cleanup(api, plan):
+    """
+    Delete the duplicates of a cleanup plan, one batch request per planned batch.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param plan: The plan of plan_cleanup
+    @type plan: dict
+    @return: dict event id -> the error of the events that could not be deleted
+    """
+    errors = {}
+    for batch in plan["batches"]:
+        errors.update(Calendar.delete_events(api, batch, batch_size=len(batch)))
+    return errors
@@ -0,0 +1,438 @@
+# Load and soak test harness for the Calendar functions.
+# Drives a mixed workload of list, search, navigate, edit, cancel and delete against a local fake of the
+# Google Calendar events API, with configurable latency and error injection, and reports throughput,
+# p50/p99 latency per operation and memory growth over time.
+#
+# Usage: python LoadTest.py --duration 30 --workers 16 --events 5000 --latency 0.005 --error-rate 0.01
+from __future__ import print_function
+import argparse
+import datetime
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import Calendar
+
+# Relative weight of every operation in the default workload
+DEFAULT_MIX = {"list": 30, "search": 20, "navigate": 25, "edit": 15, "cancel": 5, "delete": 5}
+# Seconds between two memory samples
+MEMORY_SAMPLE_INTERVAL = 1.0
+
+
+class FakeHttpError(Exception):
+    """
+    Error raised by the fake server, shaped like googleapiclient.errors.HttpError (status in resp.status).
+    """
+
+    def __init__(self, status):
+        super().__init__("HTTP " + str(status))
+        self.resp = type("Response", (), {"status": status})()
+
+
+class FakeRequest:
+    """
+    A request of the fake API. Like googleapiclient.http.HttpRequest it runs when execute() is called.
+    """
+
+    def __init__(self, server, handler, kwargs):
+        self.server = server
+        self.handler = handler
+        self.kwargs = kwargs
+        self.headers = {}
+
+    def execute(self, http=None):
+        return self.server.call(self.handler, self.kwargs, self.headers)
+
+
+class FakeEventsServer:
+    """
+    In memory stand-in for the Calendar API with injected latency and errors. Shaped like the object returned by
+    get_calendar_api(), so it can be passed as api to the Calendar functions.
+    """
+
+    def __init__(self, events=None, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        """
+        @param events: Initial events
+        @type events: list
+        @param latency: Seconds every request takes
+        @type latency: float
+        @param jitter: Up to this many extra seconds are added at random to every request
+        @type jitter: float
+        @param error_rate: Fraction of requests failing with a 503
+        @type error_rate: float
+        @param seed: Seed of the random latency and errors
+        @type seed: Integer
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._events = {}
+        for event in events or []:
+            self._store(event)
+
+    def _store(self, event):
+        event = dict(event)
+        event.setdefault("id", uuid.uuid4().hex)
+        event["etag"] = '"' + uuid.uuid4().hex + '"'
+        self._events[event["id"]] = event
+        return event
+
+    def call(self, handler, kwargs, headers):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.random() * self.jitter
+            failed = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise FakeHttpError(503)
+        with self._lock:
+            if "eventId" in kwargs and headers.get("If-Match"):
+                event = self._events.get(kwargs["eventId"])
+                if event is not None and event["etag"] != headers["If-Match"]:
+                    raise FakeHttpError(412)
+            return handler(**kwargs)
+
+    def call_now(self, handler, kwargs, headers):
+        """
+        Serve a request without injected latency, as a part of a batch.
+        """
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+        if failed:
+            raise FakeHttpError(503)
+        with self._lock:
+            return handler(**kwargs)
+
+    def events(self):
+        return _FakeEventsResource(self)
+
+    def calendarList(self):
+        return _FakeCalendarListResource(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    # Handlers, run with the server lock held
+
+    def _list(self, calendarId, timeMin, timeMax, maxResults=250, q="", pageToken=None, showDeleted=False,
+              updatedMin=None, privateExtendedProperty=(), sharedExtendedProperty=(), **params):
+        time_min = Calendar.parse_rfc3339(timeMin)
+        time_max = Calendar.parse_rfc3339(timeMax)
+        matching = [event for event in self._events.values()
+                    if Calendar.event_end(event) > time_min and Calendar.event_start(event) < time_max
+                    and all(term.lower() in self._searchable(event) for term in (q or "").split())
+                    and (showDeleted or event.get("status") != "cancelled")
+                    and (updatedMin is None or event.get("updated", "") >= updatedMin)
+                    and self._has_properties(event, "private", privateExtendedProperty)
+                    and self._has_properties(event, "shared", sharedExtendedProperty)]
+        matching.sort(key=Calendar.event_start)
+        offset = int(pageToken or 0)
+        result = {"items": [dict(event) for event in matching[offset:offset + maxResults]]}
+        if offset + maxResults < len(matching):
+            result["nextPageToken"] = str(offset + maxResults)
+        return result
+
+    @staticmethod
+    def _searchable(event):
+        people = [event.get("organizer") or {}] + event.get("attendees", [])
+        texts = [event.get("summary", ""), event.get("description", ""), event.get("location", "")]
+        texts += [person.get("email", "") for person in people]
+        return " ".join(texts).lower()
+
+    @staticmethod
+    def _has_properties(event, scope, wanted):
+        properties = (event.get("extendedProperties") or {}).get(scope, {})
+        return all(properties.get(name) == value for name, _, value in (item.partition("=") for item in wanted))
+
+    def _get(self, calendarId, eventId):
+        if eventId not in self._events:
+            raise FakeHttpError(404)
+        return dict(self._events[eventId])
+
+    def _update(self, calendarId, eventId, body):
+        if eventId not in self._events:
+            raise FakeHttpError(404)
+        return dict(self._store(dict(body, id=eventId)))
+
+    def _patch(self, calendarId, eventId, body):
+        if eventId not in self._events:
+            raise FakeHttpError(404)
+        return dict(self._store(dict(self._events[eventId], **body)))
+
+    def _delete(self, calendarId, eventId):
+        if self._events.pop(eventId, None) is None:
+            raise FakeHttpError(410)
+        return ""
+
+    def _insert(self, calendarId, body):
+        return dict(self._store(body))
+
+    def event_ids(self):
+        with self._lock:
+            return list(self._events)
+
+
+class FakeBatch:
+    """
+    A batch request of the fake API. Like googleapiclient.http.BatchHttpRequest it runs the added requests on
+    execute() and reports each result to the callback; the whole batch counts as one request for latency.
+    """
+
+    def __init__(self, server, callback=None):
+        self.server = server
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests))))
+
+    def execute(self, http=None):
+        # One round trip for the whole batch, then the parts are served without extra latency
+        self.server.call(lambda: None, {}, {})
+        for request, callback, request_id in self.requests:
+            try:
+                response, exception = request.server.call_now(request.handler, request.kwargs, request.headers), None
+            except FakeHttpError as error:
+                response, exception = None, error
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class _FakeEventsResource:
+    def __init__(self, server):
+        self.server = server
+
+    def list(self, **kwargs):
+        return FakeRequest(self.server, self.server._list, kwargs)
+
+    def get(self, **kwargs):
+        return FakeRequest(self.server, self.server._get, kwargs)
+
+    def update(self, **kwargs):
+        return FakeRequest(self.server, self.server._update, kwargs)
+
+    def patch(self, **kwargs):
+        return FakeRequest(self.server, self.server._patch, kwargs)
+
+    def delete(self, **kwargs):
+        return FakeRequest(self.server, self.server._delete, kwargs)
+
+    def insert(self, **kwargs):
+        return FakeRequest(self.server, self.server._insert, kwargs)
+
+
+class _FakeCalendarListResource:
+    def __init__(self, server):
+        self.server = server
+
+    def get(self, **kwargs):
+        return FakeRequest(self.server, lambda calendarId: {
+            "defaultReminders": [{"method": "popup", "minutes": 10}],
+            "timeZone": "UTC",
+            "accessRole": "owner"
+        }, kwargs)
+
+
+def generate_events(count, time_now, seed=None):
+    """
+    Generate count one hour events spread over the window get_all_events looks at.
+
+    @param count: Number of events
+    @type count: Integer
+    @param time_now: The current time in UTC
+    @type time_now: datetime class object
+    @return: list of events
+    """
+    generator = random.Random(seed)
+    window_start = time_now - datetime.timedelta(days=5 * 365)
+    window_seconds = 7 * 365 * 24 * 3600
+    words = ["standup", "review", "lunch", "planning", "retro", "interview", "demo", "sync"]
+    events = []
+    for number in range(count):
+        start = window_start + datetime.timedelta(seconds=generator.randrange(window_seconds))
+        events.append({
+            "id": "load" + str(number),
+            "summary": generator.choice(words) + " " + str(number),
+            "start": {"dateTime": Calendar.to_rfc3339(start)},
+            "end": {"dateTime": Calendar.to_rfc3339(start + datetime.timedelta(hours=1))},
+            "reminders": {"useDefault": True},
+            "status": "confirmed"
+        })
+    return events
+
+
+def _run_operation(api, operation, time_now, generator):
+    """
+    Run one operation of the workload through the Calendar functions and return the seconds it took. Picking the
+    event and putting a deleted event back are not counted.
+    """
+    started = time.perf_counter()
+    if operation == "list":
+        Calendar.get_all_events(api, time_now)
+    elif operation == "search":
+        Calendar.search_all_events(api, time_now, generator.choice(["standup", "review", "demo"]))
+    elif operation == "navigate":
+        day = time_now - datetime.timedelta(days=generator.randrange(-700, 1800))
+        Calendar.navigate_events(api, day.year, day.month, day.day)
+    else:
+        event_ids = api.event_ids()
+        if not event_ids:
+            return 0.0
+        event_id = generator.choice(event_ids)
+        if operation == "delete":
+            event = api.events().get(calendarId='primary', eventId=event_id).execute()
+            started = time.perf_counter()
+            Calendar.delete_event(api, event_id)
+            elapsed = time.perf_counter() - started
+            # Put it back so the calendar keeps its size during a soak test
+            api.events().insert(calendarId='primary', body=event).execute()
+            return elapsed
+        started = time.perf_counter()
+        if operation == "edit":
+            Calendar.edit_event(api, event_id, "edited " + event_id, False)
+        elif operation == "cancel":
+            Calendar.cancel_event(api, event_id)
+    return time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which the given fraction of the sorted values lies.
+
+    @param values: sorted list of numbers
+    @type values: list
+    @param fraction: e.g. 0.99
+    @type fraction: float
+    @return: the percentile, 0 for an empty list
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_load(api, duration, workers=8, mix=None, time_now=None, seed=None):
+    """
+    Drive the workload with workers threads for duration seconds.
+
+    @param api: The API to load, e.g. a FakeEventsServer
+    @param duration: Seconds to run
+    @type duration: float
+    @param workers: Number of concurrent clients
+    @type workers: Integer
+    @param mix: dict operation -> relative weight, DEFAULT_MIX when None
+    @type mix: dict
+    @param time_now: The current time in UTC the operations are relative to
+    @type time_now: datetime class object
+    @return: dict with per operation latencies and errors, the elapsed time and memory samples
+    """
+    mix = mix or DEFAULT_MIX
+    time_now = time_now or datetime.datetime.utcnow()
+    operations, weights = list(mix), list(mix.values())
+    latencies = {operation: [] for operation in operations}
+    errors = {operation: 0 for operation in operations}
+    memory = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def client(number):
+        generator = random.Random(None if seed is None else seed + number)
+        while not stop.is_set():
+            operation = generator.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                elapsed = _run_operation(api, operation, time_now, generator)
+                failed = False
+            except Exception:
+                elapsed = time.perf_counter() - started
+                failed = True
+            with lock:
+                latencies[operation].append(elapsed)
+                if failed:
+                    errors[operation] += 1
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for number in range(workers):
+                executor.submit(client, number)
+            while time.perf_counter() - started < duration:
+                current, peak = tracemalloc.get_traced_memory()
+                memory.append((time.perf_counter() - started, current, peak))
+                stop.wait(min(MEMORY_SAMPLE_INTERVAL, max(0.0, duration - (time.perf_counter() - started))))
+            stop.set()
+        current, peak = tracemalloc.get_traced_memory()
+        memory.append((time.perf_counter() - started, current, peak))
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    return {"elapsed": time.perf_counter() - started, "latencies": latencies, "errors": errors, "memory": memory}
+
+
+def print_report(result):
+    """
+    Print throughput, p50/p99 latency and errors per operation, and the memory growth over the run.
+
+    @param result: The result of run_load
+    @type result: dict
+    @return: No return
+    """
+    elapsed = result["elapsed"]
+    total = sum(len(values) for values in result["latencies"].values())
+    print("Ran %d operations in %.1f s: %.1f ops/s" % (total, elapsed, total / elapsed if elapsed else 0))
+    print("%-10s %8s %10s %10s %10s %8s" % ("operation", "count", "ops/s", "p50 ms", "p99 ms", "errors"))
+    for operation, values in result["latencies"].items():
+        values = sorted(values)
+        print("%-10s %8d %10.1f %10.2f %10.2f %8d" % (operation, len(values), len(values) / elapsed if elapsed else 0,
+                                                     percentile(values, 0.5) * 1000,
+                                                     percentile(values, 0.99) * 1000, result["errors"][operation]))
+    print("Memory over time (traced allocations):")
+    for at, current, peak in result["memory"]:
+        print("  %6.1f s  current %8.1f KiB  peak %8.1f KiB" % (at, current / 1024, peak / 1024))
+    if len(result["memory"]) > 1:
+        growth = result["memory"][-1][1] - result["memory"][0][1]
+        print("Memory growth: %.1f KiB" % (growth / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and soak test the Calendar functions against a fake API.")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--events", type=int, default=1000, help="events in the fake calendar")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds every request takes")
+    parser.add_argument("--jitter", type=float, default=0.002, help="random extra seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with a 503")
+    parser.add_argument("--mix", default=None,
+                        help="comma separated operation=weight, e.g. list=5,edit=1 (default: %s)" %
+                             ",".join("%s=%d" % item for item in DEFAULT_MIX.items()))
+    parser.add_argument("--seed", type=int, default=None, help="seed for a reproducible run")
+    args = parser.parse_args()
+
+    mix = None
+    if args.mix:
+        mix = {}
+        for item in args.mix.split(","):
+            operation, weight = item.split("=")
+            if operation not in DEFAULT_MIX:
+                parser.error("unknown operation " + operation)
+            mix[operation] = float(weight)
+
+    time_now = datetime.datetime.utcnow()
+    server = FakeEventsServer(generate_events(args.events, time_now, args.seed), args.latency, args.jitter,
+                              args.error_rate, args.seed)
+    print_report(run_load(server, args.duration, args.workers, mix, time_now, args.seed))
+
+
+if __name__ == "__main__":
+    main()
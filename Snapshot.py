@@ -0,0 +1,333 @@
+# Compact columnar snapshots of cached calendars.
+#
+# A snapshot stores the events of a calendar column by column instead of as JSON dicts:
+#  - start and end as int64 epoch seconds, for bisection, and as the original date or dateTime strings, so
+#    all-day events and UTC offsets come back as the API returned them,
+#  - the time zone of the start dictionary encoded,
+#  - organizer, location and status dictionary encoded as int32 codes (-1 when missing),
+#  - the reminder in minutes as int32 (-1 when the calendar's default is used, -2 when there is none),
+#  - id and summary as offset arrays into a UTF-8 blob,
+#  - every other field, such as description, attendees, creator, etag or extendedProperties, and the full value
+#    of fields the columns only hold part of (reminder overrides beyond the first, the end time zone, the
+#    organizer's display name), as JSON zlib compressed in blocks of EXTRA_BLOCK_SIZE events.
+# An event therefore comes back as it was written, except that a missing id or summary comes back empty and
+# missing reminders as {"useDefault": False}.
+# Every fixed width column starts on an 8 byte boundary, so an opened snapshot reads its columns straight from a
+# memory map without copying. Events are sorted by start, which lets events_between bisect on the start column.
+from __future__ import print_function
+import array
+import bisect
+import copy
+import datetime
+import json
+import mmap
+import struct
+import sys
+import zlib
+
+import Calendar
+
+MAGIC = b"CALSNAP3"
+# Number of events whose extra fields are compressed together
+EXTRA_BLOCK_SIZE = 256
+_HEADER_LENGTH = struct.Struct("<Q")
+_DEFAULT_REMINDER = -1
+_NO_REMINDER = -2
+_MISSING = -1
+
+
+def _epoch(value):
+    """
+    Return the epoch seconds of an event's dateTime or date.
+    """
+    return int(Calendar.parse_rfc3339(value).timestamp())
+
+
+def _epoch_of(time_value):
+    """
+    Return the epoch seconds of a datetime, naive values are UTC.
+    """
+    if time_value.tzinfo is None:
+        time_value = time_value.replace(tzinfo=datetime.timezone.utc)
+    return int(time_value.timestamp())
+
+
+def _fixed_column(typecode, values):
+    """
+    Return the little endian bytes of an array column.
+    """
+    column = array.array(typecode, values)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tobytes()
+
+
+def _string_column(values):
+    """
+    Return (offsets bytes, blob bytes) of a string column; value i is blob[offsets[i]:offsets[i + 1]].
+    """
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    return _fixed_column("q", offsets), b"".join(encoded)
+
+
+def _dictionary_column(values):
+    """
+    Return (codes bytes, dictionary) of a dictionary encoded string column.
+    """
+    dictionary = {}
+    codes = []
+    for value in values:
+        if value is None:
+            codes.append(_MISSING)
+        else:
+            codes.append(dictionary.setdefault(value, len(dictionary)))
+    return _fixed_column("i", codes), list(dictionary)
+
+
+def _reminder_code(event):
+    reminders = event.get("reminders") or {}
+    if reminders.get("useDefault"):
+        return _DEFAULT_REMINDER
+    try:
+        return int(reminders["overrides"][0]["minutes"])
+    except (KeyError, IndexError, TypeError):
+        return _NO_REMINDER
+
+
+def _rebuild(event_id, summary, start_text, end_text, time_zone, reminder, status, location, organizer):
+    """
+    Return the part of an event held by the columns, as a dict like those returned by the API.
+    """
+    event = {"id": event_id, "summary": summary}
+    for name, value in (("start", start_text), ("end", end_text)):
+        # All-day events hold a date (YYYY-MM-DD), the others a dateTime
+        event[name] = {"dateTime": value} if "T" in value else {"date": value}
+    if time_zone is not None:
+        event["start"]["timeZone"] = time_zone
+    if reminder == _DEFAULT_REMINDER:
+        event["reminders"] = {"useDefault": True}
+    elif reminder == _NO_REMINDER:
+        event["reminders"] = {"useDefault": False}
+    else:
+        event["reminders"] = {"useDefault": False, "overrides": [{"method": "popup", "minutes": reminder}]}
+    if status is not None:
+        event["status"] = status
+    if location is not None:
+        event["location"] = location
+    if organizer is not None:
+        event["organizer"] = {"email": organizer}
+    return event
+
+
+def _extra(event):
+    """
+    Return the fields of an event the columns do not rebuild as they are, None when there are none.
+    """
+    core = _rebuild(event.get("id", ""), event.get("summary", ""), Calendar.event_time_value(event, "start"),
+                    Calendar.event_time_value(event, "end"), event["start"].get("timeZone"), _reminder_code(event),
+                    event.get("status"), event.get("location"), (event.get("organizer") or {}).get("email"))
+    extra = {name: value for name, value in event.items() if core.get(name) != value}
+    return extra or None
+
+
+def write_snapshot(events, path):
+    """
+    Write events to a snapshot file, replacing it atomically.
+
+    @param events: an array of events
+    @type events: array
+    @param path: The snapshot file
+    @type path: String
+    @return: Number of events written
+    """
+    events = sorted(events, key=Calendar.event_start)
+    columns = {}
+    columns["start"] = _fixed_column("q", (_epoch(Calendar.event_time_value(event, "start")) for event in events))
+    columns["end"] = _fixed_column("q", (_epoch(Calendar.event_time_value(event, "end")) for event in events))
+    columns["reminder"] = _fixed_column("i", (_reminder_code(event) for event in events))
+    dictionaries = {}
+    for name, values in (("organizer", [(event.get("organizer") or {}).get("email") for event in events]),
+                         ("location", [event.get("location") for event in events]),
+                         ("status", [event.get("status") for event in events]),
+                         ("time_zone", [event["start"].get("timeZone") for event in events])):
+        columns[name], dictionaries[name] = _dictionary_column(values)
+    for name in ("id", "summary"):
+        columns[name + "_offsets"], columns[name] = _string_column([event.get(name, "") for event in events])
+    for name in ("start", "end"):
+        columns[name + "_text_offsets"], columns[name + "_text"] = _string_column(
+            [Calendar.event_time_value(event, name) for event in events])
+
+    extra_blocks = []
+    for first in range(0, len(events), EXTRA_BLOCK_SIZE):
+        block = [_extra(event) for event in events[first:first + EXTRA_BLOCK_SIZE]]
+        extra_blocks.append(zlib.compress(json.dumps(block).encode("utf-8")))
+    block_offsets = [0]
+    for block in extra_blocks:
+        block_offsets.append(block_offsets[-1] + len(block))
+    columns["extra_offsets"] = _fixed_column("q", block_offsets)
+    columns["extra"] = b"".join(extra_blocks)
+
+    # Lay the columns out after the header, each on an 8 byte boundary
+    layout = {}
+    position = 0
+    for name, data in columns.items():
+        position += -position % 8
+        layout[name] = [position, len(data)]
+        position += len(data)
+    header = json.dumps({"count": len(events), "columns": layout, "dictionaries": dictionaries,
+                         "extra_block_size": EXTRA_BLOCK_SIZE}).encode("utf-8")
+    data_start = len(MAGIC) + _HEADER_LENGTH.size + len(header)
+    padding = -data_start % 8
+
+    with Calendar.atomic_write(path, ".snapshot-", "wb") as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(_HEADER_LENGTH.pack(len(header) + padding))
+        snapshot.write(header + b" " * padding)
+        written = 0
+        for name, data in columns.items():
+            snapshot.write(b"\0" * (layout[name][0] - written))
+            snapshot.write(data)
+            written = layout[name][0] + len(data)
+    return len(events)
+
+
+class EventSnapshot:
+    """
+    A snapshot opened with open_snapshot. Columns are read from a memory map of the file; events are only
+    rebuilt as dicts when asked for with event, events_between or iteration.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: The snapshot file
+        @type path: String
+        """
+        with open(path, "rb") as snapshot:
+            self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError(path + " is not a calendar snapshot")
+        header_length, = _HEADER_LENGTH.unpack_from(self._map, len(MAGIC))
+        header_start = len(MAGIC) + _HEADER_LENGTH.size
+        header = json.loads(self._map[header_start:header_start + header_length].decode("utf-8"))
+        self._data_start = header_start + header_length
+        self._layout = header["columns"]
+        self._dictionaries = header["dictionaries"]
+        self._block_size = header["extra_block_size"]
+        self._count = header["count"]
+        self._view = memoryview(self._map)
+        # Views of the columns, released before the memory map is closed
+        self._views = []
+        self._block_cache = (None, None)
+        self.starts = self._fixed("start", "q")
+        self.ends = self._fixed("end", "q")
+        self._reminders = self._fixed("reminder", "i")
+        self._codes = {name: self._fixed(name, "i") for name in self._dictionaries}
+        self._offsets = {name: self._fixed(name + "_offsets", "q")
+                         for name in ("id", "summary", "extra", "start_text", "end_text")}
+
+    def _raw(self, name):
+        offset, length = self._layout[name]
+        start = self._data_start + offset
+        return self._view[start:start + length]
+
+    def _fixed(self, name, typecode):
+        raw = self._raw(name)
+        if sys.byteorder == "little":
+            # Zero copy: the column is read straight from the memory map
+            column = raw.cast(typecode)
+            self._views.append(column)
+            return column
+        column = array.array(typecode, raw.tobytes())
+        column.byteswap()
+        return column
+
+    def _string(self, name, index):
+        offsets = self._offsets[name]
+        return bytes(self._raw(name)[offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def _extra(self, index):
+        block = index // self._block_size
+        if self._block_cache[0] != block:
+            offsets = self._offsets["extra"]
+            compressed = self._raw("extra")[offsets[block]:offsets[block + 1]]
+            self._block_cache = (block, json.loads(zlib.decompress(compressed).decode("utf-8")))
+        return self._block_cache[1][index % self._block_size]
+
+    def __len__(self):
+        return self._count
+
+    def value(self, name, index):
+        """
+        Return a dictionary encoded value (organizer, location, status or time_zone) of an event, None when
+        missing.
+        """
+        code = self._codes[name][index]
+        return None if code == _MISSING else self._dictionaries[name][code]
+
+    def event(self, index):
+        """
+        Rebuild event number index as an event dict like those returned by the API, with all the fields it was
+        written with (see the module header for the exceptions).
+
+        @param index: Position of the event, events are ordered by start
+        @type index: Integer
+        @return: dict
+        """
+        event = _rebuild(self._string("id", index), self._string("summary", index),
+                         self._string("start_text", index), self._string("end_text", index),
+                         self.value("time_zone", index), self._reminders[index], self.value("status", index),
+                         self.value("location", index), self.value("organizer", index))
+        extra = self._extra(index)
+        if extra is not None:
+            # Copied, the decoded block is kept for the next events
+            event.update(copy.deepcopy(extra))
+        return event
+
+    def events_between(self, time_min, time_max):
+        """
+        Return the events starting in [time_min, time_max), found by bisecting the start column.
+
+        @param time_min: Start of the range
+        @type time_min: datetime class object, naive values are UTC
+        @param time_max: End of the range
+        @type time_max: datetime class object, naive values are UTC
+        @return: list of events
+        """
+        low = bisect.bisect_left(self.starts, _epoch_of(time_min))
+        high = bisect.bisect_left(self.starts, _epoch_of(time_max))
+        return [self.event(index) for index in range(low, high)]
+
+    def __iter__(self):
+        return (self.event(index) for index in range(self._count))
+
+    def close(self):
+        """
+        Release the memory map.
+        @return: No return
+        """
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_snapshot(path):
+    """
+    Open a snapshot written by write_snapshot.
+
+    @param path: The snapshot file
+    @type path: String
+    @return: EventSnapshot, to be closed after use (it is a context manager)
+    """
+    return EventSnapshot(path)
@@ -0,0 +1,207 @@
+# Memory bounded processing of large event windows.
+#
+# Every stage is a generator taking an iterable of events, so a pipeline such as
+#     export_jsonl(external_sort(buffered(fetch_events(api, ...)), key=...), path)
+# holds only a few pages of events at a time, however large the calendar:
+#  - fetch_events pulls one result page at a time, the next page being fetched while the current one is used,
+#  - buffered runs the stages before it in a thread feeding a bounded queue, so a slow consumer makes the
+#    producer wait (backpressure) instead of letting events pile up,
+#  - external_sort keeps at most memory_ceiling bytes of events; beyond that sorted runs are spilled to
+#    temporary JSONL files and merged back lazily,
+#  - print_event_stream and export_jsonl render or write events as they arrive.
+# Sizes are measured as the length of the events' JSON encoding, a stable proxy for their footprint.
+from __future__ import print_function
+import heapq
+import json
+import os
+import queue
+import tempfile
+import threading
+
+import Calendar
+
+# Default number of bytes of events an external sort keeps in memory before spilling to disk
+MEMORY_CEILING = 64 * 1024 * 1024
+# Default number of events a buffered stage holds between producer and consumer
+BUFFER_SIZE = 1000
+_DONE = object()
+
+
+def event_size(event):
+    """
+    Return the size of an event as counted against a memory ceiling: the length of its JSON encoding.
+    """
+    return len(json.dumps(event, separators=(",", ":")))
+
+
+def fetch_events(api, time_min, time_max, key_word="", page_size=Calendar.PAGE_SIZE):
+    """
+    Yield every event between time_min and time_max in start time order, one result page in memory at a time.
+
+    @param api: The build generated in get_calendar_api() function
+    @type api: googleapiclient.discovery.build
+    @param time_min: Start of the window in UTC
+    @type time_min: datetime class object
+    @param time_max: End of the window in UTC
+    @type time_max: datetime class object
+    @param key_word: Events with this key word will be returned
+    @type key_word: String
+    @param page_size: Number of events requested per page
+    @type page_size: Integer
+    @return: generator of events
+    """
+    for page in Calendar.iter_event_pages(api, Calendar.to_rfc3339(time_min), Calendar.to_rfc3339(time_max),
+                                          key_word, page_size):
+        yield from page
+
+
+def buffered(events, max_items=BUFFER_SIZE):
+    """
+    Consume events in a background thread into a queue of at most max_items, and yield them from it. The thread
+    blocks while the queue is full, so upstream stages never run more than max_items ahead of the consumer.
+    Errors raised upstream are raised again in the consumer.
+
+    @param events: The upstream stage
+    @type events: iterable of events
+    @param max_items: Maximum number of events held between the stages
+    @type max_items: Integer
+    @return: generator of events
+    """
+    handoff = queue.Queue(maxsize=max_items)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up once the consumer has stopped, instead of blocking on a full queue forever
+        while not stopped.is_set():
+            try:
+                handoff.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(events)
+        try:
+            for event in iterator:
+                if not put((None, event)):
+                    return
+            put((None, _DONE))
+        except BaseException as error:
+            put((error, None))
+        finally:
+            # Let upstream generators release what they hold when the consumer stopped early
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    producer = threading.Thread(target=produce, name="stream-buffer", daemon=True)
+    producer.start()
+    try:
+        while True:
+            error, event = handoff.get()
+            if error is not None:
+                raise error
+            if event is _DONE:
+                return
+            yield event
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def _write_run(events, directory):
+    fd, path = tempfile.mkstemp(dir=directory, prefix="run-", suffix=".jsonl")
+    with os.fdopen(fd, "w") as run:
+        for event in events:
+            run.write(json.dumps(event, separators=(",", ":")))
+            run.write("\n")
+    return path
+
+
+def _read_run(path):
+    with open(path) as run:
+        for line in run:
+            yield json.loads(line)
+
+
+def external_sort(events, key=Calendar.event_start, memory_ceiling=MEMORY_CEILING, directory=None):
+    """
+    Yield events sorted by key, holding at most about memory_ceiling bytes of events in memory. When the events
+    do not fit, sorted runs are spilled to JSONL files in a temporary directory and merged; the files are removed
+    once the generator is exhausted or closed. The sort is stable.
+
+    @param events: The events to sort
+    @type events: iterable of events
+    @param key: Function returning the sort key of an event
+    @type key: callable
+    @param memory_ceiling: Bytes of events (see event_size) kept in memory
+    @type memory_ceiling: Integer
+    @param directory: Where the temporary directory is created, the system default when None
+    @type directory: String
+    @return: generator of events
+    """
+    buffer = []
+    held = 0
+    runs = []
+    spill = None
+    try:
+        for event in events:
+            buffer.append(event)
+            held += event_size(event)
+            if held > memory_ceiling:
+                if spill is None:
+                    spill = tempfile.TemporaryDirectory(prefix="calendar-sort-", dir=directory)
+                buffer.sort(key=key)
+                runs.append(_write_run(buffer, spill.name))
+                buffer = []
+                held = 0
+        buffer.sort(key=key)
+        if not runs:
+            yield from buffer
+            return
+        if buffer:
+            runs.append(_write_run(buffer, spill.name))
+            buffer = []
+        yield from heapq.merge(*(_read_run(run) for run in runs), key=key)
+    finally:
+        if spill is not None:
+            spill.cleanup()
+
+
+def print_event_stream(events, default_reminder=Calendar.DEFAULT_REMINDER):
+    """
+    Print events the way print_events does, as they arrive.
+
+    @param events: The events to print
+    @type events: iterable of events
+    @param default_reminder: minutes shown for events using the calendar's default reminders
+    @type default_reminder: Integer
+    @return: Number of events printed
+    """
+    num = 0
+    for event in events:
+        for row in Calendar._event_rows([event], default_reminder):
+            num += 1
+            print("Events: ", num, row)
+    if not num:
+        print('No upcoming events found.')
+    return num
+
+
+def export_jsonl(events, path):
+    """
+    Write events to a JSONL file, one event per line, replacing it atomically once every event is written.
+
+    @param events: The events to write
+    @type events: iterable of events
+    @param path: The export file
+    @type path: String
+    @return: Number of events written
+    """
+    count = 0
+    with Calendar.atomic_write(path, ".export-") as export:
+        for event in events:
+            export.write(json.dumps(event, separators=(",", ":")))
+            export.write("\n")
+            count += 1
+    return count